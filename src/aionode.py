@@ -0,0 +1,260 @@
+import asyncio
+import time
+
+from collections import deque
+from os import urandom
+
+from .helper import (
+    hash256,
+    little_endian_to_int,
+)
+from .network import (
+    NETWORK_MAGIC,
+    TESTNET_NETWORK_MAGIC,
+    NetworkEnvelope,
+    PingMessage,
+    PongMessage,
+    VerAckMessage,
+    VersionMessage,
+)
+
+# unclaimed messages kept per command for later wait_for calls
+QUEUE_LIMIT = 1000
+# what one misbehaving or vanished peer can raise: timeouts and socket
+# errors, a truncated stream, bad magic/checksum or an unparseable payload
+PEER_ERRORS = (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError,
+               RuntimeError, ValueError, IndexError)
+
+
+async def read_envelope(reader, testnet=False):
+    '''Reads one NetworkEnvelope from an asyncio StreamReader'''
+    header = await reader.readexactly(24)
+    magic = header[:4]
+    expected_magic = TESTNET_NETWORK_MAGIC if testnet else NETWORK_MAGIC
+    if magic != expected_magic:
+        raise RuntimeError('magic is not right {} vs {}'.format(magic.hex(), expected_magic.hex()))
+    command = header[4:16].strip(b'\x00')
+    payload_length = little_endian_to_int(header[16:20])
+    payload = await reader.readexactly(payload_length)
+    if hash256(payload)[:4] != header[20:24]:
+        raise RuntimeError('checksum does not match')
+    return NetworkEnvelope(command, payload, testnet=testnet)
+
+
+class PeerSession:
+    '''One asyncio connection to a peer.
+
+    A background task reads every message: version and ping are answered
+    there, pongs resolve ping() calls, and everything else is handed to
+    waiting wait_for() callers or queued per command until one asks.
+    '''
+
+    def __init__(self, host, port=None, testnet=False, timeout=10):
+        if port is None:
+            port = 18333 if testnet else 8333
+        self.host = host
+        self.port = port
+        self.testnet = testnet
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.queues = {}
+        self.waiters = []
+        self.pings = {}
+        self.closed = False
+        self._task = None
+        self._verack = None
+
+    def __repr__(self):
+        return 'PeerSession({}:{})'.format(self.host, self.port)
+
+    async def connect(self):
+        '''Opens the connection and completes the version/verack handshake'''
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        self._verack = asyncio.get_running_loop().create_future()
+        self._task = asyncio.ensure_future(self._read_loop())
+        await self.send(VersionMessage())
+        await asyncio.wait_for(asyncio.shield(self._verack), self.timeout)
+        return self
+
+    async def send(self, message):
+        envelope = NetworkEnvelope(message.command, message.serialize(), testnet=self.testnet)
+        self.writer.write(envelope.serialize())
+        await self.writer.drain()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                envelope = await read_envelope(self.reader, self.testnet)
+                self._dispatch(envelope)
+        except PEER_ERRORS as e:
+            self._fail(e)
+        except asyncio.CancelledError:
+            self._fail(ConnectionError('session closed'))
+
+    def _dispatch(self, envelope):
+        command = envelope.command
+        if command == VersionMessage.command:
+            self.writer.write(NetworkEnvelope(
+                VerAckMessage.command, b'', testnet=self.testnet).serialize())
+        elif command == VerAckMessage.command:
+            if not self._verack.done():
+                self._verack.set_result(True)
+        elif command == PingMessage.command:
+            self.writer.write(NetworkEnvelope(
+                PongMessage.command, envelope.payload, testnet=self.testnet).serialize())
+        elif command == PongMessage.command and envelope.payload in self.pings:
+            future = self.pings.pop(envelope.payload)
+            if not future.done():
+                future.set_result(time.perf_counter())
+        else:
+            for waiter in self.waiters:
+                commands, future = waiter
+                if command in commands and not future.done():
+                    self.waiters.remove(waiter)
+                    future.set_result(envelope)
+                    return
+            queue = self.queues.setdefault(command, deque(maxlen=QUEUE_LIMIT))
+            queue.append(envelope)
+
+    def _fail(self, error):
+        self.closed = True
+        futures = [future for _, future in self.waiters] + list(self.pings.values())
+        if self._verack is not None:
+            futures.append(self._verack)
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+        self.waiters = []
+        self.pings = {}
+
+    async def wait_for(self, *message_classes, timeout=None):
+        '''Returns the next message of one of the given classes, parsed'''
+        command_to_class = {m.command: m for m in message_classes}
+        for command in command_to_class:
+            queue = self.queues.get(command)
+            if queue:
+                envelope = queue.popleft()
+                return command_to_class[command].parse(envelope.stream())
+        if self.closed:
+            raise ConnectionError('session closed')
+        future = asyncio.get_running_loop().create_future()
+        waiter = (set(command_to_class), future)
+        self.waiters.append(waiter)
+        try:
+            envelope = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        return command_to_class[envelope.command].parse(envelope.stream())
+
+    async def request(self, message, *response_classes, timeout=None):
+        '''Sends message and awaits the first response of the given classes'''
+        await self.send(message)
+        return await self.wait_for(*response_classes, timeout=timeout)
+
+    async def ping(self, timeout=None):
+        '''Round-trip time in seconds'''
+        nonce = urandom(8)
+        future = asyncio.get_running_loop().create_future()
+        self.pings[nonce] = future
+        start = time.perf_counter()
+        await self.send(PingMessage(nonce))
+        end = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        return end - start
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.closed = True
+
+
+class AsyncNode:
+    '''Concurrent sessions with many peers on one event loop'''
+
+    def __init__(self, testnet=False, timeout=10):
+        self.testnet = testnet
+        self.timeout = timeout
+        self.sessions = []
+
+    async def connect(self, addresses):
+        '''Connects to (host, port) pairs concurrently; failed peers are skipped'''
+        sessions = [PeerSession(host, port, self.testnet, self.timeout) for host, port in addresses]
+        results = await asyncio.gather(*(s.connect() for s in sessions), return_exceptions=True)
+        connected = [s for s, r in zip(sessions, results) if not isinstance(r, BaseException)]
+        for session, result in zip(sessions, results):
+            if isinstance(result, BaseException):
+                await session.close()
+        self.sessions.extend(connected)
+        return connected
+
+    def live_sessions(self):
+        return [s for s in self.sessions if not s.closed]
+
+    async def broadcast(self, message):
+        sessions = self.live_sessions()
+        await asyncio.gather(*(s.send(message) for s in sessions), return_exceptions=True)
+        return len(sessions)
+
+    async def request_any(self, message, *response_classes, timeout=None):
+        '''Sends message to every peer and returns the first response.
+
+        A peer that times out, disconnects or sends something unparseable
+        just drops out of the race; ConnectionError is raised only when
+        every peer failed.
+        '''
+        sessions = self.live_sessions()
+        if not sessions:
+            raise ConnectionError('no connected peers')
+        tasks = [asyncio.ensure_future(s.request(message, *response_classes, timeout=timeout))
+                 for s in sessions]
+        try:
+            error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except PEER_ERRORS as e:
+                    error = e
+            raise ConnectionError('no peer answered: {!r}'.format(error))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def close(self):
+        await asyncio.gather(*(s.close() for s in self.sessions), return_exceptions=True)
+        self.sessions = []
+
+
+# Benchmark against local stand-in peers: python -m src.aionode
+if __name__ == "__main__":
+    from .standin import StandInPeer
+
+    async def bench(peers, rounds=200):
+        node = AsyncNode(testnet=True)
+        await node.connect([(p.host, p.port) for p in peers])
+
+        async def run(session):
+            return [await session.ping() for _ in range(rounds)]
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run(s) for s in node.sessions))
+        elapsed = time.perf_counter() - start
+        await node.close()
+        latencies = sorted(rtt for result in results for rtt in result)
+        return (len(latencies) * 2 / elapsed, latencies[len(latencies) // 2],
+                latencies[int(len(latencies) * 0.99)])
+
+    for count in (1, 8, 32):
+        peers = [StandInPeer(testnet=True).start() for _ in range(count)]
+        rate, median, p99 = asyncio.run(bench(peers))
+        for peer in peers:
+            peer.stop()
+        print('{:>2} peers: {:8.0f} msg/s, median rtt {:.2f} ms, p99 {:.2f} ms'.format(
+            count, rate, median * 1000, p99 * 1000))
@@ -0,0 +1,147 @@
+import hashlib
+
+from functools import lru_cache
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+# Encoding divides by limbs of 10 base58 digits (58**10 < 2**64). Each
+# limb is split into two halves of five digits, written as pair + pair +
+# single digit from the lookup tables below.
+LIMB = 58 ** 10
+HALF = 58 ** 5
+PAIR = 58 ** 2
+PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+
+# Decoding translates every character to its digit value in one pass;
+# anything outside the alphabet becomes 0xff.
+DIGITS = bytes(
+    BASE58_ALPHABET.index(chr(i)) if chr(i) in BASE58_ALPHABET else 0xff
+    for i in range(256)
+)
+
+ADDRESS_CACHE_SIZE = 4096
+
+
+def _checksum(s):
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()[:4]
+
+
+def encode_base58(s):
+    '''Encode bytes into a Base58 string'''
+    count = len(s) - len(s.lstrip(b'\x00'))
+    num = int.from_bytes(s, 'big')
+    parts = []
+    while num > 0:
+        num, limb = divmod(num, LIMB)
+        for half in (limb % HALF, limb // HALF):
+            parts.append(PAIRS[half % PAIR])
+            parts.append(PAIRS[half // PAIR % PAIR])
+            parts.append(BASE58_ALPHABET[half // (PAIR * PAIR)])
+    parts.reverse()
+    return '1' * count + ''.join(parts).lstrip('1')
+
+
+def encode_base58_checksum(s):
+    '''Encode bytes into Base58 with checksum appended'''
+    return encode_base58(s + _checksum(s))
+
+
+def decode_base58_raw(s):
+    '''Decode a Base58 string into bytes, keeping leading zero bytes'''
+    count = len(s) - len(s.lstrip('1'))
+    try:
+        digits = s.encode('ascii').translate(DIGITS)
+    except UnicodeEncodeError:
+        raise ValueError('invalid base58 string: {!r}'.format(s))
+    if 0xff in digits:
+        raise ValueError('invalid base58 string: {!r}'.format(s))
+    num = 0
+    for digit in digits:
+        num = num * 58 + digit
+    return b'\x00' * count + num.to_bytes((num.bit_length() + 7) // 8, 'big')
+
+
+def decode_base58_checksum(s):
+    '''Decode a Base58Check string and return the payload with its version byte'''
+    combined = decode_base58_raw(s)
+    if len(combined) < 5:
+        raise ValueError('bad base58check string: {}'.format(s))
+    checksum = combined[-4:]
+    if _checksum(combined[:-4]) != checksum:
+        raise ValueError('bad address: {} {}'.format(checksum,
+            _checksum(combined[:-4])))
+    return combined[:-4]
+
+
+def decode_base58(s):
+    '''Decode a Base58 string and verify checksum'''
+    return decode_base58_checksum(s)[1:]
+
+
+def encode_many(payloads, checksum=True):
+    '''Encode an iterable of byte strings, e.g. many addresses or WIFs'''
+    encode = encode_base58_checksum if checksum else encode_base58
+    return [encode(s) for s in payloads]
+
+
+def decode_many(strings, checksum=True):
+    '''Decode an iterable of Base58 strings (as decode_base58, or raw bytes)'''
+    if not checksum:
+        return [decode_base58_raw(s) for s in strings]
+    return [decode_base58(s) for s in strings]
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def decode_address(address):
+    '''Return the hash160 of a P2PKH/P2SH address.
+
+    Results are kept in a bounded LRU cache, so repeated payouts to the
+    same address skip the decode and checksum work. Invalid addresses
+    raise ValueError and are not cached.
+    '''
+    h160 = decode_base58(address)
+    if len(h160) != 20:
+        raise ValueError('bad address length: {}'.format(address))
+    return h160
+
+
+# Throughput benchmark when run directly: python -m src.base58
+if __name__ == "__main__":
+    import os
+    import time
+
+    def naive_encode(s):
+        count = len(s) - len(s.lstrip(b'\x00'))
+        num = int.from_bytes(s, 'big')
+        result = ''
+        while num > 0:
+            num, mod = divmod(num, 58)
+            result = BASE58_ALPHABET[mod] + result
+        return '1' * count + result
+
+    def naive_decode(s):
+        num = 0
+        for c in s:
+            num = num * 58 + BASE58_ALPHABET.index(c)
+        return num.to_bytes(25, 'big')
+
+    def bench(label, func, items):
+        start = time.perf_counter()
+        func(items)
+        elapsed = time.perf_counter() - start
+        print('{:<32}{:>12.0f} ops/s'.format(label, len(items) / elapsed))
+
+    count = 100000
+    payloads = [b'\x6f' + os.urandom(20) for _ in range(count)]
+    raw = [s + _checksum(s) for s in payloads]
+    addresses = encode_many(payloads)
+    assert addresses == [naive_encode(s) for s in raw]
+    assert decode_many(addresses) == [s[1:] for s in payloads]
+    bench('naive encode', lambda xs: [naive_encode(s) for s in xs], raw)
+    bench('table encode', lambda xs: [encode_base58(s) for s in xs], raw)
+    bench('encode_many (checksum)', encode_many, payloads)
+    bench('naive decode', lambda xs: [naive_decode(s) for s in xs], addresses)
+    bench('decode_many (checksum)', decode_many, addresses)
+    hot = addresses[:ADDRESS_CACHE_SIZE // 2] * 20
+    bench('decode_address (cached)', lambda xs: [decode_address(a) for a in xs], hot)
+    print(decode_address.cache_info())
@@ -0,0 +1,345 @@
+from io import BytesIO
+
+import numpy as np
+
+from .helper import (
+    encode_varint,
+    hash256,
+    read_varint,
+)
+
+# Parameters of the BIP158 basic filter
+BASIC_FILTER_P = 19
+BASIC_FILTER_M = 784931
+MASK64 = 0xffffffffffffffff
+
+
+def siphash(key, data):
+    '''SipHash-2-4 of data under a 16-byte key, as an integer'''
+    k0 = int.from_bytes(key[:8], 'little')
+    k1 = int.from_bytes(key[8:16], 'little')
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    tail = length - length % 8
+    words = [int.from_bytes(data[i:i + 8], 'little') for i in range(0, tail, 8)]
+    words.append(int.from_bytes(data[tail:], 'little') | ((length & 0xff) << 56))
+    # the SipRound is inlined: it dominates filter matching time
+    for m in words:
+        v3 ^= m
+        for _ in range(2):
+            v0 = (v0 + v1) & MASK64
+            v1 = ((v1 << 13) | (v1 >> 51)) & MASK64 ^ v0
+            v0 = ((v0 << 32) | (v0 >> 32)) & MASK64
+            v2 = (v2 + v3) & MASK64
+            v3 = ((v3 << 16) | (v3 >> 48)) & MASK64 ^ v2
+            v0 = (v0 + v3) & MASK64
+            v3 = ((v3 << 21) | (v3 >> 43)) & MASK64 ^ v0
+            v2 = (v2 + v1) & MASK64
+            v1 = ((v1 << 17) | (v1 >> 47)) & MASK64 ^ v2
+            v2 = ((v2 << 32) | (v2 >> 32)) & MASK64
+        v0 ^= m
+    v2 ^= 0xff
+    for _ in range(4):
+        v0 = (v0 + v1) & MASK64
+        v1 = ((v1 << 13) | (v1 >> 51)) & MASK64 ^ v0
+        v0 = ((v0 << 32) | (v0 >> 32)) & MASK64
+        v2 = (v2 + v3) & MASK64
+        v3 = ((v3 << 16) | (v3 >> 48)) & MASK64 ^ v2
+        v0 = (v0 + v3) & MASK64
+        v3 = ((v3 << 21) | (v3 >> 43)) & MASK64 ^ v0
+        v2 = (v2 + v1) & MASK64
+        v1 = ((v1 << 17) | (v1 >> 47)) & MASK64 ^ v2
+        v2 = ((v2 << 32) | (v2 >> 32)) & MASK64
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def _message_words(items):
+    '''Packs equal-length items into the (n, words) uint64 SipHash message blocks'''
+    length = len(items[0])
+    padded = -(length + 1) % 8
+    blocks = b''.join(item + b'\x00' * padded + bytes([length & 0xff]) for item in items)
+    return np.frombuffer(blocks, '<u8').reshape(len(items), -1).astype(np.uint64)
+
+
+def _vector_siphash(key, words):
+    '''SipHash-2-4 of every row of words at once'''
+    k0 = np.uint64(int.from_bytes(key[:8], 'little'))
+    k1 = np.uint64(int.from_bytes(key[8:16], 'little'))
+    count = len(words)
+    v0 = np.full(count, k0 ^ np.uint64(0x736f6d6570736575), np.uint64)
+    v1 = np.full(count, k1 ^ np.uint64(0x646f72616e646f6d), np.uint64)
+    v2 = np.full(count, k0 ^ np.uint64(0x6c7967656e657261), np.uint64)
+    v3 = np.full(count, k1 ^ np.uint64(0x7465646279746573), np.uint64)
+    shifts = {b: (np.uint64(b), np.uint64(64 - b)) for b in (13, 16, 17, 21, 32)}
+
+    def rotl(x, b):
+        left, right = shifts[b]
+        return (x << left) | (x >> right)
+
+    def sipround(v0, v1, v2, v3):
+        v0 = v0 + v1
+        v1 = rotl(v1, 13) ^ v0
+        v0 = rotl(v0, 32)
+        v2 = v2 + v3
+        v3 = rotl(v3, 16) ^ v2
+        v0 = v0 + v3
+        v3 = rotl(v3, 21) ^ v0
+        v2 = v2 + v1
+        v1 = rotl(v1, 17) ^ v2
+        v2 = rotl(v2, 32)
+        return v0, v1, v2, v3
+
+    for column in range(words.shape[1]):
+        m = words[:, column]
+        v3 = v3 ^ m
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0 = v0 ^ m
+    v2 = v2 ^ np.uint64(0xff)
+    for _ in range(4):
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def hash_to_range(key, item, f):
+    '''Maps item uniformly into [0, f) with SipHash and a 64-bit multiply'''
+    return (siphash(key, item) * f) >> 64
+
+
+def hashed_values(key, items, n, m=BASIC_FILTER_M):
+    '''Sorted range hashes of items for a filter of n elements, collisions kept'''
+    f = n * m
+    return sorted(hash_to_range(key, item, f) for item in items)
+
+
+def hashed_set(key, items, n, m=BASIC_FILTER_M):
+    '''Sorted, de-duplicated range hashes of items, for querying a filter'''
+    f = n * m
+    return sorted(set(hash_to_range(key, item, f) for item in items))
+
+
+def golomb_encode(values, p=BASIC_FILTER_P):
+    '''Golomb-Rice codes the deltas of sorted values into bytes (MSB first)'''
+    bits = []
+    last = 0
+    for value in values:
+        delta = value - last
+        last = value
+        bits.append('1' * (delta >> p) + '0')
+        bits.append(format(delta & ((1 << p) - 1), '0{}b'.format(p)))
+    stream = ''.join(bits)
+    if not stream:
+        return b''
+    stream += '0' * (-len(stream) % 8)
+    return int(stream, 2).to_bytes(len(stream) // 8, 'big')
+
+
+def golomb_decode(data, n, p=BASIC_FILTER_P):
+    '''Yields the n sorted values coded in data'''
+    stream = format(int.from_bytes(data, 'big'), '0{}b'.format(len(data) * 8)) if data else ''
+    pos = 0
+    value = 0
+    for _ in range(n):
+        end = stream.index('0', pos)
+        quotient = end - pos
+        pos = end + 1
+        value += (quotient << p) | int(stream[pos:pos + p], 2)
+        pos += p
+        yield value
+
+
+class GCSFilter:
+    '''A Golomb-coded set for one block (BIP158 basic filter by default)'''
+
+    def __init__(self, key, n, data, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        self.key = key
+        self.n = n
+        self.data = data
+        self.p = p
+        self.m = m
+
+    def __repr__(self):
+        return 'GCSFilter(n={}, bytes={})'.format(self.n, len(self.data))
+
+    @classmethod
+    def build(cls, block_hash, items, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        '''block_hash is in display order; its first 16 internal-order bytes key SipHash'''
+        key = block_hash[::-1][:16]
+        items = set(items)
+        # BIP158 codes every element, so two items hashing alike give a
+        # zero delta rather than shrinking the set below N
+        values = hashed_values(key, items, len(items), m)
+        return cls(key, len(items), golomb_encode(values, p), p, m)
+
+    @classmethod
+    def parse(cls, block_hash, s, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        n = read_varint(s)
+        return cls(block_hash[::-1][:16], n, s.read(), p, m)
+
+    def serialize(self):
+        return encode_varint(self.n) + self.data
+
+    def filter_hash(self):
+        return hash256(self.serialize())
+
+    def values(self):
+        return golomb_decode(self.data, self.n, self.p)
+
+    def match_hashed(self, query):
+        '''Sorted-merge of sorted range hashes against the set; True on any hit'''
+        if self.n == 0 or not query:
+            return False
+        i = 0
+        for value in self.values():
+            while query[i] < value:
+                i += 1
+                if i == len(query):
+                    return False
+            if query[i] == value:
+                return True
+        return False
+
+    def match_any(self, items):
+        if self.n == 0:
+            return False
+        return self.match_hashed(hashed_set(self.key, items, self.n, self.m))
+
+
+def basic_filter_items(block, prevout_scripts=()):
+    '''The scripts a BIP158 basic filter commits to.
+
+    block is a FullBlock; output scripts are read straight from its
+    buffer. prevout_scripts are the scriptPubKeys spent by the block's
+    non-coinbase inputs, which the block itself does not contain.
+    '''
+    items = set()
+    raw = block.raw
+    for _, _, outputs in block.tx_layouts():
+        for _, start, end in outputs:
+            if end > start and raw[start] != 0x6a:
+                items.add(bytes(raw[start:end]))
+    for script in prevout_scripts:
+        if script:
+            items.add(bytes(script))
+    return items
+
+
+def build_basic_filter(block, prevout_scripts=()):
+    return GCSFilter.build(block.hash(), basic_filter_items(block, prevout_scripts))
+
+
+def filter_header(filter_hash, prev_header):
+    '''Filter headers chain filter hashes: hash256(filter_hash + prev_header)'''
+    return hash256(filter_hash + prev_header)
+
+
+class FilterHeaderChain:
+    '''Filter headers by height, kept as one contiguous buffer'''
+
+    def __init__(self, prev_header=b'\x00' * 32):
+        self.base = prev_header
+        self.headers = bytearray()
+
+    def __len__(self):
+        return len(self.headers) // 32
+
+    def tip(self):
+        if not self.headers:
+            return self.base
+        return bytes(self.headers[-32:])
+
+    def header(self, height):
+        return bytes(self.headers[height * 32:height * 32 + 32])
+
+    def append(self, gcs_filter):
+        header = filter_header(gcs_filter.filter_hash(), self.tip())
+        self.headers += header
+        return header
+
+    def verify(self, height, gcs_filter):
+        '''Checks a filter served for height against the chain'''
+        prev = self.base if height == 0 else self.header(height - 1)
+        return filter_header(gcs_filter.filter_hash(), prev) == self.header(height)
+
+
+class WalletMatcher:
+    '''Matches a fixed set of wallet scriptPubKeys against many filters.
+
+    The scripts are packed into SipHash message blocks once, grouped by
+    length; each filter then hashes the whole wallet with vectorised
+    SipHash and does a single sorted merge against the decoded set.
+    '''
+
+    def __init__(self, scripts):
+        self.scripts = [bytes(s) for s in set(scripts)]
+        groups = {}
+        for script in self.scripts:
+            groups.setdefault(len(script), []).append(script)
+        self.blocks = [_message_words(group) for group in groups.values()]
+
+    def hashed(self, gcs_filter):
+        '''Sorted range hashes of the wallet for this filter'''
+        f = gcs_filter.n * gcs_filter.m
+        hashes = [_vector_siphash(gcs_filter.key, words) for words in self.blocks]
+        if not hashes:
+            return []
+        hashes = np.concatenate(hashes)
+        # (h * f) >> 64 without 128-bit integers: split h into 32-bit halves
+        high = hashes >> np.uint64(32)
+        low = hashes & np.uint64(0xffffffff)
+        f_high = np.uint64(f >> 32)
+        f_low = np.uint64(f & 0xffffffff)
+        cross = (low * f_low >> np.uint64(32)) + (high * f_low & np.uint64(0xffffffff)) \
+            + (low * f_high & np.uint64(0xffffffff))
+        values = high * f_high + (high * f_low >> np.uint64(32)) \
+            + (low * f_high >> np.uint64(32)) + (cross >> np.uint64(32))
+        return np.unique(values).tolist()
+
+    def matches(self, gcs_filter):
+        if gcs_filter.n == 0:
+            return False
+        return gcs_filter.match_hashed(self.hashed(gcs_filter))
+
+    def scan(self, filters):
+        '''Yields (position, filter) for each filter that may contain our scripts'''
+        for position, gcs_filter in enumerate(filters):
+            if self.matches(gcs_filter):
+                yield position, gcs_filter
+
+
+# Benchmark when run directly: python -m src.bip158
+if __name__ == "__main__":
+    import os
+    import time
+
+    assert siphash(bytes(range(16)), bytes(range(15))) == 0xa129ca6149be45e5
+    values = sorted(set(int.from_bytes(os.urandom(3), 'big') for _ in range(500)))
+    assert list(golomb_decode(golomb_encode(values), len(values))) == values
+
+    filters = []
+    for _ in range(200):
+        scripts = [b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac' for _ in range(400)]
+        filters.append(GCSFilter.build(os.urandom(32), scripts))
+    hit = GCSFilter.build(b'\x01' * 32, [b'wallet script'])
+    assert GCSFilter.parse(b'\x01' * 32, BytesIO(hit.serialize())).match_any([b'wallet script'])
+    chain = FilterHeaderChain()
+    for gcs_filter in filters:
+        chain.append(gcs_filter)
+    assert chain.verify(57, filters[57])
+
+    wallet = [os.urandom(25) for _ in range(50)]
+    matcher = WalletMatcher(wallet + [b'short', b'other'])
+    for gcs_filter in filters[:5]:
+        expected = hashed_set(gcs_filter.key, matcher.scripts, gcs_filter.n)
+        assert matcher.hashed(gcs_filter) == expected
+    assert matcher.matches(GCSFilter.build(b'\x02' * 32, [wallet[7], b'x']))
+
+    for size, sample in ((10, 200), (1000, 200), (100000, 20)):
+        matcher = WalletMatcher(os.urandom(25) for _ in range(size))
+        start = time.perf_counter()
+        list(matcher.scan(filters[:sample]))
+        elapsed = time.perf_counter() - start
+        print('wallet of {:>6} scripts: {:10.1f} filters/s'.format(size, sample / elapsed))
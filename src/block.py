@@ -1,9 +1,19 @@
+import hashlib
+
+from io import BytesIO
+
 from .helper import (
     bits_to_target,
     hash256,
     int_to_little_endian,
     little_endian_to_int,
+    read_varint_at,
 )
+from .merkle import (
+    merkle_root,
+    verify_branch,
+)
+from .tx import Tx
 
 GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
 TESTNET_GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18')
@@ -63,4 +73,144 @@ class Block:
     def check_pow(self):
         h256 = hash256(self.serialize())
         proof = little_endian_to_int(h256)
-        return proof < self.target()
\ No newline at end of file
+        return proof < self.target()
+    
+    def validate_merkle_root(self, tx_hashes):
+        '''Checks the header's merkle root against the block's txids (display order)'''
+        root = merkle_root([h[::-1] for h in tx_hashes])
+        return root[::-1] == self.merkle_root
+    
+    def verify_inclusion(self, tx_hash, branch, index):
+        '''Checks in O(log n) that tx_hash (display order) is committed to by this header.
+        
+        branch holds the sibling hashes in internal byte order, as returned
+        by merkle.merkle_branch.
+        '''
+        return verify_branch(tx_hash[::-1], branch, index, self.merkle_root[::-1])
+
+
+def scan_tx(raw, offset):
+    '''Walks one serialized transaction in raw without building objects.
+
+    Returns (end, segments, outputs): segments are the (start, end) byte
+    ranges that make up the non-witness serialization (the txid preimage)
+    and outputs holds (amount, script_start, script_end) per output.
+    '''
+    start = offset
+    offset += 4
+    segwit = raw[offset] == 0 and raw[offset + 1] != 0
+    if segwit:
+        offset += 2
+    body_start = offset
+    num_inputs, offset = read_varint_at(raw, offset)
+    for _ in range(num_inputs):
+        offset += 36
+        script_length, offset = read_varint_at(raw, offset)
+        offset += script_length + 4
+    num_outputs, offset = read_varint_at(raw, offset)
+    outputs = []
+    for _ in range(num_outputs):
+        amount = little_endian_to_int(raw[offset:offset + 8])
+        script_length, script_start = read_varint_at(raw, offset + 8)
+        offset = script_start + script_length
+        outputs.append((amount, script_start, offset))
+    body_end = offset
+    if segwit:
+        for _ in range(num_inputs):
+            num_items, offset = read_varint_at(raw, offset)
+            for _ in range(num_items):
+                item_length, offset = read_varint_at(raw, offset)
+                offset += item_length
+        segments = ((start, start + 4), (body_start, body_end), (offset, offset + 4))
+    else:
+        segments = ((start, offset + 4),)
+    end = offset + 4
+    if end > len(raw):
+        raise SyntaxError('transaction runs past the end of the block')
+    return end, segments, outputs
+
+
+class FullBlock:
+    '''A whole block kept as its raw buffer.
+
+    The header is parsed immediately; transactions are only parsed when
+    iterated, one at a time, so scanning a large block never holds every
+    Tx object at once.
+    '''
+
+    command = b'block'
+
+    def __init__(self, raw, testnet=False):
+        self.raw = memoryview(raw)
+        self.testnet = testnet
+        self.header = Block.parse(BytesIO(self.raw[:80]))
+        self.tx_count, self.tx_offset = read_varint_at(self.raw, 80)
+
+    def __repr__(self):
+        return 'FullBlock({}, txs={}, bytes={})'.format(
+            self.hash().hex(), self.tx_count, len(self.raw))
+
+    @classmethod
+    def parse(cls, s, testnet=False):
+        return cls(s.read(), testnet=testnet)
+
+    def serialize(self):
+        return bytes(self.raw)
+
+    def hash(self):
+        return self.header.hash()
+
+    def tx_layouts(self):
+        '''Yields scan_tx results for every transaction, in block order'''
+        offset = self.tx_offset
+        for _ in range(self.tx_count):
+            layout = scan_tx(self.raw, offset)
+            yield layout
+            offset = layout[0]
+
+    def tx_hashes(self):
+        '''Yields txids (display order) by hashing byte ranges, without parsing'''
+        raw = self.raw
+        for _, segments, _ in self.tx_layouts():
+            sha = hashlib.sha256()
+            for start, end in segments:
+                sha.update(raw[start:end])
+            yield hashlib.sha256(sha.digest()).digest()[::-1]
+
+    def txids(self):
+        for tx_hash in self.tx_hashes():
+            yield tx_hash.hex()
+
+    def txs(self):
+        '''Yields Tx objects parsed on demand (witness data is skipped)'''
+        raw = self.raw
+        for _, segments, _ in self.tx_layouts():
+            stripped = b''.join(raw[start:end] for start, end in segments)
+            yield Tx.parse(BytesIO(stripped), testnet=self.testnet)
+
+    def find_outputs(self, script_pubkeys):
+        '''Yields (tx_hash, index, amount, script_pubkey) paying any of script_pubkeys.
+
+        script_pubkeys are raw scripts (Script.raw_serialize()); outputs are
+        compared as byte ranges, so no Tx or Script objects are built.
+        '''
+        wanted = set(bytes(s) for s in script_pubkeys)
+        lengths = set(len(s) for s in wanted)
+        raw = self.raw
+        for _, segments, outputs in self.tx_layouts():
+            tx_hash = None
+            for index, (amount, start, end) in enumerate(outputs):
+                if end - start not in lengths:
+                    continue
+                script = bytes(raw[start:end])
+                if script not in wanted:
+                    continue
+                if tx_hash is None:
+                    sha = hashlib.sha256()
+                    for seg_start, seg_end in segments:
+                        sha.update(raw[seg_start:seg_end])
+                    tx_hash = hashlib.sha256(sha.digest()).digest()[::-1]
+                yield tx_hash, index, amount, script
+
+    def validate_merkle_root(self):
+        return self.header.validate_merkle_root(list(self.tx_hashes()))
@@ -0,0 +1,107 @@
+import math
+
+from random import randint
+
+from .network import FilterLoadMessage
+
+BIP37_CONSTANT = 0xfba4c795
+MAX_BLOOM_FILTER_SIZE = 36000
+MAX_HASH_FUNCS = 50
+
+# nFlags values of a filterload message
+BLOOM_UPDATE_NONE = 0
+BLOOM_UPDATE_ALL = 1
+BLOOM_UPDATE_P2PUBKEY_ONLY = 2
+
+
+def murmur3(data, seed=0):
+    '''32-bit MurmurHash3 (x86 variant) as used by BIP37'''
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    length = len(data)
+    h1 = seed & 0xffffffff
+    rounded_end = length & 0xfffffffc
+    for i in range(0, rounded_end, 4):
+        k1 = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
+        k1 = (k1 * c1) & 0xffffffff
+        k1 = ((k1 << 15) | (k1 >> 17)) & 0xffffffff
+        k1 = (k1 * c2) & 0xffffffff
+        h1 ^= k1
+        h1 = ((h1 << 13) | (h1 >> 19)) & 0xffffffff
+        h1 = (h1 * 5 + 0xe6546b64) & 0xffffffff
+    k1 = 0
+    val = length & 0x03
+    if val == 3:
+        k1 = data[rounded_end + 2] << 16
+    if val >= 2:
+        k1 |= data[rounded_end + 1] << 8
+    if val >= 1:
+        k1 |= data[rounded_end]
+        k1 = (k1 * c1) & 0xffffffff
+        k1 = ((k1 << 15) | (k1 >> 17)) & 0xffffffff
+        k1 = (k1 * c2) & 0xffffffff
+        h1 ^= k1
+    h1 ^= length
+    h1 ^= h1 >> 16
+    h1 = (h1 * 0x85ebca6b) & 0xffffffff
+    h1 ^= h1 >> 13
+    h1 = (h1 * 0xc2b2ae35) & 0xffffffff
+    h1 ^= h1 >> 16
+    return h1
+
+
+class BloomFilter:
+    '''A BIP37 bloom filter'''
+
+    def __init__(self, size, function_count, tweak):
+        self.size = size
+        self.bit_field = bytearray(size)
+        self.function_count = function_count
+        self.tweak = tweak
+
+    def __repr__(self):
+        return 'BloomFilter(size={}, function_count={})'.format(
+            self.size, self.function_count)
+
+    @classmethod
+    def from_fp_rate(cls, elements, fp_rate, tweak=None):
+        '''Sizes a filter for the expected number of elements and false-positive rate'''
+        elements = max(elements, 1)
+        size = int(-1 / math.log(2) ** 2 * elements * math.log(fp_rate) / 8)
+        size = max(1, min(size, MAX_BLOOM_FILTER_SIZE))
+        function_count = int(size * 8 / elements * math.log(2))
+        function_count = max(1, min(function_count, MAX_HASH_FUNCS))
+        if tweak is None:
+            tweak = randint(0, 0xffffffff)
+        return cls(size, function_count, tweak)
+
+    def _bits(self, item):
+        bit_count = self.size * 8
+        for i in range(self.function_count):
+            seed = i * BIP37_CONSTANT + self.tweak
+            yield murmur3(item, seed=seed) % bit_count
+
+    def add(self, item):
+        for bit in self._bits(item):
+            self.bit_field[bit // 8] |= 1 << (bit % 8)
+
+    def contains(self, item):
+        for bit in self._bits(item):
+            if not self.bit_field[bit // 8] & (1 << (bit % 8)):
+                return False
+        return True
+
+    def __contains__(self, item):
+        return self.contains(item)
+
+    def filter_bytes(self):
+        return bytes(self.bit_field)
+
+    def filterload(self, flag=BLOOM_UPDATE_ALL):
+        return FilterLoadMessage(self.filter_bytes(), self.function_count, self.tweak, flag)
+
+    @classmethod
+    def from_filterload(cls, message):
+        bloom = cls(len(message.filter_bytes), message.function_count, message.tweak)
+        bloom.bit_field = bytearray(message.filter_bytes)
+        return bloom
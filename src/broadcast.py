@@ -0,0 +1,209 @@
+import threading
+import time
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .httpclient import default_client
+from .network import (
+    TX_DATA_TYPE,
+    GetDataMessage,
+    InvMessage,
+)
+from .pool import CONNECTION_ERRORS
+
+BLOCKSTREAM_TESTNET_URL = 'https://blockstream.info/testnet/api'
+HTTP_ROUTE = 'http'
+# latencies kept per route for route_stats
+LATENCY_HISTORY = 100
+
+
+class BroadcastTimeout(Exception):
+    '''A peer did not ask for the announced transaction in time'''
+
+
+class BroadcastResult:
+    '''Outcome of one racing broadcast.
+
+    broadcast() hands this back as soon as one route accepts the
+    transaction; lagging routes keep retrying in the background and fill
+    in latencies and errors as they settle. wait() blocks until all have.
+    '''
+
+    def __init__(self, tx_id, routes):
+        self.tx_id = tx_id
+        self.routes = list(routes)
+        self.winner = None
+        self.latencies = {}
+        self.errors = {}
+        self.attempts = {route: 0 for route in self.routes}
+        self._lock = threading.Lock()
+        self._first = threading.Event()
+        self._settled = threading.Event()
+
+    def __repr__(self):
+        return 'BroadcastResult({}, winner={}, accepted by {}/{} routes)'.format(
+            self.tx_id, self.winner, len(self.latencies), len(self.routes))
+
+    @property
+    def accepted(self):
+        return self.winner is not None
+
+    def _record(self, route, latency=None, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies[route] = latency
+                if self.winner is None:
+                    self.winner = route
+            else:
+                self.errors[route] = error
+            if self.winner is not None:
+                self._first.set()
+            if len(self.latencies) + len(self.errors) == len(self.routes):
+                self._first.set()
+                self._settled.set()
+
+    def wait(self, timeout=None):
+        '''Waits for every route to accept or give up; True if all settled'''
+        return self._settled.wait(timeout)
+
+
+class BroadcastManager:
+    '''Races a transaction across P2P peers and the HTTP endpoint.
+
+    Each of the first peers slots of a ConnectionPool gets an inv for the
+    transaction and the transaction itself once it asks with getdata;
+    the HTTP route POSTs the raw hex to url + '/tx'. A route that fails is
+    retried with exponential backoff, up to retries times.
+    '''
+
+    def __init__(self, pool=None, url=BLOCKSTREAM_TESTNET_URL, peers=None,
+                 timeout=10, retries=2, backoff=0.5, client=None):
+        self.pool = pool
+        self.url = url
+        self.client = client or default_client()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.peer_slots = []
+        if pool is not None:
+            if peers is None:
+                peers = len(pool.connections)
+            self.peer_slots = list(range(min(peers, len(pool.connections))))
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_HISTORY))
+        routes = len(self.peer_slots) + (url is not None)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, 4 * routes))
+
+    def routes(self):
+        '''(name, send function) for every route a broadcast races'''
+        routes = []
+        for index in self.peer_slots:
+            connection = self.pool.connections[index]
+            name = 'p2p:{}:{}'.format(connection.host, connection.port)
+            routes.append((name, lambda tx, index=index: self.send_p2p(index, tx)))
+        if self.url is not None:
+            routes.append((HTTP_ROUTE, self.send_http))
+        return routes
+
+    def broadcast(self, tx, timeout=None):
+        '''Sends tx on every route, returning once the first accepts it.
+
+        If no route accepts within timeout (default self.timeout times the
+        number of attempts), the result comes back with winner None.
+        '''
+        routes = self.routes()
+        if not routes:
+            raise ValueError('no broadcast routes configured')
+        result = BroadcastResult(tx.id(), [name for name, _ in routes])
+        for name, send in routes:
+            self.executor.submit(self._run, result, name, send, tx)
+        if timeout is None:
+            timeout = self.timeout * (self.retries + 1)
+        result._first.wait(timeout)
+        return result
+
+    def _run(self, result, route, send, tx):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            result.attempts[route] += 1
+            start = time.perf_counter()
+            try:
+                send(tx)
+            except (BroadcastTimeout, requests.RequestException) + CONNECTION_ERRORS as e:
+                error = e
+                continue
+            latency = time.perf_counter() - start
+            self.latencies[route].append(latency)
+            result._record(route, latency=latency)
+            return
+        result._record(route, error=error)
+
+    def send_p2p(self, index, tx):
+        '''Announces tx to pool slot index and sends it when the peer asks'''
+        tx_hash = tx.hash()
+        deadline = time.monotonic() + self.timeout
+        with self.pool.session(index) as node:
+            node.send(InvMessage().add_data(TX_DATA_TYPE, tx_hash))
+            while True:
+                try:
+                    # a quiet peer is not a broken connection: keep it pooled
+                    getdata = node.wait_for(GetDataMessage, timeout=max(0, deadline - time.monotonic()))
+                except TimeoutError:
+                    raise BroadcastTimeout('peer did not request {}'.format(tx.id()))
+                if (TX_DATA_TYPE, tx_hash) in getdata.data:
+                    node.send(tx)
+                    return
+
+    def send_http(self, tx):
+        # this manager does its own retrying, racing the other routes
+        response = self.client.post(
+            self.url + '/tx', data=tx.serialize().hex(), retries=0,
+            headers={'Content-Type': 'text/plain'}, timeout=self.timeout)
+        response.raise_for_status()
+
+    def route_stats(self):
+        '''Median and worst recent latency per route, in seconds'''
+        stats = {}
+        for route, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            stats[route] = {
+                'count': len(ordered),
+                'median': ordered[len(ordered) // 2],
+                'max': ordered[-1],
+            }
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+# Race against local stand-ins: python -m src.broadcast
+if __name__ == "__main__":
+    from .pool import ConnectionPool
+    from .script import p2pkh_script
+    from .standin import StandInHTTPServer, StandInPeer
+    from .tx import Tx, TxIn, TxOut
+
+    peers = [StandInPeer(testnet=True, latency=latency).start() for latency in (0.002, 0.02, 0.2)]
+    http = StandInHTTPServer(latency=0.05).start()
+    pool = ConnectionPool([(p.host, p.port) for p in peers], testnet=True)
+    manager = BroadcastManager(pool, url=http.url)
+    for i in range(20):
+        tx = Tx(1, [TxIn(i.to_bytes(32, 'big'), 0)], [TxOut(1000, p2pkh_script(b'\x00' * 20))], 0, testnet=True)
+        start = time.perf_counter()
+        result = manager.broadcast(tx)
+        elapsed = time.perf_counter() - start
+        result.wait()
+    print('last broadcast returned after {:.1f} ms via {}'.format(elapsed * 1000, result.winner))
+    for route, stats in sorted(manager.route_stats().items()):
+        print('{:<22} median {:7.1f} ms  max {:7.1f} ms  ({} accepted)'.format(
+            route, stats['median'] * 1000, stats['max'] * 1000, stats['count']))
+    manager.close()
+    pool.close()
+    http.stop()
+    for peer in peers:
+        peer.stop()
@@ -0,0 +1,181 @@
+from io import BytesIO
+
+from .block import Block
+from .headerstore import header_work
+
+CONNECT = 'connect'
+DISCONNECT = 'disconnect'
+
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+
+def skip_height(height):
+    '''Height of the skip pointer target, as chosen by Bitcoin Core.
+
+    Skipping to these heights makes ancestor lookups O(log n).
+    '''
+    if height < 2:
+        return 0
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+
+class BlockNode:
+    '''Compact in-memory entry for one header of the block tree'''
+
+    __slots__ = ('hash', 'prev', 'skip', 'height', 'chainwork', 'timestamp', 'bits')
+
+    def __init__(self, block_hash, prev, height, chainwork, timestamp, bits):
+        self.hash = block_hash
+        self.prev = prev
+        self.height = height
+        self.chainwork = chainwork
+        self.timestamp = timestamp
+        self.bits = bits
+        self.skip = prev.ancestor(skip_height(height)) if prev is not None else None
+
+    def __repr__(self):
+        return 'BlockNode({}, height={})'.format(self.hash.hex(), self.height)
+
+    def ancestor(self, height):
+        '''Returns the ancestor of this node at height, in O(log n) steps'''
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        walk_height = self.height
+        while walk_height > height:
+            skip = skip_height(walk_height)
+            skip_prev = skip_height(walk_height - 1)
+            if walk.skip is not None and (
+                    skip == height
+                    or (skip > height and not (skip_prev < skip - 2 and skip_prev >= height))):
+                walk = walk.skip
+                walk_height = skip
+            else:
+                walk = walk.prev
+                walk_height -= 1
+        return walk
+
+
+class BlockIndex:
+    '''Tree of known headers with the most-work chain as the active tip.
+
+    Subscribers are called as callback(event, node) with event CONNECT or
+    DISCONNECT whenever the active chain changes, disconnects first (tip
+    downwards) and then connects (fork upwards), so wallet state can
+    follow reorganisations.
+    '''
+
+    def __init__(self, genesis=None):
+        self.nodes = {}
+        self.tip = None
+        self.subscribers = []
+        if genesis is not None:
+            self.add_header(genesis)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def __getitem__(self, block_hash):
+        return self.nodes[block_hash]
+
+    @classmethod
+    def from_store(cls, store):
+        '''Builds the index from every header in a HeaderStore'''
+        index = cls()
+        for height in range(len(store)):
+            index.add_header(bytes(store.raw(height)), notify=False)
+        return index
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def add_header(self, header, notify=True):
+        '''Adds a Block or raw 80-byte header; returns the list of (event, node)'''
+        if not isinstance(header, Block):
+            header = Block.parse(BytesIO(header))
+        block_hash = header.hash()
+        if block_hash in self.nodes:
+            return []
+        if self.nodes:
+            prev = self.nodes.get(header.prev_block)
+            if prev is None:
+                raise RuntimeError('unknown previous block {}'.format(header.prev_block.hex()))
+            height = prev.height + 1
+            chainwork = prev.chainwork + header_work(header.bits)
+        else:
+            prev = None
+            height = 0
+            chainwork = header_work(header.bits)
+        node = BlockNode(block_hash, prev, height, chainwork, header.timestamp, header.bits)
+        self.nodes[block_hash] = node
+        if self.tip is not None and node.chainwork <= self.tip.chainwork:
+            return []
+        events = self._set_tip(node)
+        if notify:
+            for event, changed in events:
+                for callback in self.subscribers:
+                    callback(event, changed)
+        return events
+
+    def _set_tip(self, node):
+        events = []
+        if self.tip is None:
+            self.tip = node
+            return [(CONNECT, node)]
+        fork = self.find_fork(self.tip, node)
+        walk = self.tip
+        while walk is not fork:
+            events.append((DISCONNECT, walk))
+            walk = walk.prev
+        connects = []
+        walk = node
+        while walk is not fork:
+            connects.append((CONNECT, walk))
+            walk = walk.prev
+        events.extend(reversed(connects))
+        self.tip = node
+        return events
+
+    def find_fork(self, a, b):
+        '''Returns the last common ancestor of two nodes'''
+        if a.height > b.height:
+            a = a.ancestor(b.height)
+        elif b.height > a.height:
+            b = b.ancestor(a.height)
+        while a is not b:
+            a = a.prev
+            b = b.prev
+        return a
+
+    def ancestor(self, height):
+        '''The node at height on the active chain'''
+        if self.tip is None:
+            return None
+        return self.tip.ancestor(height)
+
+    def contains(self, node):
+        '''Whether node is on the active chain'''
+        return self.tip is not None and self.tip.ancestor(node.height) is node
+
+    def locator(self, node=None):
+        '''Block locator hashes: the last 10 blocks, then exponentially spaced back to genesis'''
+        if node is None:
+            node = self.tip
+        hashes = []
+        step = 1
+        while node is not None:
+            hashes.append(node.hash)
+            if node.height == 0:
+                break
+            height = max(node.height - step, 0)
+            node = node.ancestor(height)
+            if len(hashes) > 10:
+                step *= 2
+        return hashes
@@ -0,0 +1,189 @@
+import json
+import os
+
+from array import array
+from collections import deque
+
+from .block import Block
+
+DEFINED = 'DEFINED'
+STARTED = 'STARTED'
+LOCKED_IN = 'LOCKED_IN'
+ACTIVE = 'ACTIVE'
+FAILED = 'FAILED'
+
+PERIOD = 2016
+MAINNET_THRESHOLD = 1916
+TESTNET_THRESHOLD = 1512
+VERSION_BITS = 29
+MEDIAN_TIME_SPAN = 11
+STATE_FILE = 'deployments.json'
+
+
+class Deployment:
+    '''A BIP9 soft fork deployment: signalling bit and start/timeout times'''
+
+    def __init__(self, name, bit, start_time, timeout):
+        self.name = name
+        self.bit = bit
+        self.start_time = start_time
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'Deployment({}, bit={})'.format(self.name, self.bit)
+
+
+MAINNET_DEPLOYMENTS = [
+    Deployment('csv', 0, 1462060800, 1493596800),
+    Deployment('segwit', 1, 1479168000, 1510704000),
+]
+TESTNET_DEPLOYMENTS = [
+    Deployment('csv', 0, 1456790400, 1493596800),
+    Deployment('segwit', 1, 1462060800, 1493596800),
+]
+
+
+def signalled_bits(version):
+    '''Yields the version bits a BIP9 header signals'''
+    if version >> 29 != 0b001:
+        return
+    version &= (1 << VERSION_BITS) - 1
+    while version:
+        low = version & -version
+        yield low.bit_length() - 1
+        version ^= low
+
+
+class DeploymentTracker:
+    '''Incremental BIP9 state machine fed one header at a time.
+
+    Keeps per-bit counters for the current retarget period and for a
+    rolling window of the last PERIOD headers, so every new header costs
+    O(1) regardless of chain length. States are re-evaluated at each
+    period boundary from the median time past of the period's last block.
+    '''
+
+    def __init__(self, deployments, threshold=MAINNET_THRESHOLD, path=None):
+        self.deployments = deployments
+        self.threshold = threshold
+        self.path = path
+        self.height = -1
+        self.window = array('I', [0] * PERIOD)
+        self.window_counts = [0] * VERSION_BITS
+        self.period_counts = [0] * VERSION_BITS
+        self.timestamps = deque(maxlen=MEDIAN_TIME_SPAN)
+        self.states = {d.name: DEFINED for d in deployments}
+        self.since = {d.name: 0 for d in deployments}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def for_store(cls, store, deployments, threshold=MAINNET_THRESHOLD):
+        '''Tracker persisted next to a HeaderStore, caught up to its tip'''
+        tracker = cls(deployments, threshold, os.path.join(store.path, STATE_FILE))
+        tracker.catch_up(store)
+        return tracker
+
+    def catch_up(self, store):
+        '''Feeds any headers the store has beyond the tracker's height'''
+        if self.height + 1 < len(store):
+            self.feed(store.raw(h) for h in range(self.height + 1, len(store)))
+            self.save()
+
+    def add_header(self, version, timestamp):
+        self.height += 1
+        slot = self.height % PERIOD
+        if self.height >= PERIOD:
+            for bit in signalled_bits(self.window[slot]):
+                self.window_counts[bit] -= 1
+        self.window[slot] = version
+        for bit in signalled_bits(version):
+            self.window_counts[bit] += 1
+            self.period_counts[bit] += 1
+        self.timestamps.append(timestamp)
+        if slot == PERIOD - 1:
+            self._end_period()
+
+    def feed(self, headers):
+        '''Adds Blocks or raw 80-byte headers in chain order'''
+        for header in headers:
+            if isinstance(header, Block):
+                self.add_header(header.version, header.timestamp)
+            else:
+                self.add_header(int.from_bytes(header[0:4], 'little'),
+                                int.from_bytes(header[68:72], 'little'))
+
+    def feed_batch(self, batch):
+        '''Adds every header of a HeaderBatch'''
+        for version, timestamp in zip(batch.version.tolist(), batch.timestamp.tolist()):
+            self.add_header(version, timestamp)
+
+    def median_time_past(self):
+        times = sorted(self.timestamps)
+        return times[len(times) // 2] if times else 0
+
+    def _end_period(self):
+        mtp = self.median_time_past()
+        next_height = self.height + 1
+        for deployment in self.deployments:
+            state = self.states[deployment.name]
+            if state == DEFINED:
+                if mtp >= deployment.timeout:
+                    state = FAILED
+                elif mtp >= deployment.start_time:
+                    state = STARTED
+            elif state == STARTED:
+                if self.period_counts[deployment.bit] >= self.threshold:
+                    state = LOCKED_IN
+                elif mtp >= deployment.timeout:
+                    state = FAILED
+            elif state == LOCKED_IN:
+                state = ACTIVE
+            if state != self.states[deployment.name]:
+                self.states[deployment.name] = state
+                self.since[deployment.name] = next_height
+        self.period_counts = [0] * VERSION_BITS
+
+    def state(self, name):
+        return self.states[name]
+
+    def fraction(self, bit):
+        '''Share of the last PERIOD headers (or fewer, early on) signalling bit'''
+        filled = min(self.height + 1, PERIOD)
+        if filled == 0:
+            return 0.0
+        return self.window_counts[bit] / filled
+
+    def period_count(self, bit):
+        '''Headers signalling bit so far in the current retarget period'''
+        return self.period_counts[bit]
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            'height': self.height,
+            'window': self.window.tobytes().hex(),
+            'window_counts': self.window_counts,
+            'period_counts': self.period_counts,
+            'timestamps': list(self.timestamps),
+            'states': self.states,
+            'since': self.since,
+        }
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self.height = data['height']
+        self.window = array('I')
+        self.window.frombytes(bytes.fromhex(data['window']))
+        self.window_counts = data['window_counts']
+        self.period_counts = data['period_counts']
+        self.timestamps = deque(data['timestamps'], maxlen=MEDIAN_TIME_SPAN)
+        for name in self.states:
+            if name in data['states']:
+                self.states[name] = data['states'][name]
+                self.since[name] = data['since'][name]
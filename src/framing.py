@@ -0,0 +1,171 @@
+import select
+
+from .helper import hash256
+from .network import (
+    NETWORK_MAGIC,
+    TESTNET_NETWORK_MAGIC,
+    NetworkEnvelope,
+    SimpleNode,
+)
+
+HEADER_SIZE = 24
+# refuse anything bigger than Bitcoin Core's MAX_SIZE (32 MiB)
+MAX_PAYLOAD_SIZE = 0x02000000
+
+
+class PayloadStream:
+    '''Read-only stream over a payload memoryview.
+
+    Sized reads return small bytes objects like BytesIO would; read() with
+    no size returns the rest as a view, so FullBlock and friends take the
+    payload without copying it.
+    '''
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            self.position = len(self.view)
+            return self.view[start:]
+        self.position = min(start + size, len(self.view))
+        return bytes(self.view[start:self.position])
+
+
+class FramedEnvelope(NetworkEnvelope):
+    '''A NetworkEnvelope whose payload is a view into a FrameReader buffer'''
+
+    def stream(self):
+        return PayloadStream(self.payload)
+
+
+class FrameReader:
+    '''Splits NetworkEnvelopes out of a socket with recv_into.
+
+    Bytes land in one reusable bytearray that only grows when a message
+    does not fit; each envelope is sliced from a memoryview of it and its
+    checksum verified over that view, so the payload is never copied.
+    The payload view is only valid until the next read(): copy it with
+    bytes() to keep it longer.
+    '''
+
+    def __init__(self, sock, testnet=False, size=1 << 16):
+        self.sock = sock
+        self.testnet = testnet
+        self.magic = TESTNET_NETWORK_MAGIC if testnet else NETWORK_MAGIC
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.bytes_read = 0
+
+    def _make_room(self, needed):
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            # a fresh buffer, so views handed out earlier never see a resize
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:pending] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = pending
+
+    def _fill(self, needed):
+        '''Receives until at least needed bytes are buffered past start'''
+        while self.end - self.start < needed:
+            if self.start + needed > len(self.buffer):
+                self._make_room(needed)
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:
+                raise RuntimeError('Connection reset!')
+            self.end += received
+            self.bytes_read += received
+
+    def read(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        self._fill(HEADER_SIZE)
+        header = self.view[self.start:self.start + HEADER_SIZE]
+        if header[:4] != self.magic:
+            raise RuntimeError('magic is not right {} vs {}'.format(
+                header[:4].hex(), self.magic.hex()))
+        command = bytes(header[4:16]).strip(b'\x00')
+        payload_length = int.from_bytes(header[16:20], 'little')
+        checksum = bytes(header[20:24])
+        if payload_length > MAX_PAYLOAD_SIZE:
+            raise RuntimeError('payload too large: {} bytes'.format(payload_length))
+        self._fill(HEADER_SIZE + payload_length)
+        start = self.start + HEADER_SIZE
+        payload = self.view[start:start + payload_length]
+        if hash256(payload)[:4] != checksum:
+            raise RuntimeError('checksum does not match')
+        self.start = start + payload_length
+        return FramedEnvelope(command, payload, testnet=self.testnet)
+
+
+class FramedNode(SimpleNode):
+    '''SimpleNode that reads through a FrameReader instead of makefile.
+
+    Messages returned by wait_for may reference the receive buffer
+    (FullBlock keeps its payload view), so use them before reading again.
+    '''
+
+    def __init__(self, host, port=None, testnet=False, logging=True, timeout=None):
+        super().__init__(host, port=port, testnet=testnet, logging=logging, timeout=timeout)
+        self.frames = FrameReader(self.socket, testnet=testnet)
+
+    def wait_readable(self, timeout):
+        if self.frames.end == self.frames.start:
+            if not select.select([self.socket], [], [], max(0, timeout))[0]:
+                raise TimeoutError('nothing received within {:.3f}s'.format(timeout))
+
+    def read(self):
+        envelope = self.frames.read()
+        if self.logging:
+            print('receiving: {} ({} bytes)'.format(envelope.command.decode('ascii'), len(envelope.payload)))
+        return envelope
+
+
+# Benchmark on a local socket pair: python -m src.framing
+if __name__ == "__main__":
+    import socket
+    import threading
+    import time
+
+    from os import urandom
+
+    def pump(sock, data, repeat):
+        for _ in range(repeat):
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    def measure(payload_size, repeat, framed):
+        envelope = NetworkEnvelope(b'block', urandom(payload_size)).serialize()
+        reader, writer = socket.socketpair()
+        thread = threading.Thread(target=pump, args=(writer, envelope, repeat))
+        start = time.perf_counter()
+        thread.start()
+        if framed:
+            frames = FrameReader(reader)
+            for _ in range(repeat):
+                frames.read()
+        else:
+            stream = reader.makefile('rb', None)
+            for _ in range(repeat):
+                NetworkEnvelope.parse(stream)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        reader.close()
+        writer.close()
+        return len(envelope) * repeat / elapsed / 1e6
+
+    for label, size, repeat in (('ping', 8, 50000), ('headers', 2000 * 81 + 3, 2000),
+                                ('1MB block', 1000000, 300), ('4MB block', 4000000, 80)):
+        old = measure(size, repeat, framed=False)
+        new = measure(size, repeat, framed=True)
+        print('{:<10} makefile {:8.1f} MB/s   recv_into {:8.1f} MB/s   ({:.2f}x)'.format(
+            label, old, new, new / old))
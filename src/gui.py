@@ -1,7 +1,6 @@
 def launch_gui():
     import tkinter as tk
     from .faucet import open_faucet_page
-    from .utxo import UTXOFetcher
     from tkinter import messagebox
     from .wallet import Wallet
     from .tx_manager import Portfolio
@@ -14,7 +13,7 @@ def launch_gui():
             
             # Initialize wallet and portfolio objects
             self.wallet = Wallet()  
-            self.portfolio = Portfolio(node_address='testnet.programmingbitcoin.com')
+            self.portfolio = Portfolio()
             
             # UI components for Bitcoin Portfolio
             self.label = tk.Label(master, text="Bitcoin Portfolio")
@@ -73,6 +72,14 @@ def launch_gui():
             self.qr_label = tk.Label(master)
             self.qr_label.pack()
             
+            # Release the portfolio's connections and stores with the window
+            master.protocol("WM_DELETE_WINDOW", self.close)
+
+        def close(self):
+            try:
+                self.portfolio.close()
+            finally:
+                self.master.destroy()
 
         def create_transaction(self):
             # Collect user input to create a new transaction
@@ -109,8 +116,7 @@ def launch_gui():
         def check_balance(self):
             # Fetch and display the current balance of the wallet
             address = self.wallet.address
-            utxos = UTXOFetcher.fetch_utxos(address, testnet=True)
-            total = sum(utxo['value'] for utxo in utxos)
+            total = self.portfolio.balance(address)
             self.result_label.config(text=f"Current Balance: {total} satoshis")
             
     # Start the Tkinter main loop
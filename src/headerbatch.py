@@ -0,0 +1,223 @@
+import hashlib
+
+from io import BytesIO
+
+import numpy as np
+
+from .block import Block
+from .helper import (
+    MAX_TARGET,
+    read_varint_at,
+)
+
+HEADER_SIZE = 80
+MEDIAN_TIME_SPAN = 11
+
+
+def header_dtype(stride=HEADER_SIZE):
+    '''Structured dtype over raw headers laid out every stride bytes'''
+    return np.dtype({
+        'names': ['version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce'],
+        'formats': ['<u4', ('u1', (32,)), ('u1', (32,)), '<u4', '<u4', '<u4'],
+        'offsets': [0, 4, 36, 68, 72, 76],
+        'itemsize': stride,
+    })
+
+
+HEADER_DTYPE = header_dtype()
+# a headers message follows every header with a zero transaction count
+HEADERS_MESSAGE_DTYPE = header_dtype(HEADER_SIZE + 1)
+
+
+class HeaderBatch:
+    '''A batch of block headers viewed in place as a NumPy structured array.
+
+    Fields are read straight out of the payload or file without copying;
+    Block objects are only built by block()/blocks().
+
+    Note that prev_block and merkle_root are in internal byte order here,
+    the reverse of the Block attributes.
+    '''
+
+    def __init__(self, buffer, count, offset=0, stride=HEADER_SIZE):
+        self.buffer = buffer
+        self.headers = np.frombuffer(buffer, header_dtype(stride), count, offset)
+        raw = np.frombuffer(buffer, np.uint8, count * stride, offset)
+        self.raw = raw.reshape(count, stride)[:, :HEADER_SIZE]
+        self._hashes = None
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __repr__(self):
+        return 'HeaderBatch({} headers)'.format(len(self))
+
+    @classmethod
+    def from_payload(cls, payload):
+        '''Views the payload of a headers message'''
+        count, offset = read_varint_at(payload, 0)
+        if len(payload) != offset + count * (HEADER_SIZE + 1):
+            raise RuntimeError('headers payload has the wrong length')
+        batch = cls(payload, count, offset, HEADER_SIZE + 1)
+        tx_counts = np.frombuffer(payload, np.uint8, count * (HEADER_SIZE + 1), offset)
+        if tx_counts.reshape(count, HEADER_SIZE + 1)[:, HEADER_SIZE].any():
+            raise RuntimeError('number of txs not 0')
+        return batch
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        '''Views back-to-back 80-byte headers, e.g. HeaderStore.raw_range()'''
+        return cls(buffer, len(buffer) // HEADER_SIZE)
+
+    @classmethod
+    def from_file(cls, path):
+        '''Memory-maps a file of back-to-back headers, e.g. headers.dat'''
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        return cls(buffer, len(buffer) // HEADER_SIZE)
+
+    @property
+    def version(self):
+        return self.headers['version']
+
+    @property
+    def timestamp(self):
+        return self.headers['timestamp']
+
+    @property
+    def bits(self):
+        return self.headers['bits']
+
+    def block(self, i):
+        return Block.parse(BytesIO(self.raw[i].tobytes()))
+
+    def blocks(self):
+        for i in range(len(self)):
+            yield self.block(i)
+
+    def hashes(self):
+        '''(n, 32) array of block hashes in internal byte order'''
+        if self._hashes is None:
+            sha256 = hashlib.sha256
+            digests = b''.join(sha256(sha256(row).digest()).digest() for row in self.raw)
+            self._hashes = np.frombuffer(digests, np.uint8).reshape(len(self), 32)
+        return self._hashes
+
+    def exponents(self):
+        return (self.bits >> 24).astype(np.int64)
+
+    def coefficients(self):
+        return (self.bits & 0xffffff).astype(np.int64)
+
+    def targets(self):
+        '''Targets as floats; exact enough for difficulty, not for PoW checks'''
+        return self.coefficients() * np.power(256.0, self.exponents() - 3)
+
+    def difficulty(self):
+        return float(MAX_TARGET) / self.targets()
+
+    def target_bytes(self):
+        '''(n, 32) array of exact targets, big-endian'''
+        count = len(self)
+        targets = np.zeros((count, 32), np.uint8)
+        exponents = self.exponents()
+        coefficients = self.coefficients()
+        rows = np.arange(count)
+        for shift, byte in ((16, 0), (8, 1), (0, 2)):
+            position = 32 - exponents + byte
+            ok = (position >= 0) & (position < 32)
+            targets[rows[ok], position[ok]] = (coefficients[ok] >> shift) & 0xff
+        return targets
+
+    def check_pow(self):
+        '''Boolean array: hash < target for every header'''
+        proofs = self.hashes()[:, ::-1]
+        targets = self.target_bytes()
+        differ = proofs != targets
+        first = differ.argmax(axis=1)
+        rows = np.arange(len(self))
+        return differ.any(axis=1) & (proofs[rows, first] < targets[rows, first])
+
+    def check_linkage(self, prev_hash=None):
+        '''Boolean array: each header's prev_block is the hash of the one before.
+
+        prev_hash is the hash (display order) the first header should
+        build on; without it the first header is assumed to link.
+        '''
+        linked = np.ones(len(self), bool)
+        if len(self) > 1:
+            hashes = self.hashes()
+            linked[1:] = (self.headers['prev_block'][1:] == hashes[:-1]).all(axis=1)
+        if prev_hash is not None and len(self):
+            expected = np.frombuffer(prev_hash[::-1], np.uint8)
+            linked[0] = (self.headers['prev_block'][0] == expected).all()
+        return linked
+
+    def median_time_past(self, prior=()):
+        '''Median of the 11 timestamps before each header.
+
+        prior holds the timestamps of the headers preceding the batch
+        (oldest first); headers with less history use what is available.
+        '''
+        prior = list(prior)[-MEDIAN_TIME_SPAN:]
+        times = np.concatenate([np.asarray(prior, np.int64), self.timestamp.astype(np.int64)])
+        offset = len(prior)
+        result = np.zeros(len(self), np.int64)
+        full = max(MEDIAN_TIME_SPAN - offset, 0)
+        for i in range(min(full, len(self))):
+            window = times[:offset + i]
+            result[i] = np.sort(window)[len(window) // 2] if len(window) else 0
+        if len(self) > full:
+            windows = np.lib.stride_tricks.sliding_window_view(times, MEDIAN_TIME_SPAN)
+            result[full:] = np.median(windows[offset + full - MEDIAN_TIME_SPAN:len(times) - MEDIAN_TIME_SPAN], axis=1)
+        return result
+
+    def check_timestamps(self, prior=()):
+        '''Boolean array: each timestamp is after its median time past'''
+        return self.timestamp.astype(np.int64) > self.median_time_past(prior)
+
+    def bip9(self):
+        return (self.version >> 29) == 0b001
+
+    def bip91(self):
+        return (self.version >> 4) & 1 == 1
+
+    def bip141(self):
+        return (self.version >> 1) & 1 == 1
+
+    def version_bit_counts(self):
+        '''Number of BIP9-style headers signalling each of the bits 0..28'''
+        versions = self.version[self.bip9()]
+        return ((versions[:, None] >> np.arange(29, dtype=np.uint32)) & 1).sum(axis=0)
+
+
+# Benchmark when run directly: python -m src.headerbatch
+if __name__ == "__main__":
+    import time
+
+    from .helper import encode_varint
+    from .standin import synthetic_chain
+
+    chain = synthetic_chain(2000)
+    payload = encode_varint(len(chain)) + b''.join(raw + b'\x00' for raw in chain)
+
+    start = time.perf_counter()
+    blocks = [Block.parse(BytesIO(raw)) for raw in chain]
+    pow_ok = all(b.check_pow() for b in blocks)
+    difficulty = [b.difficulty() for b in blocks]
+    bip9 = sum(b.bip9() for b in blocks)
+    per_object = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = HeaderBatch.from_payload(payload)
+    batch_pow = batch.check_pow()
+    batch_difficulty = batch.difficulty()
+    counts = batch.version_bit_counts()
+    linked = batch.check_linkage()
+    timestamps = batch.check_timestamps()
+    vectorised = time.perf_counter() - start
+
+    assert pow_ok and batch_pow.all() and linked.all()
+    assert np.allclose(batch_difficulty, difficulty) and counts.sum() == 0
+    assert int(batch.bip9().sum()) == bip9
+    print('Block objects: {:.1f} ms, HeaderBatch: {:.1f} ms for {} headers'.format(
+        per_object * 1000, vectorised * 1000, len(chain)))
@@ -0,0 +1,307 @@
+import json
+import mmap
+import os
+import struct
+
+from io import BytesIO
+
+from .block import Block
+from .helper import (
+    bits_to_target,
+    hash256,
+)
+
+HEADER_SIZE = 80
+HASH_SIZE = 32
+SLOT = struct.Struct('<I')
+MIN_INDEX_SLOTS = 1 << 16
+
+
+def header_work(bits):
+    '''Expected number of hashes needed for a header with these bits'''
+    return 2**256 // (bits_to_target(bits) + 1)
+
+
+class HeaderStore:
+    '''Append-only on-disk store of raw 80-byte block headers.
+
+    Files in the store directory:
+      headers.dat  raw headers, height h at offset 80 * h
+      hashes.dat   block hashes (display order), height h at offset 32 * h
+      index.dat    open-addressing hash table of uint32 (height + 1) slots
+      tip.json     tip height, hash and cumulative chainwork
+
+    All three data files are memory-mapped, so reopening a store costs a
+    few system calls and lookups read straight from the page cache.
+    tip.json is written last, so a crash mid-append leaves trailing data
+    that is truncated on the next open.
+    '''
+
+    def __init__(self, path, genesis=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._headers_file = self._open('headers.dat')
+        self._hashes_file = self._open('hashes.dat')
+        self._index_file = self._open('index.dat')
+        self._load_tip()
+        self._headers_map = None
+        self._hashes_map = None
+        self._mapped = 0
+        self._map_index()
+        if self.count == 0 and genesis is not None:
+            self.append(genesis)
+
+    def __repr__(self):
+        return 'HeaderStore({}, height={})'.format(self.path, self.height)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, block_hash):
+        return self.height_of(block_hash) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _open(self, name):
+        filename = self._file(name)
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        return open(filename, 'r+b')
+
+    def _load_tip(self):
+        try:
+            with open(self._file('tip.json')) as f:
+                tip = json.load(f)
+            self.count = tip['height'] + 1
+            self.chainwork = int(tip['chainwork'], 16)
+        except FileNotFoundError:
+            self.count = 0
+            self.chainwork = 0
+        # drop anything written after the last persisted tip
+        self._headers_file.truncate(self.count * HEADER_SIZE)
+        self._hashes_file.truncate(self.count * HASH_SIZE)
+
+    def _save_tip(self):
+        tip = {
+            'height': self.height,
+            'hash': self.tip_hash().hex() if self.count else None,
+            'chainwork': '{:x}'.format(self.chainwork),
+        }
+        filename = self._file('tip.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(tip, f)
+        os.replace(filename + '.tmp', filename)
+
+    def _map_data(self):
+        # Old maps are dropped rather than closed: memoryviews handed out
+        # by raw() keep them alive until they are released.
+        if self.count == 0:
+            self._headers_map = self._hashes_map = None
+        else:
+            self._headers_map = mmap.mmap(
+                self._headers_file.fileno(), self.count * HEADER_SIZE,
+                access=mmap.ACCESS_READ)
+            self._hashes_map = mmap.mmap(
+                self._hashes_file.fileno(), self.count * HASH_SIZE,
+                access=mmap.ACCESS_READ)
+        self._mapped = self.count
+
+    def _ensure_mapped(self):
+        if self._mapped != self.count:
+            self._map_data()
+
+    def _map_index(self):
+        size = os.fstat(self._index_file.fileno()).st_size
+        if size == 0:
+            size = MIN_INDEX_SLOTS * SLOT.size
+            self._index_file.truncate(size)
+        self._slots = size // SLOT.size
+        self._index = mmap.mmap(self._index_file.fileno(), size)
+
+    def _slot_for(self, block_hash):
+        # display-order hashes start with zeros, so use the tail bytes
+        return int.from_bytes(block_hash[24:32], 'little') & (self._slots - 1)
+
+    def _index_insert(self, block_hash, height):
+        slot = self._slot_for(block_hash)
+        mask = self._slots - 1
+        while True:
+            value = SLOT.unpack_from(self._index, slot * SLOT.size)[0]
+            if value == 0 or value - 1 >= self.count:
+                SLOT.pack_into(self._index, slot * SLOT.size, height + 1)
+                return
+            slot = (slot + 1) & mask
+
+    def _grow_index(self, count):
+        if count * 2 <= self._slots:
+            return
+        slots = self._slots
+        while count * 2 > slots:
+            slots *= 2
+        self._index.close()
+        self._index_file.truncate(0)
+        self._index_file.truncate(slots * SLOT.size)
+        self._map_index()
+        self._ensure_mapped()
+        for height in range(self.count):
+            self._index_insert(self.hash_at(height), height)
+
+    @property
+    def height(self):
+        return self.count - 1
+
+    def tip_hash(self):
+        return self.hash_at(self.height)
+
+    def raw(self, height):
+        '''Zero-copy memoryview of the 80-byte header at height'''
+        if not 0 <= height < self.count:
+            raise IndexError('no header at height {}'.format(height))
+        self._ensure_mapped()
+        start = height * HEADER_SIZE
+        return memoryview(self._headers_map)[start:start + HEADER_SIZE]
+
+    def raw_range(self, start, stop):
+        '''Zero-copy memoryview of the headers in [start, stop)'''
+        stop = min(stop, self.count)
+        self._ensure_mapped()
+        if start >= stop:
+            return memoryview(b'')
+        return memoryview(self._headers_map)[start * HEADER_SIZE:stop * HEADER_SIZE]
+
+    def header(self, height):
+        return Block.parse(BytesIO(self.raw(height)))
+
+    def hash_at(self, height):
+        if not 0 <= height < self.count:
+            raise IndexError('no header at height {}'.format(height))
+        self._ensure_mapped()
+        start = height * HASH_SIZE
+        return self._hashes_map[start:start + HASH_SIZE]
+
+    def height_of(self, block_hash):
+        '''Returns the height of block_hash (display order), or None'''
+        self._ensure_mapped()
+        slot = self._slot_for(block_hash)
+        mask = self._slots - 1
+        while True:
+            value = SLOT.unpack_from(self._index, slot * SLOT.size)[0]
+            if value == 0:
+                return None
+            height = value - 1
+            if height < self.count and self.hash_at(height) == block_hash:
+                return height
+            slot = (slot + 1) & mask
+
+    def append(self, header):
+        self.extend([header])
+
+    def extend(self, headers):
+        '''Appends headers (Block objects or raw 80 bytes) that extend the tip.
+
+        Only linkage is checked here; proof of work and retargeting are the
+        caller's job (see the header sync).
+        '''
+        raws = []
+        hashes = []
+        work = 0
+        prev = self.tip_hash() if self.count else None
+        for header in headers:
+            raw = header.serialize() if isinstance(header, Block) else bytes(header)
+            if len(raw) != HEADER_SIZE:
+                raise ValueError('header must be 80 bytes, got {}'.format(len(raw)))
+            if prev is not None and raw[4:36][::-1] != prev:
+                raise RuntimeError('header does not extend the tip: {}'.format(
+                    raw[4:36][::-1].hex()))
+            prev = hash256(raw)[::-1]
+            raws.append(raw)
+            hashes.append(prev)
+            work += header_work(raw[72:76])
+        if not raws:
+            return
+        self._grow_index(self.count + len(raws))
+        self._headers_file.seek(self.count * HEADER_SIZE)
+        self._headers_file.write(b''.join(raws))
+        self._headers_file.flush()
+        self._hashes_file.seek(self.count * HASH_SIZE)
+        self._hashes_file.write(b''.join(hashes))
+        self._hashes_file.flush()
+        start = self.count
+        self.count += len(raws)
+        for height, block_hash in enumerate(hashes, start):
+            self._index_insert(block_hash, height)
+        self._index.flush()
+        self.chainwork += work
+        self._save_tip()
+
+    def close(self):
+        for m in (self._headers_map, self._hashes_map, self._index):
+            if m is not None:
+                try:
+                    m.close()
+                except BufferError:
+                    pass
+        self._headers_file.close()
+        self._hashes_file.close()
+        self._index_file.close()
+
+
+# Cold-start benchmark when run directly: python -m src.headerstore [count]
+if __name__ == "__main__":
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from .block import TESTNET_GENESIS_BLOCK
+
+    def rss_kb():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except OSError:
+            return 0
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        store = HeaderStore(path, genesis=TESTNET_GENESIS_BLOCK)
+        batch = []
+        prev = store.tip_hash()
+        for i in range(1, count):
+            raw = (b'\x00\x00\x00\x20' + prev[::-1] + hash256(prev)
+                   + (1296688602 + i * 600).to_bytes(4, 'little')
+                   + bytes.fromhex('ffff001d') + i.to_bytes(4, 'little'))
+            prev = hash256(raw)[::-1]
+            batch.append(raw)
+            if len(batch) == 2000:
+                store.extend(batch)
+                batch = []
+        store.extend(batch)
+        store.close()
+        print('wrote {} headers in {:.2f}s'.format(count, time.perf_counter() - start))
+
+        before = rss_kb()
+        start = time.perf_counter()
+        store = HeaderStore(path)
+        tip = store.tip_hash()
+        elapsed = time.perf_counter() - start
+        print('reopened at height {} in {:.4f}s, +{} kB resident'.format(
+            store.height, elapsed, rss_kb() - before))
+        heights = [random.randrange(store.count) for _ in range(100000)]
+        hashes = [store.hash_at(h) for h in heights]
+        start = time.perf_counter()
+        for block_hash, height in zip(hashes, heights):
+            assert store.height_of(block_hash) == height
+        elapsed = time.perf_counter() - start
+        print('hash -> height lookups: {:.0f}/s'.format(len(hashes) / elapsed))
+        assert store.height_of(tip) == store.height
+        store.close()
@@ -0,0 +1,208 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .helper import (
+    MAX_TARGET,
+    bits_to_target,
+    calculate_new_bits,
+    hash256,
+    little_endian_to_int,
+    target_to_bits,
+)
+from .network import (
+    GetHeadersMessage,
+    HeadersMessage,
+)
+
+RETARGET_INTERVAL = 2016
+MAX_HEADERS = 2000
+TESTNET_MIN_DIFFICULTY_GAP = 20 * 60
+
+
+def check_pow_batch(raws):
+    '''Returns the index of the first header in raws failing PoW, or -1.
+
+    Module level so it can run in worker processes.
+    '''
+    for i, raw in enumerate(raws):
+        target = bits_to_target(raw[72:76])
+        if little_endian_to_int(hash256(raw)) >= target:
+            return i
+    return -1
+
+
+class HeaderSync:
+    '''Downloads headers from a SimpleNode into a HeaderStore.
+
+    The network stage asks for the next getheaders batch as soon as the
+    current one arrives, while a validator thread checks linkage, proof of
+    work and 2016-block retargeting of the previous batch and appends it
+    to the store. With workers > 0 the PoW checks of each batch are split
+    across that many processes.
+    '''
+
+    def __init__(self, node, store, max_target=MAX_TARGET, workers=0, logging=False):
+        if len(store) == 0:
+            raise RuntimeError('the header store needs a genesis header')
+        self.node = node
+        self.store = store
+        self.testnet = node.testnet
+        self.max_target = max_target
+        self.limit_bits = target_to_bits(max_target)
+        self.workers = workers
+        self.logging = logging
+        self.headers = 0
+        self.elapsed = 0.0
+        self._error = None
+        self._pool = None
+        self._last_real_bits = self._find_last_real_bits()
+
+    def _find_last_real_bits(self):
+        # testnet: bits of the last header not mined under the 20 minute rule
+        height = self.store.height
+        while height % RETARGET_INTERVAL != 0:
+            bits = self.store.header(height).bits
+            if bits != self.limit_bits:
+                return bits
+            height -= 1
+        return self.store.header(height).bits
+
+    def headers_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.headers / self.elapsed
+
+    def request(self, start_block):
+        self.node.send(GetHeadersMessage(start_block=start_block))
+
+    def run(self):
+        '''Syncs until the peer has no more headers; returns the new tip height'''
+        batches = queue.Queue(maxsize=4)
+        validator = threading.Thread(target=self._validate_loop, args=(batches,))
+        validator.start()
+        pool = ProcessPoolExecutor(self.workers) if self.workers else None
+        self._pool = pool
+        start = time.perf_counter()
+        try:
+            self.request(self.store.tip_hash())
+            while self._error is None:
+                headers = self.node.wait_for(HeadersMessage)
+                raws = [block.serialize() for block in headers.blocks]
+                if len(raws) == MAX_HEADERS:
+                    # pipelined: ask for the next batch before validating this one
+                    self.request(hash256(raws[-1])[::-1])
+                if raws:
+                    batches.put(raws)
+                if len(raws) < MAX_HEADERS:
+                    break
+        finally:
+            batches.put(None)
+            validator.join()
+            if pool is not None:
+                pool.shutdown()
+            self.elapsed += time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+        return self.store.height
+
+    def _validate_loop(self, batches):
+        while True:
+            raws = batches.get()
+            if raws is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self.validate(raws)
+                self.store.extend(raws)
+                self.headers += len(raws)
+                if self.logging:
+                    print('synced to height {} ({:.0f} headers/s)'.format(
+                        self.store.height, self.headers_per_second()))
+            except Exception as e:
+                # keep draining the queue so run() never blocks on put()
+                self._error = e
+
+    def _check_pow(self, raws):
+        if self._pool is None:
+            return check_pow_batch(raws)
+        size = (len(raws) + self.workers - 1) // self.workers
+        chunks = [raws[i:i + size] for i in range(0, len(raws), size)]
+        for n, failed in enumerate(self._pool.map(check_pow_batch, chunks)):
+            if failed >= 0:
+                return n * size + failed
+        return -1
+
+    def validate(self, raws):
+        '''Checks a batch that should extend the store's tip; raises RuntimeError'''
+        failed = self._check_pow(raws)
+        if failed >= 0:
+            raise RuntimeError('bad proof of work at height {}'.format(
+                self.store.height + 1 + failed))
+        base = self.store.height + 1
+        prev_raw = bytes(self.store.raw(self.store.height))
+        prev_hash = self.store.tip_hash()
+        for i, raw in enumerate(raws):
+            height = base + i
+            if raw[4:36][::-1] != prev_hash:
+                raise RuntimeError('header at height {} does not link to {}'.format(
+                    height, prev_hash.hex()))
+            bits = raw[72:76]
+            if height % RETARGET_INTERVAL == 0:
+                first = height - RETARGET_INTERVAL
+                if first >= base:
+                    first_raw = raws[first - base]
+                else:
+                    first_raw = self.store.raw(first)
+                time_differential = (little_endian_to_int(prev_raw[68:72])
+                                     - little_endian_to_int(first_raw[68:72]))
+                expected = calculate_new_bits(
+                    prev_raw[72:76], time_differential, self.max_target)
+                if bits != expected:
+                    raise RuntimeError('bad retarget at height {}: {} vs {}'.format(
+                        height, bits.hex(), expected.hex()))
+                self._last_real_bits = bits
+            elif self.testnet and bits == self.limit_bits and bits != self._last_real_bits:
+                # testnet allows minimum difficulty after a 20 minute gap; when
+                # the real difficulty is the limit too, these are ordinary blocks
+                gap = little_endian_to_int(raw[68:72]) - little_endian_to_int(prev_raw[68:72])
+                if gap <= TESTNET_MIN_DIFFICULTY_GAP:
+                    raise RuntimeError('minimum difficulty too early at height {}'.format(height))
+            else:
+                expected = self._last_real_bits if self.testnet else prev_raw[72:76]
+                if bits != expected:
+                    raise RuntimeError('unexpected bits at height {}: {} vs {}'.format(
+                        height, bits.hex(), expected.hex()))
+                self._last_real_bits = bits
+            prev_raw = raw
+            prev_hash = hash256(raw)[::-1]
+
+
+# Benchmark against a local stand-in peer: python -m src.headersync [count]
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    from .headerstore import HeaderStore
+    from .network import SimpleNode
+    from .standin import SYNTHETIC_MAX_TARGET, StandInPeer, synthetic_chain
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    start = time.perf_counter()
+    chain = synthetic_chain(count)
+    print('mined {} synthetic headers in {:.1f}s'.format(count, time.perf_counter() - start))
+    for workers in (0, 4):
+        with StandInPeer(chain, testnet=False) as peer, \
+                tempfile.TemporaryDirectory() as path:
+            store = HeaderStore(path, genesis=chain[0])
+            node = SimpleNode(peer.host, port=peer.port, logging=False)
+            node.handshake()
+            sync = HeaderSync(node, store, max_target=SYNTHETIC_MAX_TARGET, workers=workers)
+            height = sync.run()
+            assert height == count - 1 and store.tip_hash() == hash256(chain[-1])[::-1]
+            print('workers={}: {} headers in {:.2f}s ({:.0f} headers/s)'.format(
+                workers, sync.headers, sync.elapsed, sync.headers_per_second()))
+            store.close()
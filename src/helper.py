@@ -1,11 +1,29 @@
 import hashlib
+import os
+
+from .base58 import (
+    BASE58_ALPHABET,
+    decode_base58,
+    encode_base58,
+    encode_base58_checksum,
+)
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
-BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 TWO_WEEKS = 60 * 60 * 24 * 14
 MAX_TARGET = 0xffff * 256**(0x1d - 3)
+# where the wallet keeps its caches; overridden by the environment variable
+DATA_DIR_ENV = 'PB_WALLET_DATA_DIR'
+DEFAULT_DATA_DIR = os.path.join(os.path.expanduser('~'), '.pb-wallet')
+
+def data_path(name):
+    '''Resolves a relative file name against the data directory, creating it'''
+    if name is None or os.path.isabs(name):
+        return name
+    directory = os.environ.get(DATA_DIR_ENV) or DEFAULT_DATA_DIR
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
 
 def hash160(s):
     '''Perform SHA256 followed by RIPEMD160 hashing'''
@@ -15,39 +33,6 @@ def hash256(s):
     '''Perform double SHA256 hashing'''
     return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
-def encode_base58(s):
-    '''Encode bytes into a Base58 string'''
-    count = 0
-    for c in s:
-        if c == 0:
-            count += 1
-        else:
-            break
-    num = int.from_bytes(s, 'big')
-    prefix = '1' * count
-    result = ''
-    while num > 0:
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
-
-def encode_base58_checksum(s):
-    '''Encode bytes into Base58 with checksum appended'''
-    return encode_base58(s + hash256(s)[:4])
-
-def decode_base58(s):
-    '''Decode a Base58 string and verify checksum'''
-    num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-    combined = num.to_bytes(25, byteorder='big')
-    checksum = combined[-4:]
-    if hash256(combined[:-4])[:4] != checksum:
-        raise ValueError('bad address: {} {}'.format(checksum,
-            hash256(combined[:-4])[:4]))
-    return combined[1:-4]
-
 def little_endian_to_int(b):
     '''Convert little-endian bytes to integer'''
     return int.from_bytes(b, 'little')
@@ -68,6 +53,18 @@ def read_varint(s):
     else:
         return i
     
+def read_varint_at(b, offset):
+    '''Read a variable-length integer from a buffer, returning (value, next offset)'''
+    i = b[offset]
+    if i == 0xfd:
+        return little_endian_to_int(b[offset + 1:offset + 3]), offset + 3
+    elif i == 0xfe:
+        return little_endian_to_int(b[offset + 1:offset + 5]), offset + 5
+    elif i == 0xff:
+        return little_endian_to_int(b[offset + 1:offset + 9]), offset + 9
+    else:
+        return i, offset + 1
+
 def encode_varint(i):
     '''Encode an integer as a variable-length integer'''
     if i < 0xfd:
@@ -91,7 +88,7 @@ def bits_to_target(bits):
 def target_to_bits(target):
     '''Convert target integer back to compact difficulty bits'''
     raw_bytes = target.to_bytes(32, 'big')
-    raw_bytes = raw_bytes.lstrip(b'x\00')
+    raw_bytes = raw_bytes.lstrip(b'\x00')
     if raw_bytes[0] > 0x7f:
         exponent = len(raw_bytes) + 1
         coefficient = b'\x00' + raw_bytes[:2]
@@ -101,13 +98,13 @@ def target_to_bits(target):
     new_bits = coefficient[::-1] + bytes([exponent])
     return new_bits
 
-def calculate_new_bits(previous_bits, time_differential):
+def calculate_new_bits(previous_bits, time_differential, max_target=MAX_TARGET):
     '''Calculate new difficulty bits based on previous bits and time differential'''
     if time_differential > TWO_WEEKS * 4:
         time_differential = TWO_WEEKS * 4
     if time_differential < TWO_WEEKS // 4:
         time_differential = TWO_WEEKS // 4
     new_target = bits_to_target(previous_bits) * time_differential // TWO_WEEKS
-    if new_target > MAX_TARGET:
-        new_target = MAX_TARGET
+    if new_target > max_target:
+        new_target = max_target
     return target_to_bits(new_target)
\ No newline at end of file
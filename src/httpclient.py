@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+
+from concurrent.futures import Future
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+# statuses worth another attempt; 429 also slows the rate limiter down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    '''Rate limiter that adapts to the server.
+
+    acquire() blocks until a token is available. throttled() halves the
+    rate (and honours Retry-After) when the server answers 429, at most
+    once per cooldown seconds so a burst of concurrent 429s counts once;
+    succeeded() raises the rate again by increase, up to max_rate.
+    '''
+
+    def __init__(self, rate=20.0, burst=20, min_rate=0.5, max_rate=None,
+                 increase=0.1, cooldown=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.last_decrease >= self.cooldown:
+                self.last_decrease = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class HTTPClient:
+    '''One pooled, rate limited HTTP client for all the wallet's API calls.
+
+    Requests go through a shared requests.Session, so connections (and TLS
+    sessions) are reused. Connection errors, timeouts and retryable
+    statuses are retried with full-jitter exponential backoff, and a
+    TokenBucket keeps the request rate under what the server tolerates.
+    Concurrent GETs of the same URL share one request (single-flight).
+    '''
+
+    def __init__(self, timeout=10, retries=4, backoff=0.5, max_backoff=8,
+                 rate=20.0, burst=20, pool_size=32):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'collapsed': 0}
+
+    def _count(self, key):
+        '''Bumps a stats counter; requests run on many threads at once'''
+        with self.lock:
+            self.stats[key] += 1
+
+    def _sleep(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def request(self, method, url, retries=None, **kwargs):
+        '''The response of the first attempt that isn't retryable.
+
+        After the last retry the final response is returned, or the final
+        connection error raised; callers check the status themselves.
+        '''
+        if retries is None:
+            retries = self.retries
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            self.limiter.acquire()
+            self._count('requests')
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+                self._count('retries')
+                self._sleep(attempt)
+                continue
+            if response.status_code == 429:
+                self._count('throttled')
+                retry_after = response.headers.get('Retry-After')
+                self.limiter.throttled(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            elif response.status_code not in RETRY_STATUSES:
+                self.limiter.succeeded()
+                return response
+            if last:
+                return response
+            self._count('retries')
+            self._sleep(attempt)
+
+    def get(self, url, **kwargs):
+        '''GET with single-flight: callers asking for a URL already in flight share its response'''
+        with self.lock:
+            future = self.inflight.get(url)
+            leader = future is None
+            if leader:
+                future = self.inflight[url] = Future()
+        if not leader:
+            self._count('collapsed')
+            return future.result()
+        try:
+            response = self.request('GET', url, **kwargs)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[url]
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def default_client():
+    '''The process-wide HTTPClient shared by the fetchers and broadcasters'''
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = HTTPClient()
+        return _default_client
+
+
+# Benchmark against a local stand-in HTTP server: python -m src.httpclient
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .standin import StandInHTTPServer
+
+    def run(fetch, urls, workers=16):
+        latencies = []
+
+        def timed(url):
+            start = time.perf_counter()
+            response = fetch(url)
+            latencies.append(time.perf_counter() - start)
+            return response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            statuses = list(executor.map(timed, urls))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return len(urls) / elapsed, latencies[int(len(latencies) * 0.99)], statuses
+
+    with StandInHTTPServer(latency=0.002) as server:
+        urls = ['{}/tx/{:064x}/hex'.format(server.url, i) for i in range(2000)]
+        rate, p99, _ = run(lambda url: requests.get(url, timeout=10), urls)
+        print('requests.get per call  {:6.0f} req/s  p99 {:6.1f} ms'.format(rate, p99 * 1000))
+        client = HTTPClient(rate=1e6, burst=1000)
+        rate, p99, _ = run(client.get, urls)
+        print('pooled HTTPClient      {:6.0f} req/s  p99 {:6.1f} ms'.format(rate, p99 * 1000))
+
+        before = server.requests
+        rate, p99, _ = run(client.get, [urls[0]] * 500, workers=50)
+        print('500 concurrent GETs of one URL -> {} server requests ({} collapsed)'.format(
+            server.requests - before, client.stats['collapsed']))
+
+    with StandInHTTPServer(latency=0.002, rate_limit=200) as server:
+        urls = ['{}/tx/{:064x}/hex'.format(server.url, i) for i in range(1000)]
+        client = HTTPClient(rate=400, burst=50, backoff=0.1)
+        rate, p99, statuses = run(client.get, urls)
+        print('server limited to 200 req/s: {:.0f} req/s, p99 {:.0f} ms, {} 429s seen, '
+              'limiter settled at {:.0f} req/s, {} failed'.format(
+                  rate, p99 * 1000, server.rejected, client.limiter.rate,
+                  sum(status == 429 for status in statuses)))
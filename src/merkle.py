@@ -0,0 +1,258 @@
+import hashlib
+
+from io import BytesIO
+
+from .helper import (
+    encode_varint,
+    hash256,
+    int_to_little_endian,
+    little_endian_to_int,
+    read_varint,
+)
+
+# All hashes in this module are in internal byte order (the raw hash256
+# output). Block.merkle_root and Tx.hash() use the reversed display order.
+
+
+def merkle_parent(hash1, hash2):
+    '''Takes the binary hashes and calculates the hash256 of the pair'''
+    return hash256(hash1 + hash2)
+
+
+def merkle_parent_level(level):
+    '''Takes a contiguous buffer of 32-byte hashes and returns the parent level.
+
+    The level is one bytes/bytearray object rather than a list of hashes,
+    so no Python object is kept per node.
+    '''
+    view = memoryview(level)
+    count = len(view) // 32
+    parents = bytearray(((count + 1) // 2) * 32)
+    sha256 = hashlib.sha256
+    for i in range(count // 2):
+        pair = view[i * 64:i * 64 + 64]
+        parents[i * 32:i * 32 + 32] = sha256(sha256(pair).digest()).digest()
+    if count % 2 == 1:
+        last = bytes(view[-32:])
+        parents[-32:] = hash256(last + last)
+    return parents
+
+
+def _as_level(hashes):
+    if isinstance(hashes, (bytes, bytearray, memoryview)):
+        level = hashes
+    else:
+        level = b''.join(hashes)
+    if len(level) == 0 or len(level) % 32 != 0:
+        raise ValueError('merkle tree needs a non-empty list of 32-byte hashes')
+    return level
+
+
+def merkle_root(hashes):
+    '''Takes 32-byte hashes (a list or one contiguous buffer) and returns the root'''
+    level = _as_level(hashes)
+    while len(level) > 32:
+        level = merkle_parent_level(level)
+    return bytes(level)
+
+
+def merkle_branch(hashes, index):
+    '''Returns the sibling hashes proving hashes[index] up to the root'''
+    level = _as_level(hashes)
+    count = len(level) // 32
+    if not 0 <= index < count:
+        raise IndexError('leaf index out of range: {}'.format(index))
+    branch = []
+    while count > 1:
+        sibling = index ^ 1
+        if sibling >= count:
+            sibling = index
+        branch.append(bytes(level[sibling * 32:sibling * 32 + 32]))
+        level = merkle_parent_level(level)
+        count = len(level) // 32
+        index >>= 1
+    return branch
+
+
+def branch_root(leaf, branch, index):
+    '''Folds an inclusion branch into the root it commits to'''
+    current = leaf
+    for sibling in branch:
+        if index & 1:
+            current = hash256(sibling + current)
+        else:
+            current = hash256(current + sibling)
+        index >>= 1
+    return current
+
+
+def verify_branch(leaf, branch, index, root):
+    '''Checks an inclusion branch in O(log n) hashes'''
+    return branch_root(leaf, branch, index) == root
+
+
+def bytes_to_bit_field(some_bytes):
+    flag_bits = []
+    for byte in some_bytes:
+        for _ in range(8):
+            flag_bits.append(byte & 1)
+            byte >>= 1
+    return flag_bits
+
+
+def bit_field_to_bytes(bit_field):
+    result = bytearray((len(bit_field) + 7) // 8)
+    for i, bit in enumerate(bit_field):
+        if bit:
+            result[i // 8] |= 1 << (i % 8)
+    return bytes(result)
+
+
+class PartialMerkleTree:
+    '''A BIP37 partial merkle tree: a pruned tree proving a subset of leaves'''
+
+    def __init__(self, total, hashes, flags):
+        self.total = total
+        self.hashes = hashes
+        self.flags = flags
+
+    def __repr__(self):
+        return 'PartialMerkleTree(total={}, hashes={}, flag_bytes={})'.format(
+            self.total, len(self.hashes), len(self.flags))
+
+    @classmethod
+    def parse(cls, s):
+        total = little_endian_to_int(s.read(4))
+        num_hashes = read_varint(s)
+        hashes = [s.read(32) for _ in range(num_hashes)]
+        flags_length = read_varint(s)
+        flags = s.read(flags_length)
+        return cls(total, hashes, flags)
+
+    def serialize(self):
+        result = int_to_little_endian(self.total, 4)
+        result += encode_varint(len(self.hashes))
+        result += b''.join(self.hashes)
+        result += encode_varint(len(self.flags))
+        result += self.flags
+        return result
+
+    def _height(self):
+        height = 0
+        while (1 << height) < self.total:
+            height += 1
+        return height
+
+    def _width(self, height):
+        return (self.total + (1 << height) - 1) >> height
+
+    @classmethod
+    def build(cls, hashes, matches):
+        '''Builds the partial tree for leaves whose matches[i] is true'''
+        tree = cls(len(hashes), [], b'')
+        bits = []
+        proof = []
+
+        def subtree_hash(height, pos):
+            if height == 0:
+                return hashes[pos]
+            left = subtree_hash(height - 1, pos * 2)
+            if pos * 2 + 1 < tree._width(height - 1):
+                right = subtree_hash(height - 1, pos * 2 + 1)
+            else:
+                right = left
+            return hash256(left + right)
+
+        def traverse(height, pos):
+            parent_of_match = any(matches[pos << height:(pos + 1) << height])
+            bits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                proof.append(subtree_hash(height, pos))
+                return
+            traverse(height - 1, pos * 2)
+            if pos * 2 + 1 < tree._width(height - 1):
+                traverse(height - 1, pos * 2 + 1)
+
+        traverse(tree._height(), 0)
+        tree.hashes = proof
+        tree.flags = bit_field_to_bytes(bits)
+        return tree
+
+    def extract(self):
+        '''Returns (root, [(leaf_hash, leaf_index), ...]) for the matched leaves.
+
+        Raises SyntaxError if the tree is malformed, including the
+        duplicated-sibling trick from CVE-2012-2459.
+        '''
+        if self.total == 0:
+            raise SyntaxError('partial merkle tree with no transactions')
+        if len(self.hashes) > self.total:
+            raise SyntaxError('more hashes than transactions')
+        bits = bytes_to_bit_field(self.flags)
+        if len(bits) < len(self.hashes):
+            raise SyntaxError('fewer flag bits than hashes')
+        state = {'bit': 0, 'hash': 0}
+        matched = []
+
+        def traverse(height, pos):
+            if state['bit'] >= len(bits):
+                raise SyntaxError('ran out of flag bits')
+            flag = bits[state['bit']]
+            state['bit'] += 1
+            if height == 0 or not flag:
+                if state['hash'] >= len(self.hashes):
+                    raise SyntaxError('ran out of hashes')
+                h = self.hashes[state['hash']]
+                state['hash'] += 1
+                if height == 0 and flag:
+                    matched.append((h, pos))
+                return h
+            left = traverse(height - 1, pos * 2)
+            if pos * 2 + 1 < self._width(height - 1):
+                right = traverse(height - 1, pos * 2 + 1)
+                if right == left:
+                    raise SyntaxError('duplicate sibling hashes in partial tree')
+            else:
+                right = left
+            return hash256(left + right)
+
+        root = traverse(self._height(), 0)
+        if state['hash'] != len(self.hashes):
+            raise SyntaxError('not all hashes were consumed')
+        if (state['bit'] + 7) // 8 != len(self.flags):
+            raise SyntaxError('not all flag bits were consumed')
+        return root, matched
+
+    def root(self):
+        return self.extract()[0]
+
+    def verify(self, root):
+        '''root in internal byte order'''
+        try:
+            return self.extract()[0] == root
+        except SyntaxError:
+            return False
+
+
+# Benchmark when run directly: python -m src.merkle
+if __name__ == "__main__":
+    import os
+    import time
+
+    leaves = [os.urandom(32) for _ in range(1000)]
+    root = merkle_root(leaves)
+    for index in (0, 1, 500, 999):
+        assert verify_branch(leaves[index], merkle_branch(leaves, index), index, root)
+    matches = [i % 97 == 0 for i in range(len(leaves))]
+    tree = PartialMerkleTree.parse(BytesIO(PartialMerkleTree.build(leaves, matches).serialize()))
+    found, matched = tree.extract()
+    assert found == root
+    assert [i for _, i in matched] == [i for i, m in enumerate(matches) if m]
+
+    for count in (1000, 100000, 1000000):
+        level = os.urandom(32 * count)
+        start = time.perf_counter()
+        merkle_root(level)
+        elapsed = time.perf_counter() - start
+        print('merkle_root over {:>8} leaves: {:8.3f}s ({:.0f} leaves/s)'.format(
+            count, elapsed, count / elapsed))
@@ -1,7 +1,11 @@
+import select
 import socket
+import threading
 import time
 
+from collections import deque
 from io import BytesIO
+from itertools import count
 from random import randint
 
 from .block import Block
@@ -12,11 +16,20 @@ from .helper import (
     little_endian_to_int,
     read_varint,
 )
+from .merkle import PartialMerkleTree
 
 # Magic values used to identify the Bitcoin mainnet and testnet
 NETWORK_MAGIC = b'\xf9\xbe\xb4\xd9'
 TESTNET_NETWORK_MAGIC = b'\x0b\x11\x09\x07'
 
+# Inventory types used in inv/getdata messages
+TX_DATA_TYPE = 1
+BLOCK_DATA_TYPE = 2
+FILTERED_BLOCK_DATA_TYPE = 3
+
+# unclaimed messages a node keeps per command for later wait_for calls
+QUEUE_LIMIT = 1000
+
 class NetworkEnvelope:
     '''Represents a message sent over the Bitcoin network'''
     
@@ -191,6 +204,7 @@ class PongMessage:
     def __init__(self, nonce):
         self.nonce = nonce
         
+    @classmethod
     def parse(cls, s):
         nonce = s.read(8)
         return cls(nonce)
@@ -205,12 +219,18 @@ class GetHeadersMessage:
     command = b'getheaders'
     
     def __init__(self, version=70015, num_hashes=1, 
-        start_block=None, end_block=None):
+        start_block=None, end_block=None, locator=None):
         self.version = version
-        self.num_hashes = num_hashes
+        if locator is not None:
+            start_block = locator[0]
+            num_hashes = len(locator)
         if start_block is None:
             raise RuntimeError('a start block is required')
         self.start_block = start_block
+        if locator is None:
+            locator = [start_block]
+        self.locator = locator
+        self.num_hashes = num_hashes
         if end_block is None:
             self.end_block = b'\x00' * 32
         else:
@@ -219,10 +239,19 @@ class GetHeadersMessage:
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
         result += encode_varint(self.num_hashes)
-        result += self.start_block[::-1]
+        for block_hash in self.locator:
+            result += block_hash[::-1]
         result += self.end_block[::-1]
         return result
     
+    @classmethod
+    def parse(cls, s):
+        version = little_endian_to_int(s.read(4))
+        num_hashes = read_varint(s)
+        locator = [s.read(32)[::-1] for _ in range(num_hashes)]
+        end_block = s.read(32)[::-1]
+        return cls(version, end_block=end_block, locator=locator)
+    
 
 class HeadersMessage:
     '''Represents a "headers" message containing block headers'''
@@ -242,12 +271,119 @@ class HeadersMessage:
             if num_txs != 0:
                 raise RuntimeError('number of txs not 0')
         return cls(blocks)
+    
+    def serialize(self):
+        result = encode_varint(len(self.blocks))
+        for block in self.blocks:
+            if isinstance(block, Block):
+                block = block.serialize()
+            result += block + b'\x00'
+        return result
+
+
+class GetDataMessage:
+    '''Represents a "getdata" message requesting transactions or blocks'''
+    
+    command = b'getdata'
+    
+    def __init__(self):
+        self.data = []
+        
+    def add_data(self, data_type, identifier):
+        self.data.append((data_type, identifier))
+        return self
+        
+    def serialize(self):
+        result = encode_varint(len(self.data))
+        for data_type, identifier in self.data:
+            result += int_to_little_endian(data_type, 4)
+            result += identifier[::-1]
+        return result
+    
+    @classmethod
+    def parse(cls, s):
+        message = cls()
+        for _ in range(read_varint(s)):
+            data_type = little_endian_to_int(s.read(4))
+            message.add_data(data_type, s.read(32)[::-1])
+        return message
+
+
+class InvMessage(GetDataMessage):
+    '''Represents an "inv" message announcing transactions or blocks'''
+    
+    command = b'inv'
+
+
+class NotFoundMessage(GetDataMessage):
+    '''Represents a "notfound" message listing getdata items a peer lacks'''
+    
+    command = b'notfound'
+
+
+class FilterLoadMessage:
+    '''Represents a "filterload" message carrying a BIP37 bloom filter'''
+    
+    command = b'filterload'
+    
+    def __init__(self, filter_bytes, function_count, tweak, flag=1):
+        self.filter_bytes = filter_bytes
+        self.function_count = function_count
+        self.tweak = tweak
+        self.flag = flag
+        
+    def serialize(self):
+        result = encode_varint(len(self.filter_bytes))
+        result += self.filter_bytes
+        result += int_to_little_endian(self.function_count, 4)
+        result += int_to_little_endian(self.tweak, 4)
+        result += int_to_little_endian(self.flag, 1)
+        return result
+    
+    @classmethod
+    def parse(cls, s):
+        filter_bytes = s.read(read_varint(s))
+        function_count = little_endian_to_int(s.read(4))
+        tweak = little_endian_to_int(s.read(4))
+        flag = little_endian_to_int(s.read(1))
+        return cls(filter_bytes, function_count, tweak, flag)
+
+
+class MerkleBlockMessage:
+    '''Represents a "merkleblock" message: a header plus a partial merkle tree'''
+    
+    command = b'merkleblock'
+    
+    def __init__(self, header, tree):
+        self.header = header
+        self.tree = tree
+        
+    def __repr__(self):
+        return 'MerkleBlockMessage({}, {})'.format(self.header.hash().hex(), self.tree)
+        
+    @classmethod
+    def parse(cls, s):
+        header = Block.parse(s)
+        tree = PartialMerkleTree.parse(s)
+        return cls(header, tree)
+    
+    def serialize(self):
+        return self.header.serialize() + self.tree.serialize()
+    
+    def is_valid(self):
+        '''Checks the partial merkle tree against the header's merkle root'''
+        return self.tree.verify(self.header.merkle_root[::-1])
+    
+    def matched_hashes(self):
+        '''Hashes (display order) of the transactions the filter matched'''
+        _, matched = self.tree.extract()
+        return [h[::-1] for h, _ in matched]
 
 
 class SimpleNode:
     '''Represents a simple Bitcoin node'''
     
-    def __init__(self, host, port=None, testnet=False, logging=True):
+    def __init__(self, host, port=None, testnet=False, logging=True, timeout=None):
         if port is None:
             if testnet:
                 port = 18333
@@ -255,42 +391,220 @@ class SimpleNode:
                 port = 8333
         self.testnet = testnet
         self.logging = logging
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((host, port))
+        self.socket = socket.create_connection((host, port), timeout)
+        # P2P messages are small and latency bound: don't wait to coalesce them
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.stream = self.socket.makefile('rb', None)
+        self.send_lock = threading.Lock()
+        # messages nobody was waiting for yet, per command, oldest first
+        self.queues = {}
+        self.sequence = count()
+        self.router = None
         
     def handshake(self):
         '''Performs a Bitcoin handshake (version -> verack)'''
         version = VersionMessage()
         self.send(version)
-        print("Sent version message")
+        if self.logging:
+            print("Sent version message")
         self.wait_for(VerAckMessage)
-        print("Received verack message")
+        if self.logging:
+            print("Received verack message")
     
     def send(self, message):
         '''Send a message to the connected node'''
         envelope = NetworkEnvelope(
             command=message.command, payload=message.serialize(), testnet=self.testnet)
+        self.write(envelope)
+
+    def write(self, envelope):
+        '''Send an already built envelope'''
         if self.logging:
-            print('sending: {}'.format(envelope))
-        self.socket.sendall(envelope.serialize())
+            print('sending: {} ({} bytes)'.format(envelope.command.decode('ascii'), len(envelope.payload)))
+        with self.send_lock:
+            self.socket.sendall(envelope.serialize())
+
+    def close(self):
+        if self.router is not None:
+            # the reader thread holds the stream, so end it before closing
+            self.router.stop()
+        self.stream.close()
+        self.socket.close()
         
     def read(self):
         '''Read a message from the socket'''
         envelope = NetworkEnvelope.parse(self.stream, testnet=self.testnet)
         if self.logging:
-            print('receiving: {}'.format(envelope))
+            print('receiving: {} ({} bytes)'.format(envelope.command.decode('ascii'), len(envelope.payload)))
         return envelope
+
+    def wait_readable(self, timeout):
+        '''Returns once a message has started arriving; raises TimeoutError after timeout seconds'''
+        saved = self.socket.gettimeout()
+        # a non-blocking peek returns what is buffered without consuming it
+        self.socket.setblocking(False)
+        try:
+            pending = self.stream.peek(1)
+        finally:
+            self.socket.settimeout(saved)
+        if not pending and not select.select([self.socket], [], [], max(0, timeout))[0]:
+            raise TimeoutError('nothing received within {:.3f}s'.format(timeout))
+
+    def answer(self, envelope):
+        '''Replies to version and ping; True if the message needs nothing else'''
+        if envelope.command == VersionMessage.command:
+            self.send(VerAckMessage())
+            return True
+        if envelope.command == PingMessage.command:
+            self.send(PongMessage(envelope.payload))
+            return True
+        return False
+
+    def enqueue(self, envelope):
+        if isinstance(envelope.payload, memoryview):
+            # framed payloads point into a receive buffer that gets reused
+            envelope.payload = bytes(envelope.payload)
+        queue = self.queues.get(envelope.command)
+        if queue is None:
+            queue = self.queues[envelope.command] = deque(maxlen=QUEUE_LIMIT)
+        queue.append((next(self.sequence), envelope))
+
+    def dequeue(self, commands):
+        '''Removes and returns the oldest queued envelope among commands, or None'''
+        oldest = None
+        for command in commands:
+            queue = self.queues.get(command)
+            if queue and (oldest is None or queue[0][0] < oldest[0][0]):
+                oldest = queue
+        if oldest is None:
+            return None
+        return oldest.popleft()[1]
     
-    def wait_for(self, *message_classes):
-        '''Wait for one of the specified message types'''
-        command = None
+    def wait_for(self, *message_classes, timeout=None):
+        '''Wait for one of the specified message types.
+
+        Anything else that arrives meanwhile is queued for a later
+        wait_for rather than dropped. Version and ping are answered
+        automatically and only returned when asked for. With a timeout,
+        TimeoutError is raised when nothing matching arrives in time.
+        '''
         command_to_class = {m.command: m for m in message_classes}
-        while command not in command_to_class.keys():
-            envelope = self.read()
-            command = envelope.command
-            if command == VersionMessage.command:
-                self.send(VerAckMessage())
-            elif command == PingMessage.command:
-                self.send(PongMessage(envelope.payload))
-        return command_to_class[command].parse(envelope.stream())
\ No newline at end of file
+        if self.router is not None:
+            envelope = self.router.wait_for_envelope(command_to_class, timeout)
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            envelope = self.dequeue(command_to_class)
+            while envelope is None:
+                if deadline is not None:
+                    try:
+                        self.wait_readable(deadline - time.monotonic())
+                    except TimeoutError:
+                        raise TimeoutError('no {} within {}s'.format(
+                            b'/'.join(command_to_class).decode('ascii'), timeout))
+                envelope = self.read()
+                answered = self.answer(envelope)
+                if envelope.command in command_to_class:
+                    break
+                if not answered:
+                    self.enqueue(envelope)
+                envelope = None
+        return command_to_class[envelope.command].parse(envelope.stream())
+
+    def start_router(self):
+        '''Starts a background MessageRouter reading this node'''
+        if self.router is None:
+            self.router = MessageRouter(self).start()
+        return self.router
+
+
+class MessageRouter:
+    '''Background reader that routes a SimpleNode's incoming messages.
+
+    A daemon thread reads every message, answers version and ping itself
+    (queueing them too only while a wait_for asks for them), calls the callbacks subscribed to the message's command and queues it
+    for wait_for. Messages and payload bytes are counted per command.
+    '''
+
+    def __init__(self, node):
+        self.node = node
+        self.subscribers = {}
+        self.messages = {}
+        self.bytes = {}
+        self.error = None
+        # commands that wait_for callers are blocked on, with how many callers
+        self.waiting = {}
+        self.condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Ends the reader by shutting down the receiving side of the socket'''
+        try:
+            self.node.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def subscribe(self, command, callback):
+        '''callback(envelope) runs on the reader thread for every command message'''
+        command = getattr(command, 'command', command)
+        self.subscribers.setdefault(command, []).append(callback)
+
+    def unsubscribe(self, command, callback):
+        command = getattr(command, 'command', command)
+        self.subscribers.get(command, []).remove(callback)
+
+    def _run(self):
+        try:
+            while True:
+                self.dispatch(self.node.read())
+        except Exception as e:
+            # including subscriber errors: waiters must learn the reader is gone
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def dispatch(self, envelope):
+        command = envelope.command
+        self.messages[command] = self.messages.get(command, 0) + 1
+        self.bytes[command] = self.bytes.get(command, 0) + len(envelope.payload)
+        answered = self.node.answer(envelope)
+        with self.condition:
+            if not answered or self.waiting.get(command):
+                self.node.enqueue(envelope)
+                self.condition.notify_all()
+        for callback in self.subscribers.get(command, ()):
+            callback(envelope)
+
+    def wait_for_envelope(self, commands, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            for command in commands:
+                self.waiting[command] = self.waiting.get(command, 0) + 1
+            try:
+                while True:
+                    envelope = self.node.dequeue(commands)
+                    if envelope is not None:
+                        return envelope
+                    if self.error is not None:
+                        raise RuntimeError('connection closed: {}'.format(self.error))
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('no {} within {}s'.format(
+                            b'/'.join(commands).decode('ascii'), timeout))
+                    self.condition.wait(remaining)
+            finally:
+                for command in commands:
+                    self.waiting[command] -= 1
+
+    def stats(self):
+        '''Messages and payload bytes received so far, per command'''
+        return {
+            command.decode('ascii'): {'messages': n, 'bytes': self.bytes[command]}
+            for command, n in self.messages.items()
+        }
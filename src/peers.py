@@ -0,0 +1,228 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .helper import data_path
+from .network import SimpleNode
+from .pool import (
+    CONNECTION_ERRORS,
+    ConnectionPool,
+    ping,
+)
+
+PEERS_FILE = "peers.json"
+DEFAULT_TESTNET_HOSTS = [
+    'testnet.programmingbitcoin.com',
+    'testnet-seed.bitcoin.jonasschnelli.ch',
+    'seed.tbtc.petertodd.org',
+    'testnet-seed.bluematt.me',
+]
+# weight of the newest RTT sample in a peer's moving average
+RTT_WEIGHT = 0.3
+# consecutive failures after which a peer stops being routed to
+MAX_FAILURES = 3
+
+
+def measure_rtt(node, timeout=None):
+    '''Round-trip time of a ping/pong with a connected node, in seconds'''
+    start = time.perf_counter()
+    ping(node, timeout)
+    return time.perf_counter() - start
+
+
+class PeerManager:
+    '''Finds, ranks and remembers the fastest peers among candidate hosts.
+
+    resolve() expands host names into addresses, race() connects and
+    handshakes with all of them in parallel and keeps the first ones to
+    finish, and every probe updates a per-address score (a moving average
+    of ping RTT plus a count of consecutive failures) persisted in path,
+    which is resolved against the data directory when relative.
+    connect() hands the winners to a ConnectionPool so requests go to the
+    fastest healthy peers without another handshake.
+    '''
+
+    def __init__(self, hosts=None, testnet=True, timeout=5, path=PEERS_FILE):
+        if hosts is None:
+            hosts = DEFAULT_TESTNET_HOSTS
+        self.testnet = testnet
+        self.timeout = timeout
+        self.path = data_path(path)
+        self.hosts = []
+        for host in hosts:
+            if isinstance(host, str):
+                host = (host, 18333 if testnet else 8333)
+            self.hosts.append(tuple(host))
+        self.scores = {}
+        self.resolved = None
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(self.path):
+            self.load()
+
+    @staticmethod
+    def key(address):
+        return '{}:{}'.format(*address)
+
+    def resolve(self):
+        '''Every (ip, port) the candidate hosts resolve to, resolved in parallel'''
+        def lookup(host):
+            try:
+                infos = socket.getaddrinfo(host[0], host[1], type=socket.SOCK_STREAM)
+            except OSError:
+                return []
+            return [(info[4][0], info[4][1]) for info in infos]
+
+        addresses = []
+        with ThreadPoolExecutor(max_workers=max(1, len(self.hosts))) as executor:
+            for found in executor.map(lookup, self.hosts):
+                for address in found:
+                    if address not in addresses:
+                        addresses.append(address)
+        self.resolved = addresses
+        return addresses
+
+    def probe(self, address):
+        '''Connects, handshakes and pings address; returns (node, rtt)'''
+        node = SimpleNode(address[0], port=address[1], testnet=self.testnet,
+                          logging=False, timeout=self.timeout)
+        try:
+            node.handshake()
+            rtt = measure_rtt(node, self.timeout)
+        except (TimeoutError,) + CONNECTION_ERRORS:
+            node.close()
+            raise
+        return node, rtt
+
+    def race(self, count=3, addresses=None):
+        '''Probes addresses in parallel; returns the first count as [(address, node)].
+
+        Late finishers are still scored, then disconnected.
+        '''
+        if addresses is None:
+            addresses = self.resolve()
+        winners = []
+        if not addresses:
+            return winners
+        executor = ThreadPoolExecutor(max_workers=len(addresses))
+        futures = {executor.submit(self.probe, address): address for address in addresses}
+
+        def settle(future):
+            address = futures[future]
+            try:
+                node, rtt = future.result()
+            except (TimeoutError,) + CONNECTION_ERRORS:
+                self.record_failure(address)
+                return None
+            self.record_rtt(address, rtt)
+            return node
+
+        for future in as_completed(futures):
+            node = settle(future)
+            if node is not None:
+                winners.append((futures[future], node))
+            if len(winners) == count:
+                break
+        for future in futures:
+            if not future.done():
+                future.add_done_callback(lambda f: self._discard(settle(f)))
+        executor.shutdown(wait=False)
+        self.save()
+        return winners
+
+    def _discard(self, node):
+        if node is not None:
+            node.close()
+        self.save()
+
+    def record_rtt(self, address, rtt):
+        with self.lock:
+            score = self.scores.setdefault(self.key(address), {'rtt': None, 'failures': 0})
+            if score['rtt'] is None:
+                score['rtt'] = rtt
+            score['rtt'] = (1 - RTT_WEIGHT) * score['rtt'] + RTT_WEIGHT * rtt
+            score['failures'] = 0
+            score['last_seen'] = int(time.time())
+
+    def record_failure(self, address):
+        with self.lock:
+            score = self.scores.setdefault(self.key(address), {'rtt': None, 'failures': 0})
+            score['failures'] += 1
+
+    def healthy(self, address):
+        score = self.scores.get(self.key(address))
+        return score is not None and score['rtt'] is not None and score['failures'] < MAX_FAILURES
+
+    def fastest(self, count=3):
+        '''Best known healthy addresses of the current hosts, lowest average RTT first
+
+        The scores file may hold peers from earlier runs with other hosts or
+        on the other network, so only addresses the hosts resolve to (as of
+        the last resolve()) are ranked.
+        '''
+        candidates = self.resolved if self.resolved is not None else self.resolve()
+        ranked = []
+        for address in candidates:
+            if self.healthy(address):
+                ranked.append((self.scores[self.key(address)]['rtt'], address))
+        ranked.sort()
+        return [address for _, address in ranked[:count]]
+
+    def addresses(self, count=3):
+        '''Where to route without connecting: fastest scored peers, else the hosts'''
+        return self.fastest(count) or self.hosts[:count]
+
+    def connect(self, count=3, keepalive=60):
+        '''Races the candidates and returns a ConnectionPool of the winners, already handshaken'''
+        winners = self.race(count)
+        pool = ConnectionPool([address for address, _ in winners] or self.addresses(count),
+                              testnet=self.testnet, timeout=self.timeout, keepalive=keepalive)
+        for connection, (_, node) in zip(pool.connections, winners):
+            connection.node = node
+            connection.handshakes += 1
+        return pool
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.scores, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            self.scores = json.load(f)
+
+
+# Race local stand-in peers of different speeds: python -m src.peers
+if __name__ == "__main__":
+    import tempfile
+
+    from .standin import StandInPeer
+
+    latencies = (0.05, 0.002, 0.02, 0.1, 0.01)
+    peers = [StandInPeer(testnet=True, latency=latency).start() for latency in latencies]
+    hosts = [(peer.host, peer.port) for peer in peers] + [('127.0.0.1', 1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = PeerManager(hosts, testnet=True, timeout=2, path=os.path.join(tmp, PEERS_FILE))
+        start = time.perf_counter()
+        pool = manager.connect(count=2)
+        print('connected to the 2 fastest of {} candidates in {:.1f} ms'.format(
+            len(hosts), (time.perf_counter() - start) * 1000))
+        time.sleep(1)
+        for peer, latency in zip(peers, latencies):
+            score = manager.scores[PeerManager.key((peer.host, peer.port))]
+            print('stand-in latency {:5.0f} ms: rtt {:6.1f} ms'.format(latency * 1000, score['rtt'] * 1000))
+        print('routing to', [c.port for c in pool.connections], 'stats', pool.stats())
+        reloaded = PeerManager(hosts, testnet=True, path=manager.path)
+        print('persisted fastest:', [port for _, port in reloaded.fastest(2)])
+        # scores of hosts this manager was not given are not routed to
+        others = PeerManager(hosts[2:], testnet=True, path=manager.path)
+        assert set(others.fastest(5)) <= set(hosts[2:])
+        pool.close()
+    for peer in peers:
+        peer.stop()
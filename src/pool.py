@@ -0,0 +1,204 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from os import urandom
+
+from .network import (
+    PingMessage,
+    PongMessage,
+    SimpleNode,
+)
+
+# errors that mean a pooled connection is unusable and must be replaced
+CONNECTION_ERRORS = (OSError, RuntimeError)
+
+
+def ping(node, timeout=None):
+    '''Sends a ping and waits for the matching pong; raises TimeoutError after timeout.
+
+    Goes through wait_for, so anything else arriving meanwhile stays
+    queued on the node (or its router) instead of being lost.
+    '''
+    nonce = urandom(8)
+    node.send(PingMessage(nonce))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        if node.wait_for(PongMessage, timeout=remaining).nonce == nonce:
+            return
+
+
+class PooledConnection:
+    '''One pool slot: a lazily connected, handshaken SimpleNode'''
+
+    def __init__(self, host, port, testnet, timeout):
+        self.host = host
+        self.port = port
+        self.testnet = testnet
+        self.timeout = timeout
+        self.node = None
+        self.lock = threading.Lock()
+        self.last_used = 0
+        self.handshakes = 0
+        self.sends = 0
+
+    def __repr__(self):
+        return 'PooledConnection({}:{}, connected={})'.format(
+            self.host, self.port, self.node is not None)
+
+    def ready(self):
+        '''The connected node, connecting and handshaking first if needed'''
+        if self.node is None:
+            node = SimpleNode(self.host, port=self.port, testnet=self.testnet,
+                              logging=False, timeout=self.timeout)
+            try:
+                node.handshake()
+            except CONNECTION_ERRORS:
+                node.close()
+                raise
+            self.node = node
+            self.handshakes += 1
+        self.last_used = time.monotonic()
+        return self.node
+
+    def drop(self):
+        if self.node is not None:
+            try:
+                self.node.close()
+            except OSError:
+                pass
+            self.node = None
+
+
+class ConnectionPool:
+    '''Reusable P2P connections handed out ready to use.
+
+    Nothing connects until the first session() or send(). Connections stay
+    open between uses; a background thread pings the idle ones every
+    keepalive seconds and drops any that stop answering, and a dropped or
+    failed connection is transparently reconnected on its next use.
+
+    addresses is a list of hosts or (host, port) pairs, one slot each.
+    '''
+
+    def __init__(self, addresses, testnet=False, timeout=10, keepalive=60):
+        self.testnet = testnet
+        self.keepalive = keepalive
+        self.connections = []
+        for address in addresses:
+            if isinstance(address, str):
+                host, port = address, None
+            else:
+                host, port = address
+            if port is None:
+                port = 18333 if testnet else 8333
+            self.connections.append(PooledConnection(host, port, testnet, timeout))
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _pick(self, index):
+        if index is None:
+            with self._lock:
+                index = self._next
+                self._next = (self._next + 1) % len(self.connections)
+        return self.connections[index]
+
+    def _start_keepalive(self):
+        with self._lock:
+            if self._thread is None and self.keepalive:
+                self._thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+                self._thread.start()
+
+    def session(self, index=None):
+        '''Yields a handshaken SimpleNode from slot index (round robin by default)'''
+        return self._use(self._pick(index))
+
+    @contextmanager
+    def _use(self, connection):
+        with connection.lock:
+            try:
+                node = connection.ready()
+                self._start_keepalive()
+                yield node
+            except CONNECTION_ERRORS:
+                connection.drop()
+                raise
+
+    def send(self, message, index=None, retries=1):
+        '''Sends message on a pooled connection, reconnecting on failure'''
+        for attempt in range(retries + 1):
+            connection = self._pick(index)
+            try:
+                with self._use(connection) as node:
+                    node.send(message)
+                connection.sends += 1
+                return
+            except CONNECTION_ERRORS:
+                if attempt == retries:
+                    raise
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive):
+            now = time.monotonic()
+            for connection in self.connections:
+                if connection.node is None or now - connection.last_used < self.keepalive:
+                    continue
+                if not connection.lock.acquire(blocking=False):
+                    continue
+                try:
+                    ping(connection.node, connection.timeout)
+                    connection.last_used = time.monotonic()
+                except CONNECTION_ERRORS:
+                    connection.drop()
+                finally:
+                    connection.lock.release()
+
+    def stats(self):
+        return {
+            'connected': sum(c.node is not None for c in self.connections),
+            'handshakes': sum(c.handshakes for c in self.connections),
+            'sends': sum(c.sends for c in self.connections),
+        }
+
+    def close(self):
+        self._stop.set()
+        for connection in self.connections:
+            with connection.lock:
+                connection.drop()
+
+
+# Benchmark against a local stand-in peer: python -m src.pool
+if __name__ == "__main__":
+    from .standin import StandInPeer
+
+    count = 500
+    with StandInPeer(testnet=True) as peer:
+        message = PingMessage(b'\x00' * 8)
+        start = time.perf_counter()
+        for _ in range(count):
+            node = SimpleNode(peer.host, port=peer.port, testnet=True, logging=False)
+            node.handshake()
+            node.send(message)
+            node.close()
+        fresh = time.perf_counter() - start
+
+        with ConnectionPool([(peer.host, peer.port)], testnet=True) as pool:
+            start = time.perf_counter()
+            for _ in range(count):
+                pool.send(message)
+            pooled = time.perf_counter() - start
+            stats = pool.stats()
+
+    print('handshake per send: {:.3f} ms/send'.format(fresh / count * 1000))
+    print('pooled:             {:.3f} ms/send ({} handshakes for {} sends)'.format(
+        pooled / count * 1000, stats['handshakes'], stats['sends']))
@@ -0,0 +1,187 @@
+import threading
+import time
+
+from .helper import (
+    hash256,
+    int_to_little_endian,
+    little_endian_to_int,
+)
+from .network import (
+    TESTNET_NETWORK_MAGIC,
+    NetworkEnvelope,
+    SimpleNode,
+)
+from .standin import StandInPeer
+
+FILE_MAGIC = b'P2PREC\x00\x01'
+# direction of a record, seen from the recording node
+INBOUND = b'<'
+OUTBOUND = b'>'
+# how long a replay waits for the client's next recorded message
+REPLAY_TIMEOUT = 30
+
+
+class TrafficRecorder:
+    '''Captures a node's NetworkEnvelopes to a compact file.
+
+    The file is FILE_MAGIC and a testnet byte, then one record per message:
+    a direction byte, 8 bytes of little-endian microseconds since the
+    recording started, and the envelope exactly as it went over the wire.
+    '''
+
+    def __init__(self, path, testnet=False):
+        self.path = path
+        self.testnet = testnet
+        self.file = open(path, 'wb')
+        self.file.write(FILE_MAGIC + (b'\x01' if testnet else b'\x00'))
+        self.start = time.perf_counter()
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def record(self, direction, envelope):
+        offset = int((time.perf_counter() - self.start) * 1e6)
+        data = direction + int_to_little_endian(offset, 8) + envelope.serialize()
+        with self.lock:
+            self.file.write(data)
+            self.records += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    '''Yields (direction, seconds since start, envelope) for every record'''
+    with open(path, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise RuntimeError('{} is not a traffic recording'.format(path))
+        testnet = f.read(1) == b'\x01'
+        while True:
+            direction = f.read(1)
+            if not direction:
+                return
+            offset = little_endian_to_int(f.read(8))
+            yield direction, offset / 1e6, NetworkEnvelope.parse(f, testnet=testnet)
+
+
+class RecordingNode(SimpleNode):
+    '''SimpleNode that copies everything it sends and reads to a TrafficRecorder'''
+
+    def __init__(self, host, port=None, testnet=False, logging=True, timeout=None, recorder=None):
+        super().__init__(host, port=port, testnet=testnet, logging=logging, timeout=timeout)
+        self.recorder = recorder
+
+    def write(self, envelope):
+        self.recorder.record(OUTBOUND, envelope)
+        super().write(envelope)
+
+    def read(self):
+        envelope = super().read()
+        self.recorder.record(INBOUND, envelope)
+        return envelope
+
+
+class ReplayPeer(StandInPeer):
+    '''Stand-in that plays a recording back to every client that connects.
+
+    Inbound records (what the recorded peer sent) go out with their
+    original spacing divided by speed, or back to back when speed is None.
+    Before each outbound record the replay waits for the client to send a
+    message with that command, so the conversation keeps its recorded
+    order. Latency and bandwidth apply as for any StandInPeer.
+    '''
+
+    def __init__(self, path, speed=1.0, host='127.0.0.1', port=0, latency=0, bandwidth=None):
+        self.records = list(read_recording(path))
+        testnet = bool(self.records) and self.records[0][2].magic == TESTNET_NETWORK_MAGIC
+        super().__init__(testnet=testnet, host=host, port=port, latency=latency, bandwidth=bandwidth)
+        self.speed = speed
+        self.handlers = {}
+
+    def on_connect(self, session):
+        threading.Thread(target=self.replay, args=(session,), daemon=True).start()
+
+    def _next_command(self, session, consumed):
+        deadline = time.monotonic() + REPLAY_TIMEOUT
+        while len(session.received) <= consumed:
+            if session not in self.sessions or time.monotonic() > deadline:
+                return None
+            time.sleep(0.0005)
+        return session.received[consumed]
+
+    def replay(self, session):
+        consumed = 0
+        previous = None
+        for direction, offset, envelope in self.records:
+            if direction == OUTBOUND:
+                while True:
+                    command = self._next_command(session, consumed)
+                    if command is None:
+                        return
+                    consumed += 1
+                    if command == envelope.command:
+                        break
+            else:
+                if self.speed and previous is not None and offset > previous:
+                    time.sleep((offset - previous) / self.speed)
+                try:
+                    session.send_raw(envelope.serialize())
+                except OSError:
+                    return
+            previous = offset
+
+
+# Offline, reproducible network benchmarks: python -m src.recorder
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from .headerstore import HeaderStore
+    from .headersync import HeaderSync
+    from .relay import TxRelay
+    from .standin import SYNTHETIC_MAX_TARGET, synthetic_chain, synthetic_mempool
+
+    chain = synthetic_chain(5000, seed=1)
+    mempool = synthetic_mempool(300, chain_length=5, seed=2, testnet=False)
+
+    def workload(node):
+        '''Handshake, header sync and a bulk relay: (handshake seconds, headers/s, tx/s)'''
+        start = time.perf_counter()
+        node.handshake()
+        handshake = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as path:
+            store = HeaderStore(path, genesis=chain[0])
+            sync = HeaderSync(node, store, max_target=SYNTHETIC_MAX_TARGET)
+            sync.run()
+            assert store.tip_hash() == hash256(chain[-1])[::-1]
+            store.close()
+        report = TxRelay(node).relay(mempool)
+        node.close()
+        return handshake, sync.headers_per_second(), report['tx_per_second']
+
+    def show(label, result):
+        print('{:<34} handshake {:6.1f} ms  sync {:8.0f} headers/s  relay {:7.0f} tx/s'.format(
+            label, result[0] * 1000, result[1], result[2]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'session.p2prec')
+        with StandInPeer(chain, testnet=False) as peer, TrafficRecorder(path) as recorder:
+            node = RecordingNode(peer.host, port=peer.port, logging=False, recorder=recorder)
+            show('live stand-in (recording)', workload(node))
+        print('recorded {} messages, {} bytes'.format(recorder.records, os.path.getsize(path)))
+        for speed in (None, 1.0):
+            with ReplayPeer(path, speed=speed) as peer:
+                node = SimpleNode(peer.host, port=peer.port, logging=False)
+                show('replay speed={}'.format(speed), workload(node))
+
+    for latency, bandwidth in ((0.001, None), (0.01, None), (0, 2000000), (0.01, 2000000)):
+        with StandInPeer(chain, testnet=False, latency=latency, bandwidth=bandwidth) as peer:
+            node = SimpleNode(peer.host, port=peer.port, logging=False)
+            show('latency {:.0f} ms, bandwidth {}'.format(
+                latency * 1000, bandwidth or 'unlimited'), workload(node))
@@ -1,4 +1,7 @@
+import json
+
 from logging import getLogger
+from time import perf_counter
 
 from .helper import (
     encode_varint,
@@ -19,6 +22,119 @@ def p2pkh_script(h160):
 
 LOGGER = getLogger(__name__)
 
+# OP_RIPEMD160, OP_SHA1, OP_SHA256, OP_HASH160, OP_HASH256
+HASH_OPS = (166, 167, 168, 169, 170)
+
+_ACTIVE_PROFILER = None
+
+
+def active_profiler():
+    '''Returns the ScriptProfiler currently collecting, or None'''
+    return _ACTIVE_PROFILER
+
+
+def _execute(cmd, stack, altstack, cmds, z):
+    '''Dispatch a single opcode with the arguments it expects'''
+    operation = OP_CODE_FUNCTIONS[cmd]
+    if cmd in (99, 100):
+        return operation(stack, cmds)
+    elif cmd in (107, 108):
+        return operation(stack, altstack)
+    elif cmd in (172, 173, 174, 175):
+        return operation(stack, z)
+    else:
+        return operation(stack)
+
+
+class ScriptProfiler:
+    '''Opt-in instrumentation for Script.evaluate.
+
+    Used as a context manager, every script evaluated while it is active
+    (for example all inputs of a Tx.verify run) is aggregated into one
+    profile:
+
+        with ScriptProfiler() as profiler:
+            tx.verify()
+        print(profiler.report())
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.times = {}
+        self.hashed = {}
+        self.max_stack_depth = 0
+        self.bytes_hashed = 0
+        self.scripts = 0
+        self._previous = None
+
+    def __enter__(self):
+        global _ACTIVE_PROFILER
+        self._previous = _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self
+        return self
+
+    def __exit__(self, *exc):
+        global _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self._previous
+        self._previous = None
+        return False
+
+    def execute(self, cmd, stack, altstack, cmds, z):
+        '''Run one opcode and record its cost'''
+        hashed = 0
+        if cmd in HASH_OPS and len(stack) > 0:
+            hashed = len(stack[-1])
+        start = perf_counter()
+        result = _execute(cmd, stack, altstack, cmds, z)
+        elapsed = perf_counter() - start
+        self.calls[cmd] = self.calls.get(cmd, 0) + 1
+        self.times[cmd] = self.times.get(cmd, 0.0) + elapsed
+        if hashed:
+            self.hashed[cmd] = self.hashed.get(cmd, 0) + hashed
+            self.bytes_hashed += hashed
+        self.observe_stack(len(stack) + len(altstack))
+        return result
+
+    def observe_stack(self, depth):
+        if depth > self.max_stack_depth:
+            self.max_stack_depth = depth
+
+    def record_hash(self, length):
+        '''Account bytes hashed outside of opcodes (e.g. the sighash preimage)'''
+        self.bytes_hashed += length
+
+    def stats(self):
+        '''Returns the profile as a dict, opcodes sorted by cumulative time'''
+        ops = []
+        for cmd in sorted(self.calls, key=lambda c: self.times[c], reverse=True):
+            ops.append({
+                'op': OP_CODE_NAMES.get(cmd, 'OP_[{}]'.format(cmd)),
+                'calls': self.calls[cmd],
+                'seconds': self.times[cmd],
+                'bytes_hashed': self.hashed.get(cmd, 0),
+            })
+        return {
+            'scripts': self.scripts,
+            'max_stack_depth': self.max_stack_depth,
+            'bytes_hashed': self.bytes_hashed,
+            'ops': ops,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.stats(), **kwargs)
+
+    def report(self):
+        '''Human readable table, most expensive opcodes first'''
+        stats = self.stats()
+        lines = ['{:<24}{:>10}{:>14}{:>14}'.format(
+            'op', 'calls', 'total ms', 'bytes hashed')]
+        for op in stats['ops']:
+            lines.append('{:<24}{:>10}{:>14.3f}{:>14}'.format(
+                op['op'], op['calls'], op['seconds'] * 1000, op['bytes_hashed']))
+        lines.append('scripts: {}  max stack depth: {}  bytes hashed: {}'.format(
+            stats['scripts'], stats['max_stack_depth'], stats['bytes_hashed']))
+        return '\n'.join(lines)
+
 class Script:
     def __init__(self, cmds=None):
         if cmds is None:
@@ -96,32 +212,26 @@ class Script:
         return encode_varint(total) + result
     
     def evaluate(self, z):
+        profiler = _ACTIVE_PROFILER
+        if profiler is not None:
+            profiler.scripts += 1
         cmds = self.cmds[:]
         stack = []
         altstack = []
         while len(cmds) > 0:
             cmd = cmds.pop(0)
             if type(cmd) == int:
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):
-                    if not operation(stack, cmds):
-                        LOGGER.info(f'bad op: {OP_CODE_NAMES.get(cmd, cmd)}')
-                        return False
-                elif cmd in (107, 108):
-                    if not operation(stack, altstack):
-                        LOGGER.info(f'bad op: {OP_CODE_NAMES.get(cmd, cmd)}')
-                        return False
-                elif cmd in (172, 173, 174, 175):
-                    if not operation(stack, z):
-                        LOGGER.info(f'bad op: {OP_CODE_NAMES.get(cmd, cmd)}')
-                        return False
+                if profiler is None:
+                    result = _execute(cmd, stack, altstack, cmds, z)
                 else:
-                    if not operation(stack):
-                        LOGGER.info(f'bad op: {OP_CODE_NAMES.get(cmd, cmd)}')
-                        return False
-                    
+                    result = profiler.execute(cmd, stack, altstack, cmds, z)
+                if not result:
+                    LOGGER.info(f'bad op: {OP_CODE_NAMES.get(cmd, cmd)}')
+                    return False
             else:
                 stack.append(cmd)
+                if profiler is not None:
+                    profiler.observe_stack(len(stack) + len(altstack))
         if len(stack) == 0:
             return False
         if stack.pop() == b'':
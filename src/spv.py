@@ -0,0 +1,150 @@
+import time
+
+from os import urandom
+
+from .bloom import (
+    BLOOM_UPDATE_ALL,
+    BloomFilter,
+)
+from .network import (
+    FILTERED_BLOCK_DATA_TYPE,
+    GetDataMessage,
+    MerkleBlockMessage,
+    NotFoundMessage,
+    PingMessage,
+    PongMessage,
+)
+from .tx import Tx
+
+
+class SPVScanner:
+    '''Discovers wallet transactions with BIP37 filtered blocks.
+
+    Loads a bloom filter on the peer, requests merkleblocks and yields
+    every matched transaction as soon as it arrives, after checking its
+    partial merkle tree against the block header. A ping sent after the
+    getdata marks the end of the peer's answer: blocks it reported as
+    notfound or never sent end up in missing_blocks, and matched
+    transactions it left out (ones it believes we already have) in
+    missing_txs.
+    '''
+
+    def __init__(self, node, bloom, store=None):
+        self.node = node
+        self.bloom = bloom
+        self.store = store
+        self.missing_blocks = set()
+        self.missing_txs = {}
+
+    @classmethod
+    def for_items(cls, node, items, fp_rate=0.0001, store=None):
+        '''Builds the bloom filter from items (hash160s, scripts, outpoints...)'''
+        items = list(items)
+        bloom = BloomFilter.from_fp_rate(len(items), fp_rate)
+        for item in items:
+            bloom.add(item)
+        return cls(node, bloom, store)
+
+    def load_filter(self, flag=BLOOM_UPDATE_ALL):
+        self.node.send(self.bloom.filterload(flag))
+
+    def request(self, block_hashes):
+        getdata = GetDataMessage()
+        for block_hash in block_hashes:
+            getdata.add_data(FILTERED_BLOCK_DATA_TYPE, block_hash)
+        self.node.send(getdata)
+
+    def scan(self, block_hashes, on_tx=None, timeout=None):
+        '''Yields (block_hash, tx) for matched transactions in block_hashes.
+
+        on_tx(block_hash, tx) is also called for each one, so a wallet can
+        follow along while the caller just drains the generator. Ends when
+        the pong for the ping sent after the getdata arrives; raises
+        TimeoutError if that takes longer than timeout seconds.
+        '''
+        block_hashes = list(block_hashes)
+        self.missing_blocks = set()
+        self.missing_txs = {}
+        if not block_hashes:
+            return
+        self.request(block_hashes)
+        # peers answer in order, so the pong comes after everything asked for
+        nonce = urandom(8)
+        self.node.send(PingMessage(nonce))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending_blocks = set(block_hashes)
+        expected = {}
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            message = self.node.wait_for(
+                MerkleBlockMessage, Tx, NotFoundMessage, PongMessage, timeout=remaining)
+            if isinstance(message, PongMessage):
+                if message.nonce == nonce:
+                    break
+            elif isinstance(message, NotFoundMessage):
+                for data_type, block_hash in message.data:
+                    if data_type == FILTERED_BLOCK_DATA_TYPE and block_hash in pending_blocks:
+                        pending_blocks.discard(block_hash)
+                        self.missing_blocks.add(block_hash)
+            elif isinstance(message, MerkleBlockMessage):
+                block_hash = message.header.hash()
+                if block_hash not in pending_blocks:
+                    continue
+                if not message.is_valid():
+                    raise RuntimeError('invalid merkle proof for block {}'.format(block_hash.hex()))
+                if self.store is not None and block_hash not in self.store:
+                    raise RuntimeError('merkleblock for unknown header {}'.format(block_hash.hex()))
+                pending_blocks.discard(block_hash)
+                for tx_hash in message.matched_hashes():
+                    expected[tx_hash] = block_hash
+            else:
+                block_hash = expected.pop(message.hash(), None)
+                if block_hash is None:
+                    continue
+                if on_tx is not None:
+                    on_tx(block_hash, message)
+                yield block_hash, message
+        self.missing_blocks.update(pending_blocks)
+        self.missing_txs = expected
+
+
+# Scan against a local stand-in peer: python -m src.spv
+if __name__ == "__main__":
+    from .helper import hash256
+    from .network import SimpleNode
+    from .standin import StandInPeer, synthetic_block, synthetic_chain, synthetic_mempool
+
+    txs = synthetic_mempool(40, seed=5)
+    genesis = synthetic_chain(1)[0]
+    with StandInPeer([genesis]) as peer:
+        prev = genesis
+        block_hashes = []
+        for i in range(0, len(txs), 10):
+            raw = synthetic_block(hash256(prev)[::-1], txs[i:i + 10], 1500000600 + i * 60)
+            block_hashes.append(peer.add_block(raw))
+            prev = raw[:80]
+        wanted = [txs[2], txs[13], txs[25], txs[37]]
+        node = SimpleNode(peer.host, port=peer.port, testnet=True, logging=False)
+        node.handshake()
+        # the peer now knows we have wanted[1], so its block leaves it out
+        node.send(wanted[1])
+        scanner = SPVScanner.for_items(node, [tx.tx_outs[0].script_pubkey.cmds[2] for tx in wanted])
+        scanner.load_filter()
+        unknown = b'\x11' * 32
+        start = time.perf_counter()
+        found = {tx.hash() for _, tx in scanner.scan(block_hashes + [unknown], timeout=5)}
+        elapsed = time.perf_counter() - start
+        assert {wanted[0].hash(), wanted[2].hash(), wanted[3].hash()} <= found
+        assert wanted[1].hash() in scanner.missing_txs
+        assert scanner.missing_blocks == {unknown}
+        print('{} blocks scanned in {:.3f}s: {} txs, {} left out, {} blocks not found'.format(
+            len(block_hashes) + 1, elapsed, len(found), len(scanner.missing_txs),
+            len(scanner.missing_blocks)))
+        # a peer that never answers ends the scan after timeout
+        peer.handlers.pop(b'ping')
+        peer.handlers.pop(GetDataMessage.command)
+        try:
+            list(scanner.scan(block_hashes, timeout=0.5))
+        except TimeoutError as e:
+            print('silent peer: {}'.format(e))
+        node.close()
@@ -0,0 +1,496 @@
+import json
+import socket
+import threading
+import time
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from io import BytesIO
+from random import Random
+
+from .block import FullBlock
+from .bloom import BloomFilter
+from .helper import (
+    bits_to_target,
+    calculate_new_bits,
+    encode_varint,
+    hash256,
+    int_to_little_endian,
+    little_endian_to_int,
+    target_to_bits,
+)
+from .script import p2pkh_script
+from .tx import Tx, TxIn, TxOut
+from .merkle import (
+    PartialMerkleTree,
+    merkle_root,
+)
+from .network import (
+    BLOCK_DATA_TYPE,
+    FILTERED_BLOCK_DATA_TYPE,
+    TX_DATA_TYPE,
+    FilterLoadMessage,
+    GetDataMessage,
+    GetHeadersMessage,
+    HeadersMessage,
+    InvMessage,
+    MerkleBlockMessage,
+    NetworkEnvelope,
+    NotFoundMessage,
+    PongMessage,
+    VerAckMessage,
+    VersionMessage,
+)
+from .utxostore import CHAIN_PAGE_SIZE
+
+# Easiest regtest-style target: about every other nonce is a valid proof
+# of work, so synthetic chains are cheap to mine.
+SYNTHETIC_MAX_TARGET = 0x7fffff * 256**(0x20 - 3)
+SYNTHETIC_BITS = target_to_bits(SYNTHETIC_MAX_TARGET)
+MAX_HEADERS = 2000
+
+
+def mine_header(version, prev_block, merkle_root, timestamp, bits):
+    '''Returns the raw 80-byte header with the first nonce meeting bits'''
+    target = bits_to_target(bits)
+    prefix = (int_to_little_endian(version, 4) + prev_block[::-1]
+              + merkle_root[::-1] + int_to_little_endian(timestamp, 4) + bits)
+    nonce = 0
+    while True:
+        raw = prefix + int_to_little_endian(nonce, 4)
+        if little_endian_to_int(hash256(raw)) < target:
+            return raw
+        nonce += 1
+
+
+def synthetic_chain(count, start_time=1500000000, spacing=600, jitter=300,
+                    max_target=SYNTHETIC_MAX_TARGET, version=0x20000000, seed=None):
+    '''Mines count headers (genesis first) that pass PoW, linkage and retargeting.
+
+    The same seed always gives the same chain.
+    '''
+    rng = Random(seed)
+    bits = target_to_bits(max_target)
+    headers = []
+    timestamps = []
+    prev = b'\x00' * 32
+    timestamp = start_time
+    for height in range(count):
+        if height > 0 and height % 2016 == 0:
+            time_differential = timestamps[height - 1] - timestamps[height - 2016]
+            bits = calculate_new_bits(bits, time_differential, max_target)
+        merkle_root = hash256(int_to_little_endian(height, 8))
+        raw = mine_header(version, prev, merkle_root, timestamp, bits)
+        headers.append(raw)
+        timestamps.append(timestamp)
+        prev = hash256(raw)[::-1]
+        timestamp += spacing + rng.randint(-jitter, jitter)
+    return headers
+
+
+def synthetic_mempool(count, chain_length=1, seed=None, testnet=True):
+    '''count unsigned transactions; each run of chain_length spends its predecessor.
+
+    Parents always come before their children in the returned list, and
+    the same seed always gives the same transactions.
+    '''
+    rng = Random(seed)
+    txs = []
+    for i in range(count):
+        if i % chain_length:
+            prev_tx, amount = txs[-1].hash(), txs[-1].tx_outs[0].amount - 1000
+        else:
+            prev_tx, amount = rng.getrandbits(256).to_bytes(32, 'big'), rng.randint(10**5, 10**8)
+        h160 = rng.getrandbits(160).to_bytes(20, 'big')
+        tx_outs = [TxOut(amount, p2pkh_script(h160))]
+        txs.append(Tx(1, [TxIn(prev_tx, 0)], tx_outs, 0, testnet=testnet))
+    return txs
+
+
+def synthetic_block(prev_block, txs, timestamp, bits=SYNTHETIC_BITS, version=0x20000000):
+    '''Mines a raw block holding txs (Tx objects, coinbase first) on prev_block'''
+    root = merkle_root([tx.hash()[::-1] for tx in txs])[::-1]
+    header = mine_header(version, prev_block, root, timestamp, bits)
+    return header + encode_varint(len(txs)) + b''.join(tx.serialize() for tx in txs)
+
+
+def bloom_matches(bloom, tx):
+    '''Simplified BIP37 matching: txid, pushed data and spent outpoints'''
+    if bloom.contains(tx.hash()[::-1]):
+        return True
+    for tx_out in tx.tx_outs:
+        for cmd in tx_out.script_pubkey.cmds:
+            if type(cmd) != int and bloom.contains(cmd):
+                return True
+    for tx_in in tx.tx_ins:
+        if bloom.contains(tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)):
+            return True
+        for cmd in tx_in.script_sig.cmds:
+            if type(cmd) != int and bloom.contains(cmd):
+                return True
+    return False
+
+
+class StandInPeer:
+    '''A local peer that speaks enough of the P2P protocol for offline tests.
+
+    It answers the version handshake and pings, serves getheaders from a
+    chain of raw headers (see synthetic_chain), and getdata for blocks,
+    BIP37 filtered blocks and mempool transactions, answering notfound for
+    anything else; filtered blocks leave out matched transactions the
+    connection already sent or was sent. Announced transactions
+    are requested with getdata and kept in the mempool, which a mempool
+    message announces. Every message is handled latency seconds after it
+    arrives, and when bandwidth (bytes/s) is set each session's outgoing
+    bytes are paced to it. Extra commands can be served by adding to
+    handlers, keyed by command:
+
+        peer.handlers[b'getdata'] = lambda session, envelope: ...
+
+    and on_connect(session) runs for every new connection before it is served.
+    '''
+
+    def __init__(self, headers=None, testnet=True, host='127.0.0.1', port=0,
+                 latency=0, bandwidth=None, mempool=None):
+        self.testnet = testnet
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.headers = []
+        self.heights = {}
+        self.add_headers(headers or [])
+        self.blocks = {}
+        self.mempool = {}
+        for tx in mempool or []:
+            self.add_tx(tx)
+        self.handlers = {
+            VersionMessage.command: self.on_version,
+            b'ping': self.on_ping,
+            GetHeadersMessage.command: self.on_getheaders,
+            FilterLoadMessage.command: self.on_filterload,
+            GetDataMessage.command: self.on_getdata,
+            InvMessage.command: self.on_inv,
+            Tx.command: self.on_tx,
+            b'mempool': self.on_mempool,
+        }
+        self.sessions = []
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self._running = False
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def add_headers(self, headers):
+        for raw in headers:
+            self.heights[hash256(raw)[::-1]] = len(self.headers)
+            self.headers.append(raw)
+
+    def add_block(self, raw):
+        '''Adds a raw block; its header extends the chain if it builds on the tip'''
+        block = FullBlock(raw)
+        self.blocks[block.hash()] = raw
+        if not self.headers or block.header.prev_block == hash256(self.headers[-1])[::-1]:
+            self.add_headers([bytes(raw[:80])])
+        return block.hash()
+
+    def add_tx(self, tx):
+        self.mempool[tx.hash()] = tx
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            self.server.close()
+        except OSError:
+            pass
+        for session in list(self.sessions):
+            session.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            session = StandInSession(self, conn)
+            self.sessions.append(session)
+            self.on_connect(session)
+            threading.Thread(target=session.serve, daemon=True).start()
+
+    def on_connect(self, session):
+        pass
+
+    def on_version(self, session, envelope):
+        session.send(VersionMessage(latest_block=max(len(self.headers) - 1, 0)))
+        session.send(VerAckMessage())
+
+    def on_ping(self, session, envelope):
+        session.send(PongMessage(envelope.payload))
+
+    def on_getheaders(self, session, envelope):
+        getheaders = GetHeadersMessage.parse(envelope.stream())
+        start = 0
+        for block_hash in getheaders.locator:
+            if block_hash in self.heights:
+                start = self.heights[block_hash] + 1
+                break
+        stop = min(start + MAX_HEADERS, len(self.headers))
+        if getheaders.end_block in self.heights:
+            stop = min(stop, self.heights[getheaders.end_block] + 1)
+        session.send(HeadersMessage(self.headers[start:stop]))
+
+    def on_filterload(self, session, envelope):
+        session.bloom = BloomFilter.from_filterload(FilterLoadMessage.parse(envelope.stream()))
+
+    def on_getdata(self, session, envelope):
+        getdata = GetDataMessage.parse(envelope.stream())
+        notfound = NotFoundMessage()
+        for data_type, identifier in getdata.data:
+            if data_type == TX_DATA_TYPE and identifier in self.mempool:
+                session.send_tx(self.mempool[identifier])
+            elif data_type == BLOCK_DATA_TYPE and identifier in self.blocks:
+                session.send(FullBlock(self.blocks[identifier]))
+            elif data_type == FILTERED_BLOCK_DATA_TYPE and identifier in self.blocks:
+                self.send_filtered_block(session, FullBlock(self.blocks[identifier]))
+            else:
+                notfound.add_data(data_type, identifier)
+        if notfound.data:
+            session.send(notfound)
+
+    def on_inv(self, session, envelope):
+        getdata = GetDataMessage()
+        for data_type, identifier in InvMessage.parse(envelope.stream()).data:
+            if data_type == TX_DATA_TYPE and identifier not in self.mempool:
+                getdata.add_data(data_type, identifier)
+        if getdata.data:
+            session.send(getdata)
+
+    def on_tx(self, session, envelope):
+        tx = Tx.parse(envelope.stream(), testnet=self.testnet)
+        session.known.add(tx.hash())
+        self.add_tx(tx)
+
+    def on_mempool(self, session, envelope):
+        inv = InvMessage()
+        for tx_hash in list(self.mempool):
+            inv.add_data(TX_DATA_TYPE, tx_hash)
+        session.send(inv)
+
+    def send_filtered_block(self, session, block):
+        txs = list(block.txs())
+        if session.bloom is None:
+            matches = [False] * len(txs)
+        else:
+            matches = [bloom_matches(session.bloom, tx) for tx in txs]
+        tree = PartialMerkleTree.build([tx.hash()[::-1] for tx in txs], matches)
+        session.send(MerkleBlockMessage(block.header, tree))
+        for tx, matched in zip(txs, matches):
+            # like BIP37 peers, leave out matched txs the session already has
+            if matched and tx.hash() not in session.known:
+                session.send_tx(tx)
+
+
+class StandInSession:
+    '''One accepted connection of a StandInPeer'''
+
+    def __init__(self, peer, conn):
+        self.peer = peer
+        self.conn = conn
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = conn.makefile('rb', None)
+        self.lock = threading.Lock()
+        self.received = []
+        self.bloom = None
+        # hashes of the txs this connection sent us or was sent
+        self.known = set()
+
+    def send(self, message):
+        envelope = NetworkEnvelope(
+            message.command, message.serialize(), testnet=self.peer.testnet)
+        self.send_raw(envelope.serialize())
+
+    def send_tx(self, tx):
+        self.known.add(tx.hash())
+        self.send(tx)
+
+    def send_raw(self, data):
+        with self.lock:
+            if self.peer.bandwidth:
+                time.sleep(len(data) / self.peer.bandwidth)
+            self.conn.sendall(data)
+
+    def serve(self):
+        try:
+            while True:
+                envelope = NetworkEnvelope.parse(self.stream, testnet=self.peer.testnet)
+                self.received.append(envelope.command)
+                if self.peer.latency:
+                    time.sleep(self.peer.latency)
+                handler = self.peer.handlers.get(envelope.command)
+                if handler is not None:
+                    handler(self, envelope)
+        except (RuntimeError, OSError, IndexError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self in self.peer.sessions:
+            self.peer.sessions.remove(self)
+
+
+class StandInHTTPServer:
+    '''A local stand-in for the esplora HTTP API used by the wallet.
+
+    Like blockstream.info it serves POST /tx (raw hex in, txid out),
+    GET /tx/<txid>/hex from txs and the mempool, GET
+    /address/<address>/utxo from utxos and GET /address/<address>/txs
+    (paged on with /txs/chain/<last txid>) from histories, whose lists of
+    esplora tx objects are kept newest first. Each request is answered after
+    latency seconds, or with status instead of 200 when that is set.
+    With rate_limit, requests beyond that many per second get a 429.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, status=200, rate_limit=None):
+        self.latency = latency
+        self.status = status
+        self.rate_limit = rate_limit
+        self.mempool = {}
+        self.txs = {}
+        self.utxos = {}
+        self.histories = {}
+        self.requests = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self._window = (0, 0)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so pooled clients can reuse connections, without
+            # Nagle holding back the body written after the headers
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                server.handle(self, 'POST', self.path, body)
+
+            def do_GET(self):
+                server.handle(self, 'GET', self.path, b'')
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+        self.url = 'http://{}:{}'.format(self.host, self.port)
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_tx(self, tx):
+        '''Serves tx (a Tx) from GET /tx/<txid>/hex'''
+        self.txs[tx.id()] = tx.serialize()
+
+    def _over_limit(self):
+        with self.lock:
+            self.requests += 1
+            if not self.rate_limit:
+                return False
+            second = int(time.monotonic())
+            window, count = self._window
+            count = count + 1 if window == second else 1
+            self._window = (second, count)
+            if count > self.rate_limit:
+                self.rejected += 1
+                return True
+            return False
+
+    def handle(self, request, method, path, body):
+        if self._over_limit():
+            self.reply(request, 429, b'Too Many Requests')
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        parts = path.strip('/').split('/')
+        if self.status != 200:
+            self.reply(request, self.status, b'stand-in error')
+        elif method == 'POST' and parts[-1] == 'tx':
+            try:
+                tx = Tx.parse(BytesIO(bytes.fromhex(body.decode('ascii').strip())))
+            except (ValueError, IndexError):
+                self.reply(request, 400, b'bad transaction hex')
+                return
+            tx_id = tx.id()
+            self.mempool[tx_id] = tx
+            self.reply(request, 200, tx_id.encode('ascii'))
+        elif method == 'GET' and len(parts) >= 3 and parts[-3] == 'tx' and parts[-1] == 'hex':
+            raw = self.txs.get(parts[-2])
+            if raw is None and parts[-2] in self.mempool:
+                raw = self.mempool[parts[-2]].serialize()
+            if raw is None:
+                self.reply(request, 404, b'Transaction not found')
+            else:
+                self.reply(request, 200, raw.hex().encode('ascii'))
+        elif method == 'GET' and len(parts) >= 3 and parts[-3] == 'address' and parts[-1] == 'utxo':
+            body = json.dumps(self.utxos.get(parts[-2], [])).encode('ascii')
+            self.reply(request, 200, body, content_type='application/json')
+        elif method == 'GET' and 'address' in parts and 'txs' in parts:
+            address = parts[parts.index('address') + 1]
+            body = json.dumps(self.history_page(address, parts[-1] if 'chain' in parts else None))
+            self.reply(request, 200, body.encode('ascii'), content_type='application/json')
+        else:
+            self.reply(request, 404, b'not found')
+
+    def history_page(self, address, last_seen=None):
+        '''Like esplora: unconfirmed txs then 25 confirmed, or the 25 confirmed after last_seen'''
+        history = self.histories.get(address, [])
+        confirmed = [tx for tx in history if tx['status']['confirmed']]
+        if last_seen is None:
+            return [tx for tx in history if not tx['status']['confirmed']] + confirmed[:CHAIN_PAGE_SIZE]
+        for i, tx in enumerate(confirmed):
+            if tx['txid'] == last_seen:
+                return confirmed[i + 1:i + 1 + CHAIN_PAGE_SIZE]
+        return []
+
+    def reply(self, request, status, body, content_type='text/plain'):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
@@ -1,7 +1,10 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import requests
 
-from .script import Script
+from .httpclient import default_client
+from .script import Script, active_profiler
 from .helper import (
     encode_varint,
     hash256,
@@ -10,41 +13,239 @@ from .helper import (
     read_varint,
     SIGHASH_ALL,
 )
+from .txstore import (
+    DISK_BUDGET,
+    MEMORY_BUDGET,
+    PREVOUT_BUDGET,
+    PREVOUT_OVERHEAD,
+    PREVOUT_SIBLINGS,
+    TX_DB,
+    MemoryTier,
+    RawTxStore,
+)
+
+# parents fetched at once by prefetch_parents
+PREFETCH_WORKERS = 16
 
 
 class TxFetcher:
-    cache = {}
-    
+    '''Fetches transactions by id through a memory tier, a disk store and HTTP.
+
+    cache holds recently used parsed transactions; behind it the on-disk
+    RawTxStore keeps raw bytes across runs and processes. Only a miss in
+    both goes to the API, and what it returns is written to both.
+
+    Spending inputs only need one output of each parent, so prevouts maps
+    (txid, index) to (amount, serialized scriptPubKey). fetch_prevout
+    answers from it and loads a missing parent without keeping the parsed
+    transaction around, remembering all its outputs when it has at most
+    PREVOUT_SIBLINGS of them (siblings are often spent together) and only
+    the one asked for otherwise.
+    '''
+    api_url = None
+    client = None
+    path = TX_DB
+    budget = DISK_BUDGET
+    cache = MemoryTier()
+    prevouts = MemoryTier(PREVOUT_BUDGET)
+    stats = {'prevout': 0, 'memory': 0, 'disk': 0, 'network': 0}
+    _store = None
+    _lock = threading.Lock()
+
     @classmethod
     def get_url(cls, testnet=False):
+        if cls.api_url is not None:
+            return cls.api_url
         if testnet:
             return 'https://blockstream.info/testnet/api/'
         else:
             return 'https://blockstream.info/api/'
-        
+
+    @classmethod
+    def configure(cls, api_url=None, path=TX_DB, budget=DISK_BUDGET, memory_budget=MEMORY_BUDGET,
+                  prevout_budget=PREVOUT_BUDGET, client=None):
+        '''Where and how to fetch and how much to cache; path=None keeps nothing on disk'''
+        with cls._lock:
+            if cls._store is not None:
+                cls._store.close()
+                cls._store = None
+            cls.api_url = api_url
+            cls.client = client
+            cls.path = path
+            cls.budget = budget
+            cls.cache = MemoryTier(memory_budget)
+            cls.prevouts = MemoryTier(prevout_budget)
+
+    @classmethod
+    def store(cls):
+        '''The shared RawTxStore, opened on first use'''
+        with cls._lock:
+            if cls._store is None and cls.path is not None:
+                cls._store = RawTxStore(cls.path, cls.budget)
+            return cls._store
+
+    @classmethod
+    def count(cls, tier):
+        '''Records a fetch answered by tier; prefetch workers call this concurrently'''
+        with cls._lock:
+            cls.stats[tier] += 1
+
+    @classmethod
+    def reset_stats(cls):
+        with cls._lock:
+            for key in cls.stats:
+                cls.stats[key] = 0
+
+    @classmethod
+    def hit_rates(cls):
+        '''Share of fetches answered by each tier'''
+        with cls._lock:
+            stats = dict(cls.stats)
+        total = sum(stats.values()) or 1
+        return {tier: count / total for tier, count in stats.items()}
+
+    @staticmethod
+    def parse_raw(raw, testnet=False):
+        if raw[4] == 0:
+            raw = raw[:4] + raw[6:]
+            tx = Tx.parse(BytesIO(raw), testnet=testnet)
+            tx.locktime = little_endian_to_int(raw[-4:])
+        else:
+            tx = Tx.parse(BytesIO(raw), testnet=testnet)
+        return tx
+
     @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
-        if fresh or (tx_id not in cls.cache):
-            url = '{}/tx/{}/hex'.format(cls.get_url(testnet), tx_id)
-            response = requests.get(url)
-            try:
-                raw = bytes.fromhex(response.text.strip())
-            except ValueError:
-                raise ValueError('unexpected response: {}'.format(response.text))
-            if raw[4] == 0:
-                raw = raw[:4] + raw[6:]
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
-                tx.locktime = little_endian_to_int(raw[-4:])
-            else:
-                tx = Tx.parse(BytesIO(raw), testnet=testnet)
+        tx = None if fresh else cls.cache.get(tx_id)
+        if tx is not None:
+            cls.count('memory')
+        else:
+            tx, size = cls.load(tx_id, testnet, fresh)
+            cls.cache.put(tx_id, tx, size)
+        tx.testnet = testnet
+        return tx
+
+    @classmethod
+    def fetch_prevout(cls, tx_id, index, testnet=False):
+        '''(amount, serialized scriptPubKey) of output index of tx_id'''
+        prevout = cls.prevouts.get((tx_id, index))
+        if prevout is not None:
+            cls.count('prevout')
+            return prevout
+        tx = cls.cache.get(tx_id)
+        if tx is None:
+            tx, _ = cls.load(tx_id, testnet)
+        else:
+            cls.count('memory')
+        return cls.remember_outputs(tx_id, tx, [index])[index]
+
+    @classmethod
+    def remember_outputs(cls, tx_id, tx, indices, siblings=True):
+        '''Adds the outputs at indices of tx to prevouts, or all of them for a small tx.
+
+        With siblings=False only the outputs at indices are added. Returns
+        the prevouts added, by index.
+        '''
+        for index in indices:
+            if index >= len(tx.tx_outs):
+                raise IndexError('{} has no output {}'.format(tx_id, index))
+        if siblings and len(tx.tx_outs) <= PREVOUT_SIBLINGS:
+            indices = range(len(tx.tx_outs))
+        prevouts = {}
+        for index in indices:
+            tx_out = tx.tx_outs[index]
+            script_pubkey = tx_out.script_pubkey.serialize()
+            prevouts[index] = (tx_out.amount, script_pubkey)
+            cls.prevouts.put((tx_id, index), prevouts[index], len(script_pubkey) + PREVOUT_OVERHEAD)
+        return prevouts
+
+    @classmethod
+    def load(cls, tx_id, testnet=False, fresh=False):
+        '''Parses tx_id from the disk store or the API: (tx, raw size)'''
+        store = cls.store()
+        raw = None if fresh or store is None else store.get(tx_id)
+        if raw is not None:
+            cls.count('disk')
+            tx = cls.parse_raw(raw, testnet)
+        else:
+            cls.count('network')
+            raw = cls.download(tx_id, testnet)
+            tx = cls.parse_raw(raw, testnet)
             if tx.id() != tx_id:
                 raise ValueError('not the same id: {} vs {}'.format(tx.id(), 
                                   tx_id))
-            cls.cache[tx_id] = tx
-        cls.cache[tx_id].testnet = testnet
-        return cls.cache[tx_id]
+            if store is not None:
+                store.put(tx_id, raw)
+        return tx, len(raw)
+
+    @classmethod
+    def download(cls, tx_id, testnet=False):
+        '''Raw bytes of tx_id from the API'''
+        url = '{}/tx/{}/hex'.format(cls.get_url(testnet), tx_id)
+        response = (cls.client or default_client()).get(url)
+        if response.status_code != 200:
+            raise ValueError('unexpected response: {} {}'.format(response.status_code, response.text))
+        try:
+            return bytes.fromhex(response.text.strip())
+        except ValueError:
+            raise ValueError('unexpected response: {}'.format(response.text))
 
     
+def prefetch_parents(tx, workers=PREFETCH_WORKERS):
+    '''Loads the prevouts of all of tx's inputs, fetching parents concurrently.
+
+    Distinct parents missing from the prevout cache are loaded by up to
+    workers threads, so fee(), sig_hash() and verify() afterwards run
+    without waiting on the network. Only as many prevouts as fit in the
+    prevout cache's budget (next to the ones already cached for tx) are
+    prefetched, since more would evict the first before they are read;
+    the inputs beyond it are left to their own lookups, as is a parent
+    that fails to load, whose lookup then raises the error. Returns the
+    number of parents loaded.
+    '''
+    prevouts = TxFetcher.prevouts
+    missing = {}
+    used = 0
+    for tx_in in tx.tx_ins:
+        tx_id = tx_in.prev_tx.hex()
+        if tx_in.prev_tx == b'\x00' * 32:
+            continue
+        size = prevouts.size((tx_id, tx_in.prev_index))
+        if size is None:
+            missing.setdefault(tx_id, []).append(tx_in.prev_index)
+        else:
+            used += size
+    if not missing:
+        return 0
+    budget = [prevouts.budget - used]
+    lock = threading.Lock()
+
+    def load(tx_id):
+        if budget[0] <= 0:
+            return False
+        try:
+            parent = TxFetcher.cache.get(tx_id)
+            if parent is None:
+                parent, _ = TxFetcher.load(tx_id, testnet=tx.testnet)
+            indices = missing[tx_id]
+            size = sum(len(parent.tx_outs[index].script_pubkey.serialize()) + PREVOUT_OVERHEAD
+                       for index in indices)
+            with lock:
+                if size > budget[0]:
+                    budget[0] = 0
+                    return False
+                budget[0] -= size
+            TxFetcher.remember_outputs(tx_id, parent, indices, siblings=False)
+        except (ValueError, IndexError, OSError):
+            return False
+        return True
+
+    if len(missing) == 1 or workers <= 1:
+        return sum(load(tx_id) for tx_id in missing)
+    with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+        return sum(executor.map(load, missing))
+
+
 class Tx:
     command = b'tx'
 
@@ -107,6 +308,7 @@ class Tx:
     
     def fee(self):
         '''Returns the fee of this transaction in satoshis.'''
+        prefetch_parents(self)
         input_sum, output_sum = 0, 0
         for tx_in in self.tx_ins:
             input_sum += tx_in.value(self.testnet)
@@ -137,6 +339,9 @@ class Tx:
             s += tx_out.serialize()
         s += int_to_little_endian(self.locktime, 4)
         s += int_to_little_endian(SIGHASH_ALL, 4)
+        profiler = active_profiler()
+        if profiler is not None:
+            profiler.record_hash(len(s))
         h256 = hash256(s)
         z = int.from_bytes(h256, 'big')
         return z
@@ -216,13 +421,13 @@ class TxIn:
     
     def value(self, testnet=False):
         """Returns the amount (in satoshis) of the UTXO being spent."""
-        tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].amount
+        amount, _ = TxFetcher.fetch_prevout(self.prev_tx.hex(), self.prev_index, testnet=testnet)
+        return amount
     
     def script_pubkey(self, testnet=False):
         """Returns the scriptPubKey of the UTXO being spent."""
-        tx = self.fetch_tx(testnet=testnet)
-        return tx.tx_outs[self.prev_index].script_pubkey
+        _, script_pubkey = TxFetcher.fetch_prevout(self.prev_tx.hex(), self.prev_index, testnet=testnet)
+        return Script.parse(BytesIO(script_pubkey))
     
 class TxOut:
     
@@ -242,4 +447,84 @@ class TxOut:
     def serialize(self):
         result = int_to_little_endian(self.amount, 8)
         result += self.script_pubkey.serialize()
-        return result
\ No newline at end of file
+        return result
+
+# Prevout cache and parent prefetching against a stand-in API: python -m src.tx
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    from random import Random
+
+    from .ecc import PrivateKey
+    from .helper import hash160
+    from .httpclient import HTTPClient
+    from .script import p2pkh_script
+    from .standin import StandInHTTPServer
+
+    rng = Random(4)
+    # children each spending one output of a 2000-output parent
+    parents = [Tx(1, [TxIn(rng.getrandbits(256).to_bytes(32, 'big'), 0)],
+                  [TxOut(1000 + i, p2pkh_script(rng.getrandbits(160).to_bytes(20, 'big')))
+                   for i in range(2000)], 0, testnet=True) for _ in range(100)]
+    children = [Tx(1, [TxIn(parent.hash(), 7)], [TxOut(500, p2pkh_script(b'\x00' * 20))], 0, testnet=True)
+                for parent in parents]
+    with StandInHTTPServer(latency=0.02) as server:
+        for parent in parents:
+            server.add_tx(parent)
+        client = HTTPClient(rate=1e6, burst=1000)
+
+        def retained(label, fee):
+            tracemalloc.start()
+            fees = [fee(child) for child in children]
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            assert fees == [507] * len(children)
+            print('{:<28} {:7.2f} MB retained for {} fees'.format(label, current / 1e6, len(fees)))
+
+        def whole_parent_fee(child):
+            tx_in = child.tx_ins[0]
+            parent = TxFetcher.fetch(tx_in.prev_tx.hex(), testnet=True)
+            return parent.tx_outs[tx_in.prev_index].amount - child.tx_outs[0].amount
+
+        TxFetcher.configure(api_url=server.url, path=None, memory_budget=1 << 30, client=client)
+        retained('whole parents cached', whole_parent_fee)
+        TxFetcher.configure(api_url=server.url, path=None, client=client)
+        retained('prevout cache', Tx.fee)
+
+    # fee() and verify() of a 200-input tx whose parents are all remote
+    key = PrivateKey(rng.getrandbits(128))
+    script = p2pkh_script(hash160(key.point.sec()))
+    parents = [Tx(1, [TxIn(rng.getrandbits(256).to_bytes(32, 'big'), 0)],
+                  [TxOut(10000 + i, script)], 0, testnet=True) for i in range(200)]
+    spend = Tx(1, [TxIn(parent.hash(), 0) for parent in parents], [TxOut(10000, script)], 0, testnet=True)
+    with StandInHTTPServer(latency=0.05) as server:
+        for parent in parents:
+            server.add_tx(parent)
+        client = HTTPClient(rate=1e6, burst=1000, pool_size=64)
+        TxFetcher.configure(api_url=server.url, path=None, client=client)
+        for i in range(len(spend.tx_ins)):
+            spend.sign_input(i, key)
+        for workers in (1, 16, 64):
+            TxFetcher.configure(api_url=server.url, path=None, client=client)
+            TxFetcher.reset_stats()
+            start = time.perf_counter()
+            prefetch_parents(spend, workers=workers)
+            fetched = time.perf_counter() - start
+            assert spend.fee() == sum(range(10000, 10200)) - 10000
+            assert TxFetcher.stats['network'] == len(parents)
+            print('fee() with {:>2} fetch workers: {:6.2f}s ({:.2f}s fetching)'.format(
+                workers, time.perf_counter() - start, fetched))
+        start = time.perf_counter()
+        assert spend.verify() and TxFetcher.stats['network'] == len(parents)
+        print('verify() after prefetch:     {:6.2f}s, no network requests'.format(time.perf_counter() - start))
+        # a prevout cache with room for a quarter of the inputs
+        fits = len(parents) // 4
+        TxFetcher.configure(api_url=server.url, path=None, client=client,
+                            prevout_budget=fits * (len(script.serialize()) + PREVOUT_OVERHEAD))
+        TxFetcher.reset_stats()
+        loaded = prefetch_parents(spend)
+        assert loaded == fits and len(TxFetcher.prevouts) == fits
+        print('prevouts for {} of {} inputs fit: {} prefetched, {} fetched, none evicted'.format(
+            fits, len(parents), loaded, TxFetcher.stats['network']))
+    TxFetcher.configure()
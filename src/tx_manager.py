@@ -1,34 +1,60 @@
 from .wallet import Wallet
-from .network import SimpleNode
-from .tx import Tx, TxIn, TxOut
-from .utxo import UTXOFetcher
-from .helper import decode_base58
+from .broadcast import BLOCKSTREAM_TESTNET_URL, BroadcastManager
+from .peers import PeerManager
+from .pool import ConnectionPool
+from .relay import TxRelay
+from .tx import Tx, TxIn, TxOut, prefetch_parents
+from .utxostore import UTXOStore
+from .base58 import decode_address
+from .httpclient import default_client
 from .script import p2pkh_script
-import requests
 
 class Portfolio:
     """Handles creation and broadcasting of transactions using UTXOs."""
     
-    def __init__(self, node_address):
+    def __init__(self, node_address=None, api_url=BLOCKSTREAM_TESTNET_URL, peer_count=3, max_age=60):
         self.wallet = Wallet()
-        self.node = SimpleNode(host=node_address, testnet=True)
+        if isinstance(node_address, str):
+            node_address = [node_address]
+        self.api_url = api_url
+        self.peer_count = peer_count
+        self.peers = PeerManager(node_address, testnet=True)
+        # fastest peers remembered from earlier runs; connects on the first
+        # socket broadcast, then stays open for reuse
+        self.pool = ConnectionPool(self.peers.addresses(peer_count), testnet=True)
+        self.broadcaster = BroadcastManager(self.pool, url=api_url)
+        # local UTXO index, refreshed from the API at most every max_age seconds
+        self.utxos = UTXOStore(testnet=True, api_url=api_url, max_age=max_age)
+
+    def balance(self, address):
+        """Spendable balance of address, answered from the local UTXO store."""
+        return self.utxos.balance(address)
+
+    def refresh_peers(self):
+        """Races the candidate peers and routes broadcasts to the fastest ones."""
+        pool = self.peers.connect(self.peer_count)
+        self.broadcaster.close()
+        self.pool.close()
+        self.pool = pool
+        self.broadcaster = BroadcastManager(self.pool, url=self.api_url)
+        print("Routing broadcasts to:", ", ".join(
+            f"{c.host}:{c.port}" for c in self.pool.connections))
         
     def create_tx(self, from_address, to_address, amount, fee):
         """Creates a signed Bitcoin transaction."""
-        fetcher = UTXOFetcher()
-        utxos = fetcher.fetch_utxos(from_address, testnet=True)
+        utxos = self.utxos.utxos(from_address)
         
         tx_ins = []
         tx_outs = []
         total_input = 0
         
         for utxo in utxos:
-            prev_tx = bytes.fromhex(utxo['txid'])
-            prev_index = utxo['vout']
+            prev_tx = bytes.fromhex(utxo.txid)
+            prev_index = utxo.vout
             tx_in = TxIn(prev_tx, prev_index)
             tx_ins.append(tx_in)
-            total_input += utxo['value']
-            print(f"Adding UTXO: {utxo['txid']}:{utxo['vout']} with value {utxo['value']}")
+            total_input += utxo.amount
+            print(f"Adding UTXO: {utxo.txid}:{utxo.vout} with value {utxo.amount}")
             if total_input >= amount + fee:
                 break
             
@@ -37,7 +63,7 @@ class Portfolio:
         print(f"Total input: {total_input}")
         
         # Create output to recipient
-        to_h160 = decode_base58(to_address)
+        to_h160 = decode_address(to_address)
         script_pubkey_to = p2pkh_script(to_h160)
         tx_outs.append(TxOut(amount, script_pubkey_to))
         print(f"Creating output to address: {to_address} with amount {amount}")
@@ -45,7 +71,7 @@ class Portfolio:
         # Create change output if necessary
         change_amount = total_input - amount - fee
         if change_amount > 0:
-            from_h160 = decode_base58(from_address)
+            from_h160 = decode_address(from_address)
             script_pubkey_from = p2pkh_script(from_h160)
             tx_outs.append(TxOut(change_amount, script_pubkey_from))
             print(f"Creating change output to address: {from_address} with amount {change_amount}")
@@ -54,7 +80,8 @@ class Portfolio:
         # Create transaction object
         tx_obj = Tx(1, tx_ins, tx_outs, 0, testnet=True)
 
-        # Sign each input
+        # Sign each input, with every parent fetched up front
+        prefetch_parents(tx_obj)
         for i in range(len(tx_ins)): 
             print("Signing input...")
             signature_result = tx_obj.sign_input(i, self.wallet.priv_key)
@@ -65,22 +92,46 @@ class Portfolio:
         return tx_obj
     
     def broadcast_tx(self, tx_obj, via='socket'):
-        """Broadcasts the transaction via P2P or HTTP."""
-        if via == 'socket':
+        """Broadcasts the transaction via P2P, HTTP or racing both ('race')."""
+        if via == 'race':
+            result = self.broadcaster.broadcast(tx_obj)
+            if result.accepted:
+                self.utxos.mark_spent(tx_obj)
+                print(f"Transaction accepted via {result.winner} in {result.latencies[result.winner]:.3f}s")
+            else:
+                print("Broadcast failed on every route:", result.errors)
+            return result
+        elif via == 'socket':
             try:
-                self.node.handshake()
-                self.node.send(tx_obj)
+                self.pool.send(tx_obj)
+                self.utxos.mark_spent(tx_obj)
                 print("Transaction broadcasted via P2P.")
             except Exception as e:
                 print("Socket broadcast failed:", e)
         elif via == 'http':
             try:
                 raw = tx_obj.serialize().hex()
-                url = "https://blockstream.info/testnet/api/tx"
+                url = self.api_url + "/tx"
                 headers = {'Content-Type': 'text/plain'}
-                response = requests.post(url, data=raw, headers=headers)
+                response = default_client().post(url, data=raw, headers=headers)
+                if response.status_code == 200:
+                    self.utxos.mark_spent(tx_obj)
                 print(f"Broadcast via HTTP status: {response.status_code}")
                 print(response.text)
             except Exception as e:
                 print("HTTP broadcast failed:", e)
+
+    def broadcast_many(self, txs):
+        """Announces many transactions in one inv and serves them parents first."""
+        with self.pool.session() as node:
+            report = TxRelay(node).relay(txs)
+        print(f"Relayed {report['sent']}/{report['announced']} transactions "
+              f"({report['tx_per_second']:.0f} tx/s)")
+        return report
+
+    def close(self):
+        """Closes any pooled P2P connections and the UTXO store."""
+        self.broadcaster.close()
+        self.pool.close()
+        self.utxos.close()
  
\ No newline at end of file
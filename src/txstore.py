@@ -0,0 +1,227 @@
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from .helper import data_path
+
+TX_DB = "txs.db"
+# on-disk budget for raw transactions before the least recently used go
+DISK_BUDGET = 64 * 1024 * 1024
+# in-memory budget, counted in raw transaction bytes
+MEMORY_BUDGET = 4 * 1024 * 1024
+# prevout cache budget, counted as scriptPubKey bytes plus PREVOUT_OVERHEAD
+# per entry for the key tuple, amount and dict slot
+PREVOUT_BUDGET = 8 * 1024 * 1024
+PREVOUT_OVERHEAD = 200
+# parents with at most this many outputs have all of them remembered
+PREVOUT_SIBLINGS = 32
+# a read only rewrites a row's last-used time when it is older than this,
+# so readers in other processes rarely need the write lock
+TOUCH_INTERVAL = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS txs (
+    txid TEXT PRIMARY KEY, raw BLOB NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS txs_used ON txs (used);
+CREATE TABLE IF NOT EXISTS size (
+    id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+INSERT OR IGNORE INTO size VALUES (0, (SELECT COALESCE(SUM(LENGTH(raw)), 0) FROM txs));
+CREATE TRIGGER IF NOT EXISTS txs_insert AFTER INSERT ON txs BEGIN
+    UPDATE size SET bytes = bytes + LENGTH(NEW.raw); END;
+CREATE TRIGGER IF NOT EXISTS txs_update AFTER UPDATE OF raw ON txs BEGIN
+    UPDATE size SET bytes = bytes - LENGTH(OLD.raw) + LENGTH(NEW.raw); END;
+CREATE TRIGGER IF NOT EXISTS txs_delete AFTER DELETE ON txs BEGIN
+    UPDATE size SET bytes = bytes - LENGTH(OLD.raw); END;
+'''
+
+
+class RawTxStore:
+    '''Raw transactions on disk, keyed by txid, within a byte budget.
+
+    The store is a SQLite database in WAL mode, so any number of processes
+    can read it while one writes, and every connection sees the others'
+    inserts. Each row carries a last-used time; when the total size
+    passes budget, put() evicts the least recently used rows. Triggers
+    keep that total in a one-row size table, so checking it costs one
+    lookup whatever the store holds. A relative path is resolved against
+    the data directory.
+    '''
+
+    def __init__(self, path=TX_DB, budget=DISK_BUDGET, timeout=30):
+        self.path = data_path(path)
+        self.budget = budget
+        self.db = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM txs').fetchone()[0]
+
+    def get(self, tx_id):
+        '''Raw bytes of tx_id, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT raw, used FROM txs WHERE txid = ?', (tx_id,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            now = time.time()
+            if now - row[1] > TOUCH_INTERVAL:
+                with self.db:
+                    self.db.execute('UPDATE txs SET used = ? WHERE txid = ?', (now, tx_id))
+            return bytes(row[0])
+
+    def put(self, tx_id, raw):
+        with self.lock, self.db:
+            # an upsert, since REPLACE would delete without firing txs_delete
+            self.db.execute(
+                'INSERT INTO txs VALUES (?, ?, ?) ON CONFLICT (txid) DO UPDATE SET '
+                'raw = excluded.raw, used = excluded.used', (tx_id, raw, time.time()))
+            self._evict()
+
+    def _evict(self):
+        excess = self.size() - self.budget
+        if excess <= 0:
+            return
+        victims = []
+        for tx_id, size in self.db.execute('SELECT txid, LENGTH(raw) FROM txs ORDER BY used'):
+            victims.append((tx_id,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM txs WHERE txid = ?', victims)
+        self.stats['evictions'] += len(victims)
+
+    def size(self):
+        '''Total bytes of raw transactions stored'''
+        return self.db.execute('SELECT bytes FROM size').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+class MemoryTier:
+    '''LRU in front of the disk store, bounded by the sizes given to put()
+
+    TxFetcher keeps parsed transactions (sized by their raw bytes) and
+    prevouts (sized by their scriptPubKey) in one each.
+    '''
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def __contains__(self, tx_id):
+        with self.lock:
+            return tx_id in self.items
+
+    def size(self, tx_id):
+        '''The size tx_id was put with, or None if it is not held'''
+        with self.lock:
+            item = self.items.get(tx_id)
+            return None if item is None else item[1]
+
+    def get(self, tx_id):
+        with self.lock:
+            item = self.items.get(tx_id)
+            if item is None:
+                return None
+            self.items.move_to_end(tx_id)
+            return item[0]
+
+    def put(self, tx_id, tx, size):
+        with self.lock:
+            old = self.items.pop(tx_id, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.items[tx_id] = (tx, size)
+            self.bytes += size
+            while self.bytes > self.budget and len(self.items) > 1:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+def _read_all(path, tx_ids):
+    '''Worker for the cross-process benchmark: reads every tx_id from a store'''
+    with RawTxStore(path) as store:
+        return sum(store.get(tx_id) is not None for tx_id in tx_ids)
+
+
+# Memory, disk and network tiers against a stand-in with latency: python -m src.txstore
+if __name__ == "__main__":
+    import tempfile
+
+    from concurrent.futures import ProcessPoolExecutor
+    from random import Random
+
+    from .httpclient import HTTPClient
+    from .standin import StandInHTTPServer, synthetic_mempool
+    from .tx import TxFetcher
+
+    txs = synthetic_mempool(2000, seed=3)
+    rng = Random(4)
+    # skewed workload: 80% of fetches hit 50 hot parents, the rest a long tail
+    workload = [txs[rng.randrange(50) if rng.random() < 0.8 else rng.randrange(len(txs))].id()
+                for _ in range(5000)]
+
+    with StandInHTTPServer(latency=0.02) as server, tempfile.TemporaryDirectory() as tmp:
+        for tx in txs:
+            server.add_tx(tx)
+        path = os.path.join(tmp, TX_DB)
+        client = HTTPClient(rate=1e6, burst=1000)
+
+        def run(label):
+            TxFetcher.reset_stats()
+            start = time.perf_counter()
+            for tx_id in workload:
+                TxFetcher.fetch(tx_id, testnet=True)
+            elapsed = time.perf_counter() - start
+            rates = TxFetcher.hit_rates()
+            print('{:<28} {:7.2f}s  memory {:5.1%}  disk {:5.1%}  network {:5.1%}'.format(
+                label, elapsed, rates['memory'], rates['disk'], rates['network']))
+
+        TxFetcher.configure(api_url=server.url, path=path, memory_budget=16 * 1024, client=client)
+        run('cold (empty store)')
+        TxFetcher.configure(api_url=server.url, path=path, memory_budget=16 * 1024, client=client)
+        run('new process, warm disk')
+
+        unique = sorted(set(workload))
+        start = time.perf_counter()
+        with ProcessPoolExecutor(4) as executor:
+            found = list(executor.map(_read_all, [path] * 4, [unique] * 4))
+        print('{:<28} {:7.2f}s  each found {} of {} txs'.format(
+            '4 reader processes', time.perf_counter() - start, found[0], len(unique)))
+
+        budget = 20000
+        TxFetcher.configure(api_url=server.url, path=os.path.join(tmp, 'small.db'), budget=budget, client=client)
+        for tx in txs[:500]:
+            TxFetcher.fetch(tx.id(), testnet=True)
+        store = TxFetcher.store()
+        print('budget {} bytes: {} txs, {} bytes stored, {} evicted'.format(
+            budget, len(store), store.size(), store.stats['evictions']))
+    TxFetcher.configure()
@@ -1,5 +1,44 @@
-import time
-import requests
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from .httpclient import default_client
+
+
+class UTXO:
+    '''An unspent output as reported by the esplora API'''
+
+    __slots__ = ('address', 'txid', 'vout', 'amount', 'confirmed', 'block_height')
+
+    def __init__(self, address, txid, vout, amount, confirmed=True, block_height=None):
+        self.address = address
+        self.txid = txid
+        self.vout = vout
+        self.amount = amount
+        self.confirmed = confirmed
+        self.block_height = block_height
+
+    def __repr__(self):
+        return 'UTXO({}:{}, {} sat)'.format(self.txid, self.vout, self.amount)
+
+    def __eq__(self, other):
+        return isinstance(other, UTXO) and self.outpoint == other.outpoint
+
+    def __hash__(self):
+        return hash(self.outpoint)
+
+    @property
+    def outpoint(self):
+        return self.txid, self.vout
+
+    @classmethod
+    def from_json(cls, address, data):
+        status = data.get('status', {})
+        return cls(address, data['txid'], data['vout'], data['value'],
+                   status.get('confirmed', True), status.get('block_height'))
+
 
 class UTXOFetcher:
     @staticmethod
@@ -9,27 +48,102 @@ class UTXOFetcher:
         else:
             return 'https://blockstream.info/api'
 
+    @staticmethod
+    def fetch(address, testnet=False, retries=3, timeout=10, client=None, api_url=None):
+        '''UTXO records for one address; raises ValueError on failure'''
+        url = f'{api_url or UTXOFetcher.get_url(testnet)}/address/{address}/utxo'
+        client = client or default_client()
+        try:
+            response = client.get(url, retries=retries, timeout=timeout)
+        except Exception as e:
+            raise ValueError(f"Failed to fetch UTXOs after {retries} retries: {e}")
+        if response.status_code != 200:
+            raise ValueError(f"Failed to fetch UTXOs: status {response.status_code}")
+        try:
+            return [UTXO.from_json(address, data) for data in response.json()]
+        except (ValueError, KeyError) as e:
+            raise ValueError(f"Unexpected UTXO response: {e}")
+
     @staticmethod
     def fetch_utxos(address, testnet=False, retries=3, timeout=10):
-        url = f'{UTXOFetcher.get_url(testnet)}/address/{address}/utxo'
-        for attempt in range(retries):
-            try:
-                print(f"Request URL: {url} (Attempt {attempt+1})")
-                response = requests.get(url, timeout=timeout)
-                print(f"Response Status Code: {response.status_code}")
-                if response.status_code != 200:
-                    print(f"Unexpected status code: {response.status_code}")
-                    time.sleep(2)
-                    continue
-                utxos = response.json()
-                return utxos
-            except requests.exceptions.Timeout:
-                print("Timeout occurred, retrying...")
-                time.sleep(2)
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}")
-                time.sleep(2)
-            except ValueError as e:
-                print(f"JSON decode error: {e}")
-                time.sleep(2)
-        raise ValueError(f"Failed to fetch UTXOs after {retries} retries.")
\ No newline at end of file
+        print(f"Fetching UTXOs for {address}")
+        utxos = UTXOFetcher.fetch(address, testnet, retries, timeout)
+        print(f"Found {len(utxos)} UTXOs")
+        return utxos
+
+    @staticmethod
+    def fetch_many(addresses, testnet=False, workers=16, retries=3, timeout=10,
+                   client=None, api_url=None):
+        '''Yields (address, utxos, error) for each address as its fetch completes.
+
+        At most workers requests run at once and addresses are consumed
+        lazily, so huge address lists are fine. A failed address yields
+        utxos=None and the exception instead of stopping the batch.
+        '''
+        client = client or default_client()
+        addresses = iter(addresses)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+
+            def submit():
+                for address in addresses:
+                    future = executor.submit(
+                        UTXOFetcher.fetch, address, testnet, retries, timeout, client, api_url)
+                    pending[future] = address
+                    if len(pending) >= 2 * workers:
+                        return
+
+            submit()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    address = pending.pop(future)
+                    try:
+                        yield address, future.result(), None
+                    except ValueError as e:
+                        yield address, None, e
+                submit()
+
+    @staticmethod
+    def balances(addresses, testnet=False, workers=16, client=None, api_url=None):
+        '''(confirmed+unconfirmed balance per address, errors per address)'''
+        balances = {}
+        errors = {}
+        for address, utxos, error in UTXOFetcher.fetch_many(
+                addresses, testnet, workers=workers, client=client, api_url=api_url):
+            if error is None:
+                balances[address] = sum(utxo.amount for utxo in utxos)
+            else:
+                errors[address] = error
+        return balances, errors
+
+
+# Benchmark against a local stand-in with injected latency: python -m src.utxo
+if __name__ == "__main__":
+    import time
+
+    from .httpclient import HTTPClient
+    from .standin import StandInHTTPServer
+
+    count = 1000
+    addresses = ['addr{:04d}'.format(i) for i in range(count)]
+    with StandInHTTPServer(latency=0.05) as server:
+        for i, address in enumerate(addresses):
+            server.utxos[address] = [{'txid': '{:064x}'.format(i), 'vout': 0, 'value': 1000 + i,
+                                      'status': {'confirmed': True, 'block_height': 100}}]
+        client = HTTPClient(rate=1e6, burst=1000, pool_size=64)
+        sample = 40
+        start = time.perf_counter()
+        for address in addresses[:sample]:
+            UTXOFetcher.fetch(address, client=client, api_url=server.url)
+        sequential = (time.perf_counter() - start) / sample * count
+        print('sequential:        {:6.2f}s for {} addresses (extrapolated from {})'.format(
+            sequential, count, sample))
+        for workers in (8, 32, 64):
+            start = time.perf_counter()
+            balances, errors = UTXOFetcher.balances(
+                addresses, workers=workers, client=client, api_url=server.url)
+            elapsed = time.perf_counter() - start
+            assert len(balances) == count and not errors
+            print('fetch_many({:>2}):    {:6.2f}s for {} addresses ({:.0f}x)'.format(
+                workers, elapsed, count, sequential / elapsed))
@@ -0,0 +1,300 @@
+import sqlite3
+import threading
+import time
+
+from .helper import data_path
+from .httpclient import default_client
+from .utxo import UTXO, UTXOFetcher
+
+UTXO_DB = "utxos.db"
+# confirmed txs per /address/<a>/txs page, as esplora serves them
+CHAIN_PAGE_SIZE = 25
+# history pages walked before a full /utxo snapshot is cheaper
+MAX_PAGES = 8
+# seconds after which a pending spend that never showed up is released
+PENDING_EXPIRY = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS utxos (
+    txid TEXT NOT NULL, vout INTEGER NOT NULL, address TEXT NOT NULL,
+    amount INTEGER NOT NULL, block_height INTEGER,
+    PRIMARY KEY (txid, vout));
+CREATE INDEX IF NOT EXISTS utxos_address ON utxos (address);
+CREATE TABLE IF NOT EXISTS mempool_outputs (
+    txid TEXT NOT NULL, vout INTEGER NOT NULL, address TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (txid, vout));
+CREATE INDEX IF NOT EXISTS mempool_outputs_address ON mempool_outputs (address);
+CREATE TABLE IF NOT EXISTS spends (
+    txid TEXT NOT NULL, vout INTEGER NOT NULL, spending_txid TEXT NOT NULL,
+    address TEXT, created REAL NOT NULL,
+    PRIMARY KEY (txid, vout));
+CREATE TABLE IF NOT EXISTS sync (
+    address TEXT PRIMARY KEY, cursor TEXT NOT NULL, refreshed REAL NOT NULL);
+'''
+
+SPENDABLE = '''
+SELECT txid, vout, amount, 1, block_height FROM utxos u WHERE address = :address
+    AND NOT EXISTS (SELECT 1 FROM spends s WHERE s.txid = u.txid AND s.vout = u.vout)
+UNION ALL
+SELECT txid, vout, amount, 0, NULL FROM mempool_outputs m WHERE address = :address
+    AND NOT EXISTS (SELECT 1 FROM spends s WHERE s.txid = m.txid AND s.vout = m.vout)
+'''
+
+
+class UTXOStore:
+    '''SQLite cache of the wallet's unspent outputs, refreshed incrementally.
+
+    Confirmed outputs live in utxos, keyed by outpoint and indexed by
+    address. Each address remembers the newest confirmed txid it has
+    applied (its cursor): a refresh reads /address/<a>/txs newest first
+    and applies only the confirmed transactions above the cursor, so an
+    address with no new activity costs one request. The first sync, a
+    reorg that drops the cursor, or a backlog over MAX_PAGES pages falls
+    back to a /utxo snapshot. Mempool transactions are kept apart as an
+    overlay (mempool_outputs plus spends) and replaced on every refresh.
+
+    mark_spent() records the inputs of our own broadcasts as pending
+    spends, so they are not offered again before the network reports
+    them. Queries refresh an address only when its data is older than
+    max_age seconds; otherwise they are answered from the local index.
+    A relative path is resolved against the data directory.
+    '''
+
+    def __init__(self, path=UTXO_DB, testnet=True, api_url=None, max_age=60, client=None):
+        if path != ':memory:':
+            path = data_path(path)
+        self.path = path
+        self.testnet = testnet
+        self.api_url = api_url or UTXOFetcher.get_url(testnet)
+        self.max_age = max_age
+        self.client = client or default_client()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.refreshed = dict(self.db.execute('SELECT address, refreshed FROM sync'))
+        # balance per address, dropped whenever the tables change
+        self.balances = {}
+        self.stats = {'refreshes': 0, 'snapshots': 0, 'pages': 0, 'applied': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _get_json(self, path):
+        response = self.client.get(self.api_url + path)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to fetch {path}: status {response.status_code}")
+        return response.json()
+
+    def _new_confirmed(self, address, confirmed, cursor):
+        '''Confirmed txs above cursor, newest first, or None if a snapshot is needed'''
+        new = []
+        page = confirmed
+        for _ in range(MAX_PAGES):
+            for tx in page:
+                if tx['txid'] == cursor:
+                    return new
+                new.append(tx)
+            if len(page) < CHAIN_PAGE_SIZE:
+                # reached the start of the history: only fine if it was empty before
+                return new if cursor == '' else None
+            self.stats['pages'] += 1
+            page = self._get_json(f"/address/{address}/txs/chain/{page[-1]['txid']}")
+        return None
+
+    def refresh(self, address):
+        '''Brings address up to date with the API; returns the number of txs applied'''
+        history = self._get_json(f"/address/{address}/txs")
+        self.stats['pages'] += 1
+        mempool = [tx for tx in history if not tx['status']['confirmed']]
+        confirmed = [tx for tx in history if tx['status']['confirmed']]
+        with self.lock:
+            row = self.db.execute('SELECT cursor FROM sync WHERE address = ?', (address,)).fetchone()
+        new = None if row is None else self._new_confirmed(address, confirmed, row[0])
+        snapshot = None
+        if new is None:
+            snapshot = UTXOFetcher.fetch(address, self.testnet, client=self.client, api_url=self.api_url)
+            new = []
+        cursor = confirmed[0]['txid'] if confirmed else (row[0] if row else '')
+        now = time.time()
+        with self.lock, self.db:
+            if snapshot is not None:
+                self.stats['snapshots'] += 1
+                self.db.execute('DELETE FROM utxos WHERE address = ?', (address,))
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO utxos VALUES (?, ?, ?, ?, ?)',
+                    [(u.txid, u.vout, address, u.amount, u.block_height) for u in snapshot if u.confirmed])
+            self._apply(address, new)
+            self._replace_mempool(address, mempool, now)
+            self.db.execute(
+                'DELETE FROM spends WHERE address IS NULL AND (created < ? OR ('
+                'NOT EXISTS (SELECT 1 FROM utxos u WHERE u.txid = spends.txid AND u.vout = spends.vout) AND '
+                'NOT EXISTS (SELECT 1 FROM mempool_outputs m WHERE m.txid = spends.txid AND m.vout = spends.vout)))',
+                (now - PENDING_EXPIRY,))
+            self.db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (address, cursor, now))
+            self.refreshed[address] = now
+            self.balances.clear()
+            self.stats['refreshes'] += 1
+            self.stats['applied'] += len(new)
+        return len(new)
+
+    @staticmethod
+    def _effects(address, txs):
+        '''(outputs paying address, outpoints spent) of a batch of esplora txs'''
+        created = {}
+        spent = set()
+        for tx in txs:
+            for vout, output in enumerate(tx['vout']):
+                if output.get('scriptpubkey_address') == address:
+                    created[(tx['txid'], vout)] = (output['value'], tx['status'].get('block_height'))
+            for vin in tx['vin']:
+                if not vin.get('is_coinbase'):
+                    spent.add((vin['txid'], vin['vout']))
+        return created, spent
+
+    def _apply(self, address, txs):
+        created, spent = self._effects(address, txs)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO utxos VALUES (?, ?, ?, ?, ?)',
+            [(txid, vout, address, amount, height)
+             for (txid, vout), (amount, height) in created.items() if (txid, vout) not in spent])
+        self.db.executemany('DELETE FROM utxos WHERE txid = ? AND vout = ?', list(spent))
+
+    def _replace_mempool(self, address, txs, now):
+        created, spent = self._effects(address, txs)
+        spenders = {(vin['txid'], vin['vout']): tx['txid'] for tx in txs for vin in tx['vin']}
+        self.db.execute('DELETE FROM mempool_outputs WHERE address = ?', (address,))
+        self.db.execute('DELETE FROM spends WHERE address = ?', (address,))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO mempool_outputs VALUES (?, ?, ?, ?)',
+            [(txid, vout, address, amount) for (txid, vout), (amount, _) in created.items()])
+        self.db.executemany(
+            'INSERT OR REPLACE INTO spends VALUES (?, ?, ?, ?, ?)',
+            [(txid, vout, spenders[(txid, vout)], address, now) for txid, vout in spent])
+
+    def ensure_fresh(self, address, max_age=None):
+        '''Refreshes address if its data is older than max_age (default self.max_age)'''
+        if max_age is None:
+            max_age = self.max_age
+        refreshed = self.refreshed.get(address)
+        if refreshed is not None and time.time() - refreshed <= max_age:
+            return
+        try:
+            self.refresh(address)
+        except Exception as e:
+            if refreshed is None:
+                raise ValueError(f"Failed to fetch UTXOs for {address}: {e}")
+            print(f"Refresh failed, using UTXOs cached {time.time() - refreshed:.0f}s ago: {e}")
+
+    def utxos(self, address, max_age=None):
+        '''Spendable UTXO records: confirmed and mempool outputs not spent by anyone we know of'''
+        self.ensure_fresh(address, max_age)
+        with self.lock:
+            rows = self.db.execute(SPENDABLE, {'address': address}).fetchall()
+        return [UTXO(address, txid, vout, amount, bool(confirmed), height)
+                for txid, vout, amount, confirmed, height in rows]
+
+    def balance(self, address, max_age=None):
+        self.ensure_fresh(address, max_age)
+        with self.lock:
+            balance = self.balances.get(address)
+            if balance is None:
+                balance = self.balances[address] = self.db.execute(
+                    'SELECT COALESCE(SUM(amount), 0) FROM (' + SPENDABLE + ')', {'address': address}).fetchone()[0]
+            return balance
+
+    def mark_spent(self, tx):
+        '''Holds back the outpoints tx spends until the network reports it'''
+        now = time.time()
+        tx_id = tx.id()
+        with self.lock, self.db:
+            self.balances.clear()
+            self.db.executemany(
+                'INSERT OR IGNORE INTO spends VALUES (?, ?, ?, NULL, ?)',
+                [(tx_in.prev_tx.hex(), tx_in.prev_index, tx_id, now) for tx_in in tx.tx_ins])
+
+    def release(self, tx_id):
+        '''Forgets the pending spends of a tx that will not be broadcast after all'''
+        with self.lock, self.db:
+            self.balances.clear()
+            self.db.execute('DELETE FROM spends WHERE spending_txid = ? AND address IS NULL', (tx_id,))
+
+    def close(self):
+        self.db.close()
+
+
+# Incremental refresh and local balance queries against a stand-in: python -m src.utxostore
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from .httpclient import HTTPClient
+    from .standin import StandInHTTPServer
+    from .tx import Tx, TxIn
+
+    address = 'mwallet'
+    counter = iter(range(1, 10**6))
+    height = [100]
+
+    def add_tx(server, spends=(), outputs=(), confirmed=True):
+        '''Appends an esplora-style tx to the history and keeps /utxo consistent'''
+        txid = '{:064x}'.format(next(counter))
+        status = {'confirmed': confirmed, 'block_height': height[0] if confirmed else None}
+        tx = {'txid': txid, 'status': status,
+              'vin': [{'txid': t, 'vout': v, 'is_coinbase': False} for t, v in spends],
+              'vout': [{'scriptpubkey_address': a, 'value': value} for a, value in outputs]}
+        history = server.histories.setdefault(address, [])
+        history.insert(0 if not confirmed else len([t for t in history if not t['status']['confirmed']]), tx)
+        unspent = server.utxos.setdefault(address, [])
+        unspent[:] = [u for u in unspent if (u['txid'], u['vout']) not in set(spends)]
+        for vout, (a, value) in enumerate(outputs):
+            if a == address:
+                unspent.append({'txid': txid, 'vout': vout, 'value': value, 'status': status})
+        height[0] += confirmed
+        return txid
+
+    with StandInHTTPServer(latency=0.02) as server, tempfile.TemporaryDirectory() as tmp:
+        coins = [(add_tx(server, outputs=[(address, 1000 + i)]), 0) for i in range(500)]
+        for i in range(0, 200, 2):
+            add_tx(server, spends=[coins[i]], outputs=[('elsewhere', 500), (address, 400)])
+        expected = lambda: sum(u['value'] for u in server.utxos[address])
+
+        client = HTTPClient(rate=1e6, burst=1000)
+        store = UTXOStore(os.path.join(tmp, UTXO_DB), api_url=server.url, max_age=60, client=client)
+        start = time.perf_counter()
+        assert store.balance(address) == expected()
+        print('first sync (snapshot):      {:7.1f} ms, {} requests'.format(
+            (time.perf_counter() - start) * 1000, server.requests))
+
+        for i in range(1, 13, 2):
+            add_tx(server, spends=[coins[i]], outputs=[(address, 900)])
+        add_tx(server, outputs=[(address, 777)], confirmed=False)
+        before = server.requests
+        start = time.perf_counter()
+        applied = store.refresh(address)
+        assert store.balance(address) == expected(), (store.balance(address), expected())
+        print('incremental refresh:        {:7.1f} ms, {} requests, {} txs applied'.format(
+            (time.perf_counter() - start) * 1000, server.requests - before, applied))
+
+        start = time.perf_counter()
+        UTXOFetcher.fetch(address, client=client, api_url=server.url)
+        print('full /utxo download:        {:7.1f} ms'.format((time.perf_counter() - start) * 1000))
+        runs = 20000
+        start = time.perf_counter()
+        for _ in range(runs):
+            store.balance(address)
+        print('local balance query:        {:7.1f} us'.format((time.perf_counter() - start) / runs * 1e6))
+
+        store.mark_spent(Tx(1, [TxIn(bytes.fromhex(coins[201][0]), 0)], [], 0, testnet=True))
+        assert store.balance(address) == expected() - 1201
+        store.close()
+        reopened = UTXOStore(store.path, api_url=server.url, client=client)
+        before = server.requests
+        assert reopened.balance(address) == expected() - 1201 and server.requests == before
+        print('pending spend held back and cache reused across reopen without requests')
+        reopened.close()